@@ -21,7 +21,14 @@ from amivapi.auth.link_methods import (
     add_permitted_methods_after_update,
     add_permitted_methods_for_home
 )
-from amivapi.auth.sessions import process_login, sessiondomain
+from amivapi.auth.sessions import (
+    invalidate_cached_session,
+    invalidate_cached_sessions_of_user,
+    process_login,
+    sessiondomain
+)
+from amivapi.cache import TimestampBuffer, TTLCache
+from amivapi.indexes import expiry_index, register_indexes
 from amivapi.utils import register_domain
 
 
@@ -33,6 +40,20 @@ def init_app(app):
     # Sessions
     register_domain(app, sessiondomain)
     app.on_insert_sessions += process_login
+    register_indexes(app, 'sessions', {
+        '_updated': expiry_index('_updated', app.config['SESSION_TIMEOUT']),
+    })
+
+    # Session cache and buffered timestamp updates
+    app.config['session_cache'] = TTLCache(app.config['SESSION_CACHE_SIZE'],
+                                           app.config['SESSION_CACHE_TTL'])
+    app.config['unknown_token_cache'] = TTLCache(
+        app.config['UNKNOWN_TOKEN_CACHE_SIZE'],
+        app.config['SESSION_CACHE_TTL'])
+    app.config['session_timestamps'] = TimestampBuffer(
+        app, 'sessions', app.config['TIMESTAMP_FLUSH_INTERVAL'])
+    app.on_deleted_item_sessions += invalidate_cached_session
+    app.on_deleted_item_users += invalidate_cached_sessions_of_user
 
     # on_pre_METHOD, triggered right after auth by Eve
     for method in ['GET', 'POST', 'PATCH', 'DELETE']:
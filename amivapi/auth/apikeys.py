@@ -8,12 +8,19 @@
 Provides the apikey resource and hooks to handle authorization with a key.
 
 API keys should only be created or modified by admins.
+
+Authorization happens for every request, but there are only a few keys which
+are rarely modified. Therefore all keys are kept in memory as a table mapping
+tokens to permissions. This way, tokens which are not API keys (e.g. user
+sessions) can be ruled out without any database access.
+The table is reloaded after `APIKEY_CACHE_TTL` or if keys are modified.
 """
 from datetime import datetime as dt
 
 from flask import abort, current_app, g
 
 from amivapi.auth.auth import AdminOnlyAuth
+from amivapi.cache import TimestampBuffer, TTLCache
 from amivapi.utils import register_domain
 
 try:
@@ -23,14 +30,29 @@ except ImportError:
     from amivapi.utils import token_urlsafe
 
 
+def get_apikey_table():
+    """Return a dict mapping the tokens of all API keys to the keys."""
+    cache = current_app.config['apikey_cache']
+    table = cache.get('table')
+
+    if table is None:
+        keys = current_app.data.driver.db['apikeys'].find(
+            {}, {'token': 1, 'permissions': 1})
+        table = {key['token']: key for key in keys}
+        cache.set('table', table)
+
+    return table
+
+
 def authorize_apikeys(resource):
     """Check if user is an apikey, and if it is, do authorization.
 
     Also update 'updated' timestamp everytime a key is accessed
     """
-    apikeys = current_app.data.driver.db['apikeys']
-    apikey = apikeys.find_one({'token': g.get('current_token')},
-                              {'permissions': 1})
+    if g.get('current_session') is not None:
+        return  # The token belongs to a user session, not to a key
+
+    apikey = get_apikey_table().get(g.get('current_token'))
 
     if apikey:
         # Get permission for resource if they exist
@@ -38,8 +60,7 @@ def authorize_apikeys(resource):
 
         # Update timestamp (remove microseconds to match mongo precision)
         new_time = dt.utcnow().replace(microsecond=0)
-        apikeys.update_one({'_id': apikey['_id']},
-                           {'$set': {'_updated': new_time}})
+        current_app.config['apikey_timestamps'].touch(apikey['_id'], new_time)
 
         if permission == 'read':
             g.resource_admin_readonly = True
@@ -50,6 +71,11 @@ def authorize_apikeys(resource):
                        "permissions.")
 
 
+def invalidate_apikey_table(*_):
+    """Hook to reload the API key table after keys have been modified."""
+    current_app.config['apikey_cache'].clear()
+
+
 description = ("""
 API keys can be used to give permissions to other applications.
 
@@ -95,6 +121,10 @@ apikeydomain = {
 
         'authentication': AdminOnlyAuth,
 
+        'mongo_indexes': {
+            'token': ([('token', 1)], {'background': True, 'unique': True}),
+        },
+
         'schema': {
             'name': {
                 'description': 'A unique name to identify the key.',
@@ -144,3 +174,14 @@ def init_apikeys(app):
     register_domain(app, apikeydomain)
     app.after_auth += authorize_apikeys
     app.on_insert_apikeys += generate_tokens
+
+    # Key table and buffered timestamp updates, load the table on startup
+    app.config['apikey_cache'] = TTLCache(1, app.config['APIKEY_CACHE_TTL'])
+    app.config['apikey_timestamps'] = TimestampBuffer(
+        app, 'apikeys', app.config['TIMESTAMP_FLUSH_INTERVAL'])
+    with app.app_context():
+        get_apikey_table()
+
+    app.on_inserted_apikeys += invalidate_apikey_table
+    app.on_updated_apikeys += invalidate_apikey_table
+    app.on_deleted_item_apikeys += invalidate_apikey_table
@@ -76,6 +76,7 @@ from functools import wraps
 
 from eve.auth import BasicAuth, resource_auth
 from flask import abort, current_app, g, request
+from pymongo import ReturnDocument
 
 
 class AmivTokenAuth(BasicAuth):
@@ -214,24 +215,56 @@ def authenticate_token(token):
     if token:
         g.current_token = token
 
-        # Get session
-        sessions = current_app.data.driver.db['sessions']
-        session = sessions.find_one({'token': token})
+        session = _get_session(token)
 
         if session:
-            # Update timestamp (remove microseconds to match mongo precision)
-            new_time = dt.utcnow().replace(microsecond=0)
-            sessions.update_one({'_id': session['_id']},
-                                {'$set': {
-                                    '_updated': new_time
-                                }})
-            session['_updated'] = new_time
-
             # Save user_id and session with updated timestamp in g
             g.current_session = session
             g.current_user = str(session['user'])  # ObjectId to str
 
 
+def _get_session(token):
+    """Find the session for a token and update its timestamp.
+
+    Sessions are kept in the in-process session cache. If the session is not
+    cached, it is retrieved and its timestamp is updated in a single query.
+    Otherwise, the timestamp update is buffered and written in a batch later.
+
+    Tokens without session (e.g. API keys) are cached in a separate, small
+    cache, so invalid tokens can not evict sessions. This is safe because a
+    new session always comes with a new token.
+
+    Returns:
+        dict: Copy of the session with updated timestamp, None if not found.
+    """
+    cache = current_app.config['session_cache']
+    unknown = current_app.config['unknown_token_cache']
+
+    # Update timestamp (remove microseconds to match mongo precision)
+    new_time = dt.utcnow().replace(microsecond=0)
+
+    session = cache.get(token)
+    if session is not None:
+        current_app.config['session_timestamps'].touch(session['_id'],
+                                                       new_time)
+    elif unknown.get(token):
+        return None
+    else:
+        sessions = current_app.data.driver.db['sessions']
+        session = sessions.find_one_and_update(
+            {'token': token},
+            {'$set': {'_updated': new_time}},
+            return_document=ReturnDocument.AFTER)
+
+        if session is None:
+            unknown.set(token, True)
+            return None
+        cache.set(token, session)
+
+    # Return a copy, the cached session must not be modified
+    return dict(session, _updated=new_time)
+
+
 # Hooks begin here
 
 def authenticate(*args):
@@ -225,6 +225,11 @@ oauthclients_domain = {
 
         'authentication': AdminOnlyAuth,
 
+        'mongo_indexes': {
+            'client_id': ([('client_id', 1)],
+                          {'background': True, 'unique': True}),
+        },
+
         'schema': {
             'client_id': {
                 'description': "Name of the OAuth client service. This is the "
@@ -2,9 +2,11 @@
 #
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
-"""Sessions endpoint."""
+"""Sessions endpoint.
 
-import datetime
+Sessions expire `SESSION_TIMEOUT` after they have been used last, they are
+removed by a TTL index on `_updated` (see `auth.init_app`).
+"""
 
 from bson import ObjectId
 from bson.errors import InvalidId
@@ -14,7 +16,6 @@ from flask import abort, current_app as app
 
 from amivapi import ldap
 from amivapi.auth import AmivTokenAuth
-from amivapi.cron import periodic
 from amivapi.utils import admin_permissions, get_id
 
 # Change when we drop python3.5 support
@@ -106,6 +107,11 @@ sessiondomain = {
         # Allow GET requests with token, i.e. GET /sessions/<token>
         'additional_lookup': {'field': 'token', 'url': 'string'},
 
+        'mongo_indexes': {
+            'token': ([('token', 1)], {'background': True, 'unique': True}),
+            'user': ([('user', 1)], {'background': True}),
+        },
+
         'schema': {
             'username': {
                 'description': '`_id`, `nethz` or `email` of a user.',
@@ -178,7 +184,15 @@ def process_login(items):
         if (app.config.get('ldap_connector') and
                 ldap.authenticate_user(username, password)):
             # Success, sync user and get token
-            updated = ldap.sync_one(username)
+            try:
+                updated = ldap.sync_one(username)
+            except ldap.LdapUnavailable as error:
+                # Use the stored user data for now
+                app.logger.warning("Ldap sync failed: %s" % error)
+                updated = app.data.driver.db['users'].find_one(
+                    {'nethz': username})
+                if updated is None:
+                    abort(503, description="LDAP is not available.")
             _prepare_token(item, updated['_id'])
             app.logger.info(
                 "User '%s' was authenticated with LDAP" % username)
@@ -237,14 +251,14 @@ def verify_password(user, plaintext):
         bool: True if password matches. False if it doesn't or if there is no
             password set and/or provided.
     """
-    password_context = app.config['PASSWORD_CONTEXT']
+    hasher = app.config['password_hasher']
 
     if (plaintext is None) or (user['password'] is None):
         return False
 
-    is_valid = password_context.verify(plaintext, user['password'])
+    is_valid = hasher.verify(plaintext, user['password'])
 
-    if is_valid and password_context.needs_update(user['password']):
+    if is_valid and hasher.needs_update(user['password']):
         # update password - hook will handle hashing
         update = {'password': plaintext}
         with admin_permissions():
@@ -252,17 +266,16 @@ def verify_password(user, plaintext):
     return is_valid
 
 
-# Regular task to clean up expired sessions
-@periodic(datetime.timedelta(days=1))
-def delete_expired_sessions():
-    """Delete expired sessions.
+# Session cache invalidation
 
-    Needs an app context to access current_app,
-    make sure to create one if necessary.
+def invalidate_cached_session(item):
+    """Remove a deleted session from the session cache."""
+    app.config['session_cache'].pop(item['token'])
+    app.config['session_timestamps'].discard(item['_id'])
 
-    E.g.
-    >>> with app.app_context():
-    >>>     delete_expired_sessions()
-    """
-    deadline = datetime.datetime.utcnow() - app.config['SESSION_TIMEOUT']
-    app.data.driver.db['sessions'].delete_many({'_updated': {'$lt': deadline}})
+
+def invalidate_cached_sessions_of_user(item):
+    """Remove all cached sessions of a deleted user."""
+    user_id = get_id(item)
+    app.config['session_cache'].remove_if(
+        lambda _, session: session and session['user'] == user_id)
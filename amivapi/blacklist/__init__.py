@@ -8,6 +8,7 @@ Contains settings for eve resource, special validation.
 """
 
 from amivapi.blacklist.model import blacklist
+from amivapi.deferred import deferred
 from amivapi.utils import register_domain
 
 from amivapi.blacklist.emails import (
@@ -22,6 +23,6 @@ def init_app(app):
     register_domain(app, blacklist)
 
     # Send emails to users who have new/changed blacklist entries
-    app.on_inserted_blacklist += notify_new_blacklist
-    app.on_updated_blacklist += notify_patch_blacklist
-    app.on_deleted_item_blacklist += notify_delete_blacklist
+    app.on_inserted_blacklist += deferred(notify_new_blacklist)
+    app.on_updated_blacklist += deferred(notify_patch_blacklist)
+    app.on_deleted_item_blacklist += deferred(notify_delete_blacklist)
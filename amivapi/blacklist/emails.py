@@ -10,10 +10,10 @@ entries get resolved/deleted.
 
 from flask import current_app
 
-from amivapi.utils import mail
+from amivapi.utils import get_id, mail
 from datetime import datetime
 
-from amivapi.cron import schedulable, schedule_task
+from amivapi.cron import cancel_task, schedulable, schedule_task
 
 
 def _get_email(item):
@@ -24,16 +24,34 @@ def _get_email(item):
     return user['email']
 
 
+def _removed_mail_key(item):
+    """Key of the scheduled removal mail of a blacklist entry."""
+    return 'blacklist-removed-%s' % get_id(item)
+
+
+def _schedule_removed_mail(item):
+    """Schedule the removal mail, replacing a previously scheduled one."""
+    schedule_task(item['end_time'], send_removed_mail, str(get_id(item)),
+                  key=_removed_mail_key(item))
+
+
 @schedulable
 def send_removed_mail(item):
-    """Send scheduled email when a blacklist entry times out."""
-    _item = current_app.data.find_one('blacklist', None, {"_id": item['_id']})
-    # Check that the end date is still correct and has not changed again
+    """Send scheduled email when a blacklist entry times out.
+
+    Args:
+        item: The id of the entry. Tasks scheduled by earlier versions pass
+            the whole entry instead.
+    """
+    _item = current_app.data.find_one('blacklist', None, _id=get_id(item))
     if _item is None:
         return  # Entry was deleted, no mail to send anymore
     if _item.get('end_time') is None:
         return  # Entry was patched to last indefinitely, so no mail to send.
-    if _item['end_time'].replace(tzinfo=None) != item['end_time']:
+    end_time = _item['end_time'].replace(tzinfo=None)
+    if end_time > datetime.utcnow():
+        return  # Entry was extended, the new mail is scheduled already.
+    if isinstance(item, dict) and end_time != item['end_time']:
         return  # Entry was edited, so this is outdated.
 
     email = _get_email(_item)
@@ -62,7 +80,7 @@ def notify_new_blacklist(items):
 
         # If the end time is already known, schedule removal mail
         if item['end_time'] and item['end_time'] > datetime.utcnow():
-            schedule_task(item['end_time'], send_removed_mail, item)
+            _schedule_removed_mail(item)
 
 
 def notify_patch_blacklist(new, old):
@@ -71,19 +89,24 @@ def notify_patch_blacklist(new, old):
     # fixes an error, for example changed the reason or price. An entry is
     # resolved when the end_time is before now. The end_time might also
     # have been removed, in which case we don't schedule an email either.
-    if 'end_time' not in new or new['end_time'] is None:
+    if 'end_time' not in new:
+        return
+    if new['end_time'] is None:
+        cancel_task(_removed_mail_key(old))
         return
 
     # Either send mail immediately, or schedule for the future
     item = {**old, **new}
     if new['end_time'] <= datetime.utcnow():
-        send_removed_mail(item)
+        cancel_task(_removed_mail_key(item))
+        send_removed_mail(item['_id'])
     elif new['end_time'] != old['end_time']:
-        schedule_task(new['end_time'], send_removed_mail, item)
+        _schedule_removed_mail(item)
 
 
 def notify_delete_blacklist(item):
     """Send an email to a user if one of his entries was deleted."""
+    cancel_task(_removed_mail_key(item))
     email = _get_email(item)
     fields = {'reason': item['reason']}
 
@@ -37,6 +37,11 @@ blacklist = {
 
         'authentication': BlacklistAuth,
 
+        'mongo_indexes': {
+            'user_end_time': ([('user', 1), ('end_time', 1)],
+                              {'background': True}),
+        },
+
         'schema': {
             'user': {
                 "description": "The user who is blacklisted",
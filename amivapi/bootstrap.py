@@ -16,14 +16,18 @@ from sentry_sdk.integrations.flask import FlaskIntegration
 
 from amivapi import (
     auth,
+    cache,
     cascade,
     cron,
+    deferred,
     documentation,
     events,
     groups,
     blacklist,
+    hashing,
     joboffers,
     ldap,
+    outbox,
     studydocs,
     users,
     utils
@@ -96,6 +100,15 @@ def create_app(config_file=None, **kwargs):
     # Create LDAP connector
     ldap.init_app(app)
 
+    # Forget documents cached during a request when they are modified
+    cache.init_app(app)
+
+    # Worker pool for hooks executed after requests
+    deferred.init_app(app)
+
+    # Worker processes for password hashing
+    hashing.init_app(app)
+
     # Initialize modules to register resources, validation, hooks, auth, etc.
     users.init_app(app)
     auth.init_app(app)
@@ -106,6 +119,7 @@ def create_app(config_file=None, **kwargs):
     studydocs.init_app(app)
     cascade.init_app(app)
     cron.init_app(app)
+    outbox.init_app(app)
     documentation.init_app(app)
 
     # Fix that eve doesn't run hooks on embedded documents
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""In-process caches.
+
+The API runs as a long-lived process and a few lookups happen on (almost)
+every request, e.g. finding the session for a token. The helpers in this
+module allow to keep such data in memory for a short time.
+
+Every app gets its own cache objects (created in the respective `init_app`
+functions), so tests and multiple apps in one process do not interfere.
+
+Keep in mind that other processes (e.g. other API workers or cron) can
+modify the database as well. Everything cached here must therefore expire
+after a short time, and modifications through the API should invalidate
+the affected entries explicitly.
+
+Additionally, documents can be cached for the duration of a single request
+with `find_one_cached`. Validators, auth and hooks often need the same
+document (e.g. the event of a signup), which is only loaded once this way.
+"""
+
+import atexit
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock, Timer
+from weakref import WeakSet
+
+from flask import (
+    _request_ctx_stack,
+    current_app,
+    g,
+    has_request_context
+)
+from pymongo import UpdateOne
+
+
+class TTLCache(object):
+    """Bounded mapping with expiring entries.
+
+    If the cache is full, the least recently used entry is removed.
+
+    Args:
+        maxsize (int): Maximum number of entries.
+        ttl (timedelta): Time after which an entry expires.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if missing or expired."""
+        now = datetime.utcnow()
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires <= now:
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Add or replace an entry."""
+        expires = datetime.utcnow() + self.ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value (ignoring expiry)."""
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def remove_if(self, predicate):
+        """Remove all entries for which `predicate(key, value)` is true."""
+        with self._lock:
+            for key in [key for key, (_, value) in self._data.items()
+                        if predicate(key, value)]:
+                del self._data[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TimestampBuffer(object):
+    """Write-behind buffer for `_updated` timestamps of a collection.
+
+    Some documents (e.g. sessions) get their timestamp updated on every
+    request. Instead of writing every update immediately, updates are
+    collected and written in a single bulk write. Multiple updates of the same
+    document are coalesced, only the latest timestamp is kept.
+
+    The buffer is flushed on `touch` as soon as the oldest pending update is
+    older than `interval`, or if more than `maxsize` documents are pending.
+    Additionally, the first pending update starts a timer, which flushes the
+    buffer after `interval` even if no further requests arrive, and pending
+    updates are written when the process exits.
+
+    Args:
+        app (Eve): The app
+        collection (str): Name of the collection.
+        interval (timedelta): Maximum time updates are kept in the buffer.
+        maxsize (int): Maximum number of pending documents.
+    """
+
+    def __init__(self, app, collection, interval, maxsize=1000):
+        self.app = app
+        self.collection = collection
+        self.interval = interval
+        self.maxsize = maxsize
+        self._pending = {}
+        self._pending_since = None
+        self._timer = None
+        self._lock = Lock()
+        _timestamp_buffers.add(self)
+
+    def touch(self, _id, time):
+        """Set the timestamp of the document with `_id` to `time` (later)."""
+        now = datetime.utcnow()
+        with self._lock:
+            if not self._pending:
+                self._pending_since = now
+            self._pending[_id] = max(time, self._pending.get(_id, time))
+
+            if self._timer is None:
+                self._timer = Timer(self.interval.total_seconds(),
+                                    self.flush)
+                self._timer.daemon = True  # Flushed at exit anyway
+                self._timer.start()
+
+            due = ((len(self._pending) >= self.maxsize) or
+                   (now - self._pending_since >= self.interval))
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write all pending timestamps to the database."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, {}
+
+        if pending:
+            # `$max` ensures that the timestamp never moves backwards, even if
+            # several processes flush updates for the same document
+            requests = [UpdateOne({'_id': _id}, {'$max': {'_updated': time}})
+                        for _id, time in pending.items()]
+            with self.app.app_context():
+                self.app.data.driver.db[self.collection].bulk_write(
+                    requests, ordered=False)
+
+    def discard(self, _id):
+        """Forget pending updates for a document, e.g. if it was deleted."""
+        with self._lock:
+            self._pending.pop(_id, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+# All buffers, to write pending timestamps when the process exits
+_timestamp_buffers = WeakSet()
+
+
+@atexit.register
+def _flush_timestamp_buffers():
+    for buffer in list(_timestamp_buffers):
+        try:
+            buffer.flush()
+        except Exception:
+            buffer.app.logger.exception("Failed to write pending timestamps "
+                                        "of '%s'." % buffer.collection)
+
+
+def _request_cache():
+    """Get the document cache of the current request.
+
+    The cache is stored on `g`. As `g` may outlive a request (e.g. if an app
+    context is pushed manually), the cache remembers its request and is
+    replaced for every new request. Outside of requests, nothing is cached.
+    """
+    if not has_request_context():
+        return None
+
+    request_ctx = _request_ctx_stack.top
+    cache = g.get('document_cache')
+    if cache is None or cache[0] is not request_ctx:
+        cache = g.document_cache = (request_ctx, {})
+    return cache[1]
+
+
+def find_one_cached(resource, _id):
+    """Find a document by id, loading it only once per request.
+
+    All callers in a request get the same document, which should therefore
+    not be modified.
+
+    Args:
+        resource (str): The resource
+        _id (ObjectId): Id of the document, may also be str or None
+
+    Returns:
+        dict: The document or None, if it does not exist.
+    """
+    if _id is None:
+        return None
+
+    cache = _request_cache()
+    key = (resource, str(_id))
+    if cache is not None and key in cache:
+        return cache[key]
+
+    lookup = {current_app.config['ID_FIELD']: _id}
+    document = current_app.data.find_one(resource, None, **lookup)
+
+    if cache is not None:
+        cache[key] = document
+    return document
+
+
+def forget_cached_document(resource, _id):
+    """Remove a document from the request cache after it was modified."""
+    cache = _request_cache()
+    if cache is not None:
+        cache.pop((resource, str(_id)), None)
+
+
+# Hooks to keep the request cache up to date with changes through eve
+
+def forget_updated_document(resource, updates, original):
+    forget_cached_document(resource, original[current_app.config['ID_FIELD']])
+
+
+def forget_deleted_document(resource, item):
+    forget_cached_document(resource, item[current_app.config['ID_FIELD']])
+
+
+def init_app(app):
+    """Register hooks to invalidate the request cache."""
+    app.on_updated += forget_updated_document
+    app.on_replaced += forget_updated_document
+    app.on_deleted_item += forget_deleted_document
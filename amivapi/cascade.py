@@ -9,48 +9,152 @@ This adds an option 'cascade_delete' to data_relations in the schema. If it is
 set to true, then deleting the referenced object will also delete the
 referencing object. If false, the reference will be set to NULL, when the
 referenced object is deleted.
+
+The references to every resource are collected once in `init_app`. All
+referencing objects are deleted (or updated) with a single database operation
+per reference. The hooks are run for every object, like for
+`deleteitem_internal` and `patch_internal`: first the hooks before the change
+for all objects, then the hooks after the change for all objects.
+
+Resources which need more than a database operation (media files, soft
+delete, versioning) and references which are not nullable (the patch would
+fail validation) are handled with Eve's internal methods one by one instead.
 """
 
+from collections import namedtuple
+from datetime import datetime
+
+from eve.methods.common import resolve_document_etag
 from eve.methods.delete import deleteitem_internal
 from eve.methods.patch import patch_internal
 from flask import current_app
+from pymongo import UpdateOne
 from werkzeug.exceptions import NotFound
 
 from amivapi.utils import admin_permissions
 
+# A field of `resource` referencing another resource
+Reference = namedtuple('Reference', ['resource', 'field', 'cascade', 'bulk'])
+
+
+def build_reference_graph(domain):
+    """Find all references between resources.
+
+    Args:
+        domain (dict): The domain of the app
+
+    Returns:
+        dict: resource names as keys, lists of references to the resource as
+            values.
+    """
+    graph = {}
+    for resource, resource_def in domain.items():
+        # Resources which are more than a collection
+        special = (resource_def.get('_media') or
+                   resource_def.get('soft_delete') or
+                   resource_def.get('versioning'))
+
+        for field, field_def in resource_def['schema'].items():
+            relation = field_def.get('data_relation')
+            if relation is None:
+                continue
+            cascade = bool(relation.get('cascade_delete'))
+            bulk = not special and (cascade or field_def.get('nullable'))
+            graph.setdefault(relation['resource'], []).append(
+                Reference(resource, field, cascade, bool(bulk)))
+
+    return graph
+
 
 def cascade_delete(resource, item):
     """Cascade DELETE.
 
     Hook to delete all objects, which have the 'cascade_delete' option set
     in the data_relation and relate to the object, which was just deleted.
+    Other references to the object are set to NULL.
     """
     domain = current_app.config['DOMAIN']
     deleted_id = item[domain[resource]['id_field']]
 
-    for res, res_domain in domain.items():
-        # Filter schema of `res` to get all fields containing references
-        # to the resource of the deleted item
-        relations = ((field, field_def['data_relation'])
-                     for field, field_def in res_domain['schema'].items()
-                     if 'data_relation' in field_def and
-                     field_def['data_relation'].get('resource') == resource)
-        for field, data_relation in relations:
-            # All items in `res` with reference to the deleted item
-            lookup = {field: deleted_id}
-            with admin_permissions():
-                try:
-                    if data_relation.get('cascade_delete'):
-                        # Delete the item as well
-                        deleteitem_internal(res, concurrency_check=False,
-                                            **lookup)
-                    else:
-                        # Don't delete, only remove reference
-                        patch_internal(res, payload={field: None},
-                                       concurrency_check=False,
-                                       **lookup)
-                except NotFound:
-                    pass
+    for reference in current_app.config['cascade_graph'].get(resource, []):
+        collection = current_app.data.driver.db[
+            current_app.config['SOURCES'][reference.resource]['source']]
+        documents = list(collection.find({reference.field: deleted_id}))
+        if not documents:
+            continue
+
+        with admin_permissions():
+            if not reference.bulk:
+                _cascade_one_by_one(reference, documents)
+            elif reference.cascade:
+                _delete_all(reference, collection, documents)
+            else:
+                _remove_references(reference, collection, documents)
+
+
+def _delete_all(reference, collection, documents):
+    """Delete all referencing documents at once."""
+    app = current_app
+    resource = reference.resource
+    for document in documents:
+        app.on_delete_item(resource, document)
+        getattr(app, 'on_delete_item_%s' % resource)(document)
+
+    id_field = app.config['DOMAIN'][resource]['id_field']
+    collection.delete_many(
+        {id_field: {'$in': [document[id_field] for document in documents]}})
+
+    for document in documents:
+        app.on_deleted_item(resource, document)
+        getattr(app, 'on_deleted_item_%s' % resource)(document)
+
+
+def _remove_references(reference, collection, documents):
+    """Set the reference of all documents to NULL with one bulk write."""
+    app = current_app
+    resource = reference.resource
+    id_field = app.config['DOMAIN'][resource]['id_field']
+    now = datetime.utcnow().replace(microsecond=0)
+
+    changes = []
+    for document in documents:
+        updates = {reference.field: None, '_updated': now}
+        app.on_update(resource, updates, document)
+        getattr(app, 'on_update_%s' % resource)(updates, document)
+
+        updated = dict(document, **updates)
+        resolve_document_etag(updated, resource)
+        updates['_etag'] = updated['_etag']
+        changes.append((updates, document))
+
+    collection.bulk_write([
+        UpdateOne({id_field: document[id_field]}, {'$set': updates})
+        for updates, document in changes
+    ], ordered=False)
+
+    for updates, document in changes:
+        app.on_updated(resource, updates, document)
+        getattr(app, 'on_updated_%s' % resource)(updates, document)
+
+
+def _cascade_one_by_one(reference, documents):
+    """Use Eve's internal methods for every document."""
+    id_field = current_app.config['DOMAIN'][reference.resource]['id_field']
+    for document in documents:
+        lookup = {id_field: document[id_field]}
+        try:
+            if reference.cascade:
+                # Delete the item as well
+                deleteitem_internal(reference.resource,
+                                    concurrency_check=False, **lookup)
+            else:
+                # Don't delete, only remove reference
+                patch_internal(reference.resource,
+                               payload={reference.field: None},
+                               concurrency_check=False, **lookup)
+        except NotFound:
+            # Already removed, e.g. by another cascade
+            pass
 
 
 def cascade_delete_collection(resource, items):
@@ -60,6 +164,10 @@ def cascade_delete_collection(resource, items):
 
 
 def init_app(app):
-    """Add hooks to app."""
+    """Find references between resources and add hooks to app.
+
+    Needs to be called after all resources are registered.
+    """
+    app.config['cascade_graph'] = build_reference_graph(app.config['DOMAIN'])
     app.on_deleted_item += cascade_delete
     app.on_deleted += cascade_delete_collection
@@ -4,17 +4,17 @@
 #          you to buy us beer if we meet and you like the software.
 
 """A command line interface for AMIVApi."""
-from os import listdir, remove
-from os.path import join, isdir
 from datetime import datetime as dt
 from time import sleep
 
 from click import argument, echo, group, option, Path, Choice, ClickException
 
 from amivapi.bootstrap import create_app
-from amivapi.cron import run_scheduled_tasks
-from amivapi import ldap
-from amivapi.groups.mailing_lists import updated_group
+from amivapi.cron import run_scheduled_tasks, wait_for_tasks
+from amivapi.events.counters import recount_signups
+from amivapi.outbox import send_queued_mails
+from amivapi import indexes, ldap
+from amivapi.groups.mailing_lists import recreate_files
 
 try:
     import bjoern
@@ -34,34 +34,78 @@ config_option = option("--config",
 
 @cli.command()
 @config_option
-def recreate_mailing_lists(config):
+@option("--force", is_flag=True,
+        help="Upload all remote files, even if they did not change.")
+def recreate_mailing_lists(config, force):
     """(Re-)create mailing lists for all groups.
 
-    1. Delete all mailing list files.
+    Files are only written if their content changed, and files which do not
+    belong to any group anymore are removed.
+    """
+    app = create_app(config_file=config)
+
+    if not (app.config.get('MAILING_LIST_DIR') or
+            app.config.get('REMOTE_MAILING_LIST_ADDRESS')):
+        echo('No directory or remote for mailing lists specified in config.')
+        return
 
-    2. Create new mailing list files.
+    with app.app_context():
+        stats = recreate_files(force=force)
+
+    echo("Mailing lists: %(written)i files written, %(uploaded)i files "
+         "uploaded, %(removed)i files removed." % stats)
 
-    For every group, we call the update_group function for this
+
+@cli.command()
+@config_option
+@option("--dry-run", is_flag=True,
+        help="Only report differences, do not modify any index.")
+@option("--keep-obsolete", is_flag=True,
+        help="Do not drop indexes which are not declared anymore.")
+def ensure_indexes(config, dry_run, keep_obsolete):
+    """Create, update and drop database indexes.
+
+    Compares the indexes declared for all resources (and other collections)
+    with the database and reports missing, changed and obsolete indexes.
+    Missing and changed indexes are (re-)created and obsolete indexes are
+    dropped.
     """
     app = create_app(config_file=config)
-    directory = app.config.get('MAILING_LIST_DIR')
-    prefix = app.config['MAILING_LIST_FILE_PREFIX']
 
-    if not directory:
-        echo('No directory for mailing lists specified in config.')
-        return
+    with app.app_context():
+        if dry_run:
+            report = indexes.check_indexes(app)
+        else:
+            report = indexes.ensure_indexes(app,
+                                            drop_obsolete=not keep_obsolete)
 
-    # Delete existing files
-    if isdir(directory):
-        for filename in listdir(directory):
-            if filename.startswith(prefix):
-                remove(join(directory, filename))
+    for kind in ('missing', 'changed', 'obsolete'):
+        for collection, name in report[kind]:
+            echo("%s index '%s' on '%s'."
+                 % (kind.capitalize(), name, collection))
+
+    if not any(report.values()):
+        echo("All indexes are up to date.")
+    elif dry_run:
+        echo("Dry run, no indexes were modified.")
+    elif keep_obsolete and report['obsolete']:
+        echo("Obsolete indexes were kept.")
+
+
+@cli.command()
+@config_option
+def recount_event_signups(config):
+    """Recompute the signup counters of all events.
+
+    The counters are kept up to date automatically, this is only needed if
+    signups have been modified directly in the database.
+    """
+    app = create_app(config_file=config)
 
-    # Create new files
     with app.app_context():
-        groups = app.data.driver.db['groups'].find({})
-        for g in groups:
-            updated_group(g, g)  # Use group as update and original
+        count = recount_signups()
+
+    echo("Signup counters updated, %i events have signups." % count)
 
 
 def run_cron(app):
@@ -78,7 +122,7 @@ def run_cron(app):
 def cron(config, continuous):
     """Run scheduled tasks.
 
-    Use --continuous to keep running and execute tasks periodically.
+    Use --continuous to keep running and execute tasks when they are due.
     """
     app = create_app(config_file=config)
 
@@ -87,8 +131,8 @@ def cron(config, continuous):
     else:
         interval = app.config['CRON_INTERVAL']
 
-        echo('Running scheduled tasks periodically (every %i seconds).'
-             % interval.total_seconds())
+        echo('Running scheduled tasks continuously (checking at least every '
+             '%i seconds).' % interval.total_seconds())
 
         while True:
             checkpoint = dt.utcnow()
@@ -97,19 +141,45 @@ def cron(config, continuous):
             echo('Tasks executed, total execution time: %.3f seconds.'
                  % execution_time.total_seconds())
 
-            if execution_time > interval:
-                echo('Warning: Execution time exceeds interval length.')
+            # Wait until the next task is due
+            with app.app_context():
+                wait_for_tasks(interval)
 
-            sleep((interval - execution_time).total_seconds())
+
+@cli.command()
+@config_option
+@option("--continuous", is_flag=True,
+        help="If set, continue running and check for new mails regularly.")
+def send_mails(config, continuous):
+    """Send mails from the outbox.
+
+    Mails are also sent with the scheduled tasks, use --continuous to run a
+    dedicated worker which sends mails without delay.
+    """
+    app = create_app(config_file=config)
+
+    while True:
+        with app.app_context():
+            sent = send_queued_mails()
+        if sent:
+            echo("Sent %i mails." % sent)
+
+        if not continuous:
+            return
+        sleep(app.config['MAIL_WORKER_INTERVAL'].total_seconds())
 
 
 @cli.command()
 @config_option
 @option('--all', 'sync_all', is_flag=True, help="Sync all users.")
+@option('--restart', is_flag=True,
+        help="Do not resume an interrupted sync of all users.")
 @argument('nethz', nargs=-1)
-def ldap_sync(config, sync_all, nethz):
+def ldap_sync(config, sync_all, restart, nethz):
     """Synchronize users with eth ldap.
 
+    An interrupted sync of all users is resumed, unless --restart is set.
+
     Examples:
 
         amivapi ldap_sync --all
@@ -122,8 +192,9 @@ def ldap_sync(config, sync_all, nethz):
     else:
         with app.test_request_context():
             if sync_all:
-                res = ldap.sync_all()
-                echo("Synchronized %i users." % len(res))
+                res = ldap.sync_all(restart=restart)
+                echo("Synchronized users: %(created)i created, %(updated)i "
+                     "updated, %(unchanged)i unchanged." % res)
             else:
                 for user in nethz:
                     if ldap.sync_one(user) is not None:
@@ -20,7 +20,11 @@ Now you can schedule the task to be executed at a specific time:
 schedule_task(datetime(2012, 12, 21, 12, 0, 0), end_of_world,
               "Maya's calendar ran out of paper or something")
 
-This is of course possible multiple times.
+This is of course possible multiple times. To replace an earlier task instead,
+schedule both with the same key:
+
+schedule_task(datetime(2012, 12, 21, 12, 0, 0), end_of_world,
+              "Maya's calendar ran out of paper or something", key='end')
 
 
 2. Periodic tasks
@@ -34,6 +38,23 @@ def weekly_hello(name):
 The first execution will happen the first time the scheduler is run.
 
 
+3. Execution
+
+Due tasks are executed by `run_scheduled_tasks` (`amivapi cron`) with a pool
+of `CRON_WORKERS` threads. Several cron processes can run at the same time:
+A task is claimed with a lease (`locked_until` and `worker_id`) before it is
+executed, and removed once it has finished. If a worker crashes, the lease
+expires after `CRON_LEASE` and the task is executed again by another worker.
+Failed tasks are retried after `CRON_RETRY_DELAY` (doubled for every attempt)
+until `CRON_MAX_ATTEMPTS` is reached. Periodic tasks are not retried, as the
+next execution is already scheduled.
+
+Between runs, `amivapi cron --continuous` waits with `wait_for_tasks` until
+the next task is due. Scheduling a task inserts a signal into a small capped
+collection, which wakes up waiting workers (with a tailable cursor) to check
+when the new task is due. Workers wait at most `CRON_INTERVAL`.
+
+
 Notes:
 For all kind of scheduled tasks an app context is available, but no request
 context. If you need a request context, you can use the flask test client.
@@ -46,11 +67,20 @@ run every day at the same time, but will drift into the future slowly. This
 might sum up to a missing period, so after a year the function might have been
 called only 364 times.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
+from os import getpid
 import pickle
+from socket import gethostname
+from threading import get_ident
+from time import sleep
 
 from flask import current_app
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
+
+from amivapi.indexes import register_indexes
 
 
 #
@@ -80,9 +110,11 @@ def periodic(period, *args):
     def wrap(func):
         @wraps(func)
         def wrapped():
-            schedule_task(datetime.utcnow() + period, wrapped)
+            schedule_task(datetime.utcnow() + period, wrapped,
+                          key=func_str(wrapped))
             func(*args)
 
+        wrapped.periodic = True
         schedulable(wrapped)
 
         # if init_app has already run, schedule the first execution
@@ -96,19 +128,36 @@ def periodic(period, *args):
     return wrap
 
 
-def schedule_task(time, func, *args):
-    """ Schedule a task at some point in the future. """
+def schedule_task(time, func, *args, key=None):
+    """ Schedule a task at some point in the future.
+
+    If a `key` is given, a task scheduled earlier with the same key is
+    replaced, e.g. to reschedule a reminder if a date changes. Arguments are
+    stored with the task, so pass ids instead of whole documents.
+    """
     func_s = func_str(func)
 
     if func_s not in schedulable_functions:
         raise NotSchedulable("%s is not schedulable. Did you forget the "
                              "@schedulable decorator?" % func.__name__)
 
-    current_app.data.driver.db['scheduled_tasks'].insert_one({
+    task = {
         'time': time,
         'function': func_s,
         'args': pickle.dumps(args)
-    })
+    }
+    if key is None:
+        current_app.data.driver.db['scheduled_tasks'].insert_one(task)
+    else:
+        # Reset the lease, the replaced task may be running right now
+        task.update(locked_until=None, worker_id=None, attempts=0)
+        _upsert_task(key, {'$set': task})
+    _signal(time)
+
+
+def cancel_task(key):
+    """ Remove the task scheduled with `key` (if any). """
+    current_app.data.driver.db['scheduled_tasks'].delete_one({'key': key})
 
 
 def update_scheduled_task(time, func, *args):
@@ -126,16 +175,62 @@ def update_scheduled_task(time, func, *args):
                  'time': time,
                  'args': pickle.dumps(args)
         }})
+    _signal(time)
+
+
+def wait_for_tasks(timeout):
+    """ Wait until the next task is due, but at most `timeout` (timedelta).
+
+    Returns early if a task is scheduled in the meantime, the caller checks
+    again which tasks are due. This needs an app context.
+    """
+    now = datetime.utcnow()
+    deadline = min([now + timeout] + _next_due(now))
+    remaining = (deadline - now).total_seconds()
+    if remaining <= 0:
+        return
+
+    # Tail the signals in insertion order (ids are generated by the clients
+    # and not ordered across processes). The database waits for new signals
+    # until the deadline. The first batch contains all existing signals (the
+    # collection is capped), they are skipped.
+    signals = current_app.data.driver.db['scheduled_task_signals'].find(
+        cursor_type=CursorType.TAILABLE_AWAIT
+    ).batch_size(SIGNALS_MAX).max_await_time_ms(int(remaining * 1000))
+    try:
+        if next(signals, None) is not None:
+            for _ in range(signals.retrieved - 1):
+                next(signals)
+
+        # Tasks scheduled before the cursor was opened
+        if min([deadline] + _next_due(datetime.utcnow())) < deadline:
+            return
+
+        while signals.alive and datetime.utcnow() < deadline:
+            if next(signals, None) is not None:
+                # A new task, which may be due before the deadline
+                return
+    finally:
+        signals.close()
+
+    # The cursor is closed if the collection is empty
+    remaining = (deadline - datetime.utcnow()).total_seconds()
+    if remaining > 0:
+        sleep(remaining)
 
 
 def schedule_once_soon(func, *args):
     """ Schedules a function to be run as soon as the scheduler is run the next
     time. Also check, that it is not already scheduled to be run first.
+
+    The task is keyed by the function, see `schedule_task`.
     """
-    if current_app.data.driver.db['scheduled_tasks'].count_documents(
-            {'function': func_str(func)}) != 0:
-        return
-    schedule_task(datetime.utcnow(), func, *args)
+    func_s = func_str(func)
+    now = datetime.utcnow()
+    if _upsert_task(func_s, {'$setOnInsert': {'time': now,
+                                              'function': func_s,
+                                              'args': pickle.dumps(args)}}):
+        _signal(now)
 
 
 #
@@ -145,6 +240,17 @@ def schedule_once_soon(func, *args):
 schedulable_functions = {}
 periodic_functions = []
 
+# Functions which have been scheduled by earlier versions, but do not exist
+# anymore. Their tasks are removed on app init.
+removed_functions = [
+    # Sessions expire with a TTL index now
+    'amivapi.auth.sessions.delete_expired_sessions',
+]
+
+# Size of the capped collection to signal new tasks (bytes and documents)
+SIGNALS_SIZE = 2 ** 20
+SIGNALS_MAX = 1000
+
 
 def func_str(func):
     """ Return a string describing the function """
@@ -155,20 +261,163 @@ def run_scheduled_tasks():
     """ Check for scheduled task, which have passed the deadline and run them.
     This needs an app context.
     """
-    while True:
-        task = (current_app.data.driver.db['scheduled_tasks']
-                .find_one_and_delete(
-                    {'time': {'$lte': datetime.utcnow()}}))
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(app.config['CRON_WORKERS']) as executor:
+        workers = [executor.submit(_run_tasks, app)
+                   for _ in range(app.config['CRON_WORKERS'])]
+    for worker in workers:
+        worker.result()  # Raise errors, e.g. if the database is unavailable
 
-        if task is None:
-            return
 
-        args = pickle.loads(task['args'])
-        func = schedulable_functions[task['function']]
-        func(*args)
+def _upsert_task(key, update):
+    """ Update or insert the task with `key`.
+
+    Returns:
+        bool: True if a new task was inserted.
+    """
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    try:
+        result = tasks.update_one({'key': key}, update, upsert=True)
+    except DuplicateKeyError:
+        # Inserted concurrently, update it instead
+        tasks.update_one({'key': key}, update)
+        return False
+    return result.upserted_id is not None
+
+
+def _signal(time):
+    """ Wake up workers waiting for tasks due later than `time`. """
+    current_app.data.driver.db['scheduled_task_signals'].insert_one(
+        {'time': time})
+
+
+def _next_due(now):
+    """ Return the time when the next task can be claimed (as list). """
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    times = []
+
+    task = tasks.find_one({'locked_until': {'$not': {'$gt': now}}},
+                          {'time': 1}, sort=[('time', 1)])
+    if task is not None:
+        times.append(task['time'])
+
+    task = tasks.find_one({'locked_until': {'$gt': now}},
+                          {'locked_until': 1}, sort=[('locked_until', 1)])
+    if task is not None:
+        times.append(task['locked_until'])
+
+    # The database returns timezone-aware datetimes
+    return [time.replace(tzinfo=None) for time in times]
+
+
+def _worker_id():
+    """ Identify the current thread of this process on this host. """
+    return "%s:%i:%i" % (gethostname(), getpid(), get_ident())
+
+
+def _run_tasks(app):
+    """ Claim and run due tasks until there are none left (in a worker). """
+    with app.app_context():
+        while True:
+            task = _claim_task()
+            if task is None:
+                return
+            _run_task(task)
+
+
+def _claim_task():
+    """ Lease the next due task which is not leased by another worker. """
+    now = datetime.utcnow()
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    while True:
+        task = tasks.find_one_and_update(
+            {'time': {'$lte': now}, 'locked_until': {'$not': {'$gt': now}}},
+            {'$set': {'locked_until': now + current_app.config['CRON_LEASE'],
+                      'worker_id': _worker_id()},
+             '$inc': {'attempts': 1}},
+            sort=[('time', 1)],
+            return_document=ReturnDocument.AFTER)
+
+        if (task is None or
+                task['attempts'] <= current_app.config['CRON_MAX_ATTEMPTS']):
+            return task
+
+        # The lease has expired too often, the task crashes its workers
+        current_app.logger.error("Scheduled task '%s' did not finish in %i "
+                                 "attempts, giving up."
+                                 % (task['function'], task['attempts'] - 1))
+        _release(task, remove=True)
+
+
+def _run_task(task):
+    """ Run a claimed task, remove it on success and retry it on failure. """
+    func = schedulable_functions.get(task['function'])
+    if func is None:
+        # E.g. the function has been removed since the task was scheduled
+        current_app.logger.error("Scheduled task '%s' is not schedulable, "
+                                 "removing it." % task['function'])
+        _release(task, remove=True)
+        return
+
+    try:
+        func(*pickle.loads(task['args']))
+    except Exception:
+        current_app.logger.exception("Scheduled task '%s' failed (attempt "
+                                     "%i)." % (task['function'],
+                                               task['attempts']))
+        retry = (not getattr(func, 'periodic', False) and
+                 task['attempts'] < current_app.config['CRON_MAX_ATTEMPTS'])
+        if retry:
+            delay = (current_app.config['CRON_RETRY_DELAY'] *
+                     2 ** (task['attempts'] - 1))
+            _release(task, time=datetime.utcnow() + delay)
+        else:
+            _release(task, remove=True)
+    else:
+        _release(task, remove=True)
+
+
+def _release(task, remove=False, time=None):
+    """ Remove a task or schedule it again, unless the lease was lost. """
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    lease = {'_id': task['_id'],
+             'worker_id': task['worker_id'],
+             'locked_until': task['locked_until']}
+    if remove:
+        tasks.delete_one(lease)
+    else:
+        tasks.update_one(lease, {'$set': {'time': time,
+                                          'locked_until': None,
+                                          'worker_id': None}})
 
 
 def init_app(app):
+    register_indexes(app, 'scheduled_tasks', {
+        'time': ([('time', 1)], {'background': True}),
+        'function': ([('function', 1)], {'background': True}),
+        'locked_until': ([('locked_until', 1)], {'background': True}),
+        'key': ([('key', 1)], {
+            'background': True,
+            'unique': True,
+            'partialFilterExpression': {'key': {'$exists': True}},
+        }),
+    })
+
+    with app.app_context():
+        db = app.data.driver.db
+        db['scheduled_tasks'].delete_many(
+            {'function': {'$in': removed_functions}})
+
+        # Capped collection to signal new tasks to waiting workers
+        try:
+            db.create_collection('scheduled_task_signals', capped=True,
+                                 size=SIGNALS_SIZE, max=SIGNALS_MAX)
+        except CollectionInvalid:
+            pass  # Exists already
+        # Tailable cursors on an empty collection are closed immediately
+        if db['scheduled_task_signals'].find_one() is None:
+            db['scheduled_task_signals'].insert_one({'time': None})
+
     # Periodic functions: If no execution is scheduled so far, schedule one
     with app.app_context():  # this is needed to run db queries
         for func in periodic_functions:
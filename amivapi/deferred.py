@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Deferred execution of hooks.
+
+Some hooks only have side effects the client does not need to wait for, e.g.
+sending mails or updating mailing list files. Such hooks can be registered as
+deferred:
+
+    app.on_inserted_groups += deferred(new_groups)
+
+During a request, deferred hooks are collected and handed to a small pool of
+worker threads when the request is finished. The workers run the hooks with a
+request context for the same url (e.g. to build links with `url_for`), but
+with a new `g`, so the hooks must not rely on authentication data.
+The arguments are copied, so later modifications (e.g. by other hooks or by
+Eve when building the response) are not visible to deferred hooks.
+
+If all workers are busy and `DEFERRED_HOOK_QUEUE_SIZE` hooks are waiting, new
+hooks are executed immediately instead. Outside of requests (e.g. in the CLI
+or in scheduled tasks) and for tests, hooks are always executed immediately.
+
+Failed hooks are logged. The number of deferred, completed, failed and
+immediately executed hooks is counted in `app.config['deferred_hooks'].stats`.
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+
+from flask import current_app, g, request
+
+
+class DeferredHooks(object):
+    """Worker pool for deferred hooks of an app.
+
+    Args:
+        app (Eve): The app
+        workers (int): Number of worker threads
+        queue_size (int): Maximum number of hooks waiting for a worker
+    """
+
+    def __init__(self, app, workers, queue_size):
+        self.app = app
+        self.stats = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = BoundedSemaphore(workers + queue_size)
+        self._lock = Lock()
+
+    def submit(self, func, args, base_url):
+        """Run `func(*args)` in a worker, or now if the queue is full."""
+        if self._slots.acquire(blocking=False):
+            self._count('deferred')
+            self._executor.submit(self._run_and_release, func, args, base_url)
+        else:
+            self._count('inline')
+            self._run(func, args, base_url)
+
+    def _run_and_release(self, func, args, base_url):
+        try:
+            self._run(func, args, base_url)
+        finally:
+            self._slots.release()
+
+    def _run(self, func, args, base_url):
+        try:
+            with self.app.test_request_context(base_url=base_url):
+                func(*args)
+        except Exception:
+            self.app.logger.exception("Deferred hook '%s' failed."
+                                      % func.__name__)
+            self._count('failed')
+        else:
+            self._count('completed')
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+def deferred(func):
+    """Wrap a hook to be executed after the request (if possible)."""
+    @wraps(func)
+    def wrapped(*args):
+        pending = g.get('deferred_hooks')
+        if pending is None:
+            # Not in a request or deferred hooks are disabled
+            return func(*args)
+        pending.append((func, deepcopy(args)))
+
+    return wrapped
+
+
+def _collect_deferred_hooks():
+    """Start collecting deferred hooks for a new request."""
+    g.deferred_hooks = []
+
+
+def _submit_deferred_hooks(exception=None):
+    """Hand all collected hooks to the workers after the request."""
+    pending = g.pop('deferred_hooks', None)
+    if pending:
+        hooks = current_app.config['deferred_hooks']
+        for func, args in pending:
+            hooks.submit(func, args, request.url_root)
+
+
+def init_app(app):
+    """Create worker pool and add request handlers."""
+    workers = app.config['DEFERRED_HOOK_WORKERS']
+    if app.config.get('TESTING') or not workers:
+        app.config['deferred_hooks'] = None
+        return
+
+    app.config['deferred_hooks'] = DeferredHooks(
+        app, workers, app.config['DEFERRED_HOOK_QUEUE_SIZE'])
+    app.before_request(_collect_deferred_hooks)
+    app.teardown_request(_submit_deferred_hooks)
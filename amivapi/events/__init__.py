@@ -9,7 +9,15 @@ logic needed for signup of non members to events.
 """
 
 
+from amivapi.cache import TTLCache
+from amivapi.deferred import deferred
 from amivapi.events.authorization import EventAuthValidator
+from amivapi.events.counters import (
+    count_deleted_signup,
+    count_new_signups,
+    count_updated_signup,
+    init_signup_counters
+)
 from amivapi.events.emails import send_confirmmail_to_unregistered_users
 from amivapi.events.email_links import (
     add_confirmed_before_insert,
@@ -43,6 +51,11 @@ def init_app(app):
     register_validator(app, EventValidator)
     register_validator(app, EventAuthValidator)
 
+    # Compiled JSON schemas for signup validation
+    app.config['event_schema_cache'] = TTLCache(
+        app.config['EVENT_SCHEMA_CACHE_SIZE'],
+        app.config['EVENT_SCHEMA_CACHE_TTL'])
+
     # Show user's email in registered signups
     app.on_fetched_resource_eventsignups += add_email_to_signup_collection
     app.on_fetched_item_eventsignups += add_email_to_signup
@@ -52,14 +65,22 @@ def init_app(app):
     app.on_fetched_item_eventsignups += add_position_to_signup
     app.on_inserted_eventsignups += add_position_to_signup_on_inserted
 
-    # Show signup count in events
+    # Keep signup counters in events up to date. The counters need to be
+    # updated before the waiting list is, so these hooks are added first
+    app.on_insert_events += init_signup_counters
+    app.on_inserted_eventsignups += count_new_signups
+    app.on_updated_eventsignups += count_updated_signup
+    app.on_deleted_item_eventsignups += count_deleted_signup
+
+    # Show signup count in events (for events without stored counters)
     app.on_fetched_resource_events += add_signup_count_to_event_collection
     app.on_fetched_item_events += add_signup_count_to_event
 
     # Add confirmed field to incoming signups
     app.on_insert_eventsignups += add_confirmed_before_insert
     # Sending confirmation mails
-    app.on_inserted_eventsignups += send_confirmmail_to_unregistered_users
+    app.on_inserted_eventsignups += deferred(
+        send_confirmmail_to_unregistered_users)
 
     # Auto accept registrations for fcfs system
     app.on_insert_eventsignups += add_accepted_before_insert
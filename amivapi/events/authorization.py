@@ -9,6 +9,7 @@ from bson import ObjectId
 from flask import g, current_app
 from datetime import datetime as dt
 from amivapi.auth import AmivTokenAuth
+from amivapi.cache import find_one_cached
 from amivapi.utils import get_id
 
 
@@ -45,8 +46,7 @@ class EventSignupAuth(AmivTokenAuth):
             event = item['event']
         else:
             # Event is not embedded, get the event first
-            lookup = {current_app.config['ID_FIELD']: item['event']}
-            event = current_app.data.find_one('events', None, **lookup)
+            event = find_one_cached('events', item['event'])
 
         # Remove tzinfo to compare to utcnow (API only accepts UTC anyways)
         time_register_start = event['time_register_start'].replace(tzinfo=None)
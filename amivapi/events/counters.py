@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Signup counters stored in events.
+
+Every event stores the number of accepted (`signup_count`) and unaccepted
+(`unaccepted_count`) signups, so they do not need to be counted whenever
+events are fetched.
+
+The counters are updated atomically with `$inc` whenever signups are
+created, deleted or accepted. If they get out of sync nevertheless (e.g.
+after modifying the database by hand), `amivapi recount_event_signups`
+recomputes them.
+"""
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from amivapi.cache import forget_cached_document
+
+
+def update_signup_counters(event_id, accepted=0, unaccepted=0):
+    """Atomically change the signup counters of an event.
+
+    Events without counters (created before they were introduced) are
+    counted instead, `$inc` would start counting from zero.
+
+    Args:
+        event_id (ObjectId): The event
+        accepted (int): Change of the number of accepted signups
+        unaccepted (int): Change of the number of unaccepted signups
+    """
+    result = current_app.data.driver.db['events'].update_one(
+        {'_id': event_id, 'signup_count': {'$exists': True}},
+        {'$inc': {'signup_count': accepted, 'unaccepted_count': unaccepted}})
+    forget_cached_document('events', event_id)
+
+    if not result.matched_count:
+        # The signups are already modified, so counting includes the change
+        ensure_signup_counters({'_id': event_id})
+
+
+def reserve_seats(event, count):
+    """Atomically reserve seats for signups from the waiting list.
+
+    The accepted counter of the event is increased only if enough spots are
+    left, so concurrent requests can never reserve more seats than there
+    are. If fewer seats than requested are available, as many as possible
+    are reserved.
+
+    Args:
+        event (dict): The event, must contain counters
+            (see `ensure_signup_counters`)
+        count (int): Number of requested seats
+
+    Returns:
+        int: Number of reserved seats
+    """
+    events = current_app.data.driver.db['events']
+    spots = event['spots']
+
+    if spots == 0:
+        # Unlimited spots
+        update_signup_counters(event['_id'], accepted=count,
+                               unaccepted=-count)
+        return count
+
+    while count > 0:
+        result = events.update_one(
+            {'_id': event['_id'],
+             'signup_count': {'$exists': True, '$lte': spots - count}},
+            {'$inc': {'signup_count': count, 'unaccepted_count': -count}})
+        forget_cached_document('events', event['_id'])
+        if result.modified_count:
+            return count
+
+        # Someone else was faster, try again with the remaining seats
+        current = events.find_one({'_id': event['_id']}, {'signup_count': 1})
+        if current is None or 'signup_count' not in current:
+            return 0
+        count = min(count, spots - current['signup_count'])
+
+    return 0
+
+
+def release_seats(event_id, count):
+    """Give back reserved seats which could not be used."""
+    update_signup_counters(event_id, accepted=-count, unaccepted=count)
+
+
+def ensure_signup_counters(event):
+    """Make sure an event document contains the signup counters.
+
+    Events created before the counters were introduced do not have them. In
+    this case, they are counted and stored once.
+
+    Args:
+        event (dict): The event, will be modified if counters are missing.
+    """
+    if 'signup_count' in event and 'unaccepted_count' in event:
+        return
+
+    signups = current_app.data.driver.db['eventsignups']
+    event['signup_count'] = signups.count_documents(
+        {'event': event['_id'], 'accepted': True})
+    event['unaccepted_count'] = signups.count_documents(
+        {'event': event['_id'], 'accepted': False})
+
+    current_app.data.driver.db['events'].update_one(
+        {'_id': event['_id'],
+         'signup_count': {'$exists': False}},
+        {'$set': {'signup_count': event['signup_count'],
+                  'unaccepted_count': event['unaccepted_count']}})
+
+
+def recount_signups():
+    """Recompute the signup counters of all events in one aggregation.
+
+    Needs an app context.
+
+    Returns:
+        int: Number of events with signups.
+    """
+    counts = current_app.data.driver.db['eventsignups'].aggregate([
+        {'$group': {
+            '_id': '$event',
+            'accepted': {'$sum': {'$cond': ['$accepted', 1, 0]}},
+            'unaccepted': {'$sum': {'$cond': ['$accepted', 0, 1]}},
+        }}
+    ])
+
+    updates = []
+    event_ids = []
+    for count in counts:
+        event_ids.append(count['_id'])
+        updates.append(UpdateOne({'_id': count['_id']}, {'$set': {
+            'signup_count': count['accepted'],
+            'unaccepted_count': count['unaccepted'],
+        }}))
+
+    events = current_app.data.driver.db['events']
+    if updates:
+        events.bulk_write(updates, ordered=False)
+
+    # All other events have no signups at all
+    events.update_many({'_id': {'$nin': event_ids}},
+                       {'$set': {'signup_count': 0, 'unaccepted_count': 0}})
+
+    return len(event_ids)
+
+
+# Hooks
+
+def init_signup_counters(events):
+    """Start counting signups with zero for new events."""
+    for event in events:
+        event['signup_count'] = 0
+        event['unaccepted_count'] = 0
+
+
+def count_new_signups(signups):
+    """Count new signups as accepted or unaccepted.
+
+    Signups accepted later by the waiting list are counted there.
+    """
+    for signup in signups:
+        if signup['accepted']:
+            update_signup_counters(signup['event'], accepted=1)
+        else:
+            update_signup_counters(signup['event'], unaccepted=1)
+
+
+def count_updated_signup(updates, original):
+    """Update counters if admins change whether a signup is accepted."""
+    if ('accepted' in updates and
+            bool(updates['accepted']) != bool(original['accepted'])):
+        change = 1 if updates['accepted'] else -1
+        update_signup_counters(original['event'],
+                               accepted=change, unaccepted=-change)
+
+
+def count_deleted_signup(signup):
+    """Remove deleted signup from counters."""
+    if signup['accepted']:
+        update_signup_counters(signup['event'], accepted=-1)
+    else:
+        update_signup_counters(signup['event'], unaccepted=-1)
@@ -9,6 +9,7 @@ Needed when users are notified about their event signups.
 from flask import current_app, url_for
 from itsdangerous import URLSafeSerializer
 
+from amivapi.cache import find_one_cached
 from amivapi.events.utils import get_token_secret
 from amivapi.utils import mail
 
@@ -18,8 +19,7 @@ def notify_signup_accepted(event, signup):
     id_field = current_app.config['ID_FIELD']
 
     if signup.get('user'):
-        lookup = {id_field: signup['user']}
-        user = current_app.data.find_one('users', None, **lookup)
+        user = find_one_cached('users', signup['user'])
         name = user['firstname']
         email = user['email']
     else:
@@ -53,9 +53,7 @@ def send_confirmmail_to_unregistered_users(items):
     """
     for item in items:
         if 'user' not in item:
-            event = current_app.data.find_one(
-                'events', None,
-                **{current_app.config['ID_FIELD']: item['event']})
+            event = find_one_cached('events', item['event'])
 
             title = event.get('title_en') or event.get('title_de')
 
@@ -151,6 +151,14 @@ eventdomain = {
         'public_methods': ['GET', 'HEAD'],
         'public_item_methods': ['GET', 'HEAD'],
 
+        'mongo_indexes': {
+            'moderator': ([('moderator', 1)], {'background': True}),
+            'time_start': ([('time_start', 1)], {'background': True}),
+            'time_advertising': ([('time_advertising_start', 1),
+                                  ('time_advertising_end', 1)],
+                                 {'background': True}),
+        },
+
         'schema': {
             'title_de': {
                 'title': 'German Title',
@@ -502,6 +510,18 @@ eventdomain = {
 
         'public_methods': ['POST'],
 
+        'mongo_indexes': {
+            # Signup counts, waiting list and positions
+            'event_accepted_created': ([('event', 1),
+                                        ('accepted', 1),
+                                        ('_created', 1)],
+                                       {'background': True}),
+            'event_created': ([('event', 1), ('_created', 1)],
+                              {'background': True}),
+            'user_event': ([('user', 1), ('event', 1)], {'background': True}),
+            'email_event': ([('email', 1), ('event', 1)], {'background': True}),
+        },
+
         'schema': {
             'event': {
                 'description': "The event to sign up to (must require "
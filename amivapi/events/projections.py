@@ -4,7 +4,13 @@
 #          you to buy us beer if we meet and you like the software.
 """Hooks to generate fields in events and eventsignups"""
 
-from flask import current_app
+from bisect import bisect_right
+from collections import defaultdict
+import json
+
+from flask import current_app, request
+
+from amivapi.events.counters import ensure_signup_counters
 
 
 def add_email_to_signup(item):
@@ -20,6 +26,23 @@ def add_email_to_signup(item):
 
 
 def add_email_to_signup_collection(response):
+    """Add emails to all signups, loading all users with a single query."""
+    id_field = current_app.config['ID_FIELD']
+    missing = [item for item in response['_items']
+               if 'email' not in item and not isinstance(item['user'], dict)]
+
+    user_ids = list({item['user'] for item in missing})
+    emails = {}
+    if user_ids:
+        users = current_app.data.driver.db['users'].find(
+            {id_field: {'$in': user_ids}}, {'email': 1})
+        emails = {user[id_field]: user['email'] for user in users}
+
+    for item in missing:
+        if item['user'] in emails:
+            item['email'] = emails[item['user']]
+
+    # Embedded users (and users not found above) are handled one by one
     for item in response['_items']:
         add_email_to_signup(item)
 
@@ -32,27 +55,82 @@ def add_position_to_signup(item):
     item['position'] = position
 
 
+def add_position_to_signups(items):
+    """Add positions to many signups with one aggregation per event.
+
+    For every event, the number of signups per creation time is aggregated
+    (up to the latest signup in `items`). The position of a signup is the
+    number of signups created at the same time or earlier.
+    """
+    by_event = defaultdict(list)
+    for item in items:
+        event = item['event']
+        event_id = event['_id'] if isinstance(event, dict) else event
+        by_event[event_id].append(item)
+
+    for event_id, signups in by_event.items():
+        latest = max(signup['_created'] for signup in signups)
+        counts = current_app.data.driver.db['eventsignups'].aggregate([
+            {'$match': {'event': event_id, '_created': {'$lte': latest}}},
+            {'$group': {'_id': '$_created', 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}},
+        ])
+
+        times = []
+        positions = []
+        position = 0
+        for count in counts:
+            position += count['count']
+            # Inserted items have naive timestamps, the database returns
+            # timezone aware timestamps (both UTC)
+            times.append(count['_id'].replace(tzinfo=None))
+            positions.append(position)
+
+        for signup in signups:
+            index = bisect_right(times,
+                                 signup['_created'].replace(tzinfo=None))
+            signup['position'] = positions[index - 1] if index else 0
+
+
 def add_position_to_signup_collection(response):
-    for item in response['_items']:
-        add_position_to_signup(item)
+    add_position_to_signups(response['_items'])
 
 
 def add_position_to_signup_on_inserted(items):
-    for item in items:
-        add_position_to_signup(item)
+    add_position_to_signups(items)
+
+
+def _requested_counters():
+    """Return the signup counters which the client projection includes."""
+    try:
+        projection = json.loads(request.args.get('projection') or '{}')
+    except ValueError:
+        projection = {}
+
+    # Like Eve: a projection is either inclusive or exclusive
+    inclusive = any(projection.values())
+    return [field for field in ('signup_count', 'unaccepted_count')
+            if projection.get(field, not inclusive)]
+
+
+def add_signup_count_to_event(item, requested=None):
+    """The signup counters are stored in the event, but may be missing for
+    old events. In this case they are counted once.
 
+    Counters excluded by the client projection are missing as well, they
+    are neither counted nor added.
+    """
+    if requested is None:
+        requested = _requested_counters()
+    if all(field in item for field in requested):
+        return
 
-def add_signup_count_to_event(item):
-    """After an event is fetched from the database we add the current signup
-    count"""
-    item['signup_count'] = (
-        current_app.data.driver.db['eventsignups'].count_documents(
-            {'event': item['_id'], 'accepted': True}))
-    item['unaccepted_count'] = (
-        current_app.data.driver.db['eventsignups'].count_documents(
-            {'event': item['_id'], 'accepted': False}))
+    counters = dict(item)
+    ensure_signup_counters(counters)
+    item.update({field: counters[field] for field in requested})
 
 
 def add_signup_count_to_event_collection(items):
+    requested = _requested_counters()
     for item in items['_items']:
-        add_signup_count_to_event(item)
+        add_signup_count_to_event(item, requested)
@@ -4,9 +4,18 @@
 #          you to buy us beer if we meet and you like the software.
 """Logic to implement different signup queues."""
 
+from datetime import datetime
+from uuid import uuid4
+
 from flask import current_app, g
 from pymongo import ASCENDING
 
+from amivapi.cache import find_one_cached, forget_cached_document
+from amivapi.events.counters import (
+    ensure_signup_counters,
+    release_seats,
+    reserve_seats
+)
 from amivapi.events.emails import notify_signup_accepted
 
 
@@ -19,42 +28,87 @@ def update_waiting_list(event_id):
     2. After a signup was deleted.
     3. After an external signup was confirmed.
 
+    Seats are reserved atomically on the event (see `reserve_seats`) before
+    signups are accepted with a single write, so concurrent requests can not
+    accept more signups than there are spots. If the event is full, the
+    waiting list is not read at all. If a concurrent request accepted some
+    of the reserved signups first, the unused seats are released and the
+    waiting list is read again, until no seats or waiting signups are left.
+
     Returns:
-        list: ids of all singups which are newly accepted.
+        dict: Updated fields of all signups which are newly accepted, with
+            their ids as keys.
     """
     id_field = current_app.config['ID_FIELD']
-    lookup = {id_field: event_id}
-    event = current_app.data.find_one('events', None, **lookup)
+    event = find_one_cached('events', event_id)
 
-    accepted_ids = []
+    if event is None:
+        # The event itself was deleted, e.g. signups are removed by cascade
+        return {}
 
-    if event['selection_strategy'] == 'fcfs':
-        lookup = {'event': event_id, 'accepted': True}
-        signup_count = (
-            current_app.data.driver.db['eventsignups'].count_documents(lookup))
-
-        # 0 spots == infinite spots
-        if event['spots'] == 0 or signup_count < event['spots']:
-            lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
-            new_list = current_app.data.driver.db['eventsignups'].find(
-                lookup).sort('_created', ASCENDING)
+    if event['selection_strategy'] != 'fcfs':
+        return {}
 
-            if event['spots'] > 0:
-                to_accept = new_list.limit(event['spots'] - signup_count)
-            else:
-                # infinite spots, so just accept everyone
-                to_accept = new_list
+    ensure_signup_counters(event)
 
-            for new_accepted in to_accept:
-                accepted_ids.append(new_accepted['_id'])
-                # Set accepted flag
-                current_app.data.update('eventsignups', new_accepted[id_field],
-                                        {'accepted': True}, new_accepted)
-
-                # Notify user
-                notify_signup_accepted(event, new_accepted)
-
-    return accepted_ids
+    collection = current_app.data.driver.db['eventsignups']
+    accepted = {}
+    while True:
+        # 0 spots == infinite spots
+        if event['spots'] > 0 and event['signup_count'] >= event['spots']:
+            break
+
+        waiting = collection.find(
+            {'event': event_id, 'accepted': False, 'confirmed': True},
+            {id_field: 1, 'user': 1, 'email': 1}).sort('_created', ASCENDING)
+        if event['spots'] > 0:
+            waiting = waiting.limit(event['spots'] - event['signup_count'])
+
+        to_accept = list(waiting)
+        if to_accept:
+            to_accept = to_accept[:reserve_seats(event, len(to_accept))]
+        if not to_accept:
+            break
+
+        # The new etag also identifies the signups accepted by this request
+        updates = {
+            'accepted': True,
+            '_updated': datetime.utcnow().replace(microsecond=0),
+            '_etag': uuid4().hex,
+        }
+        ids = [signup[id_field] for signup in to_accept]
+        result = collection.update_many({id_field: {'$in': ids},
+                                         'accepted': False},
+                                        {'$set': updates})
+        for _id in ids:
+            forget_cached_document('eventsignups', _id)
+
+        complete = result.modified_count == len(to_accept)
+        if not complete:
+            # Some signups have been accepted by a concurrent request
+            release_seats(event_id, len(to_accept) - result.modified_count)
+            ours = {signup[id_field] for signup in collection.find(
+                {id_field: {'$in': ids}, '_etag': updates['_etag']},
+                {id_field: 1})}
+            to_accept = [signup for signup in to_accept
+                         if signup[id_field] in ours]
+
+        for signup in to_accept:
+            notify_signup_accepted(event, signup)
+            accepted[signup[id_field]] = updates
+
+        if complete:
+            break
+
+        # The released seats may be free for signups further down the
+        # waiting list, read it again with the current counter
+        current = current_app.data.driver.db['events'].find_one(
+            {id_field: event_id}, {'signup_count': 1})
+        if current is None:
+            break
+        event = dict(event, signup_count=current['signup_count'])
+
+    return accepted
 
 
 """
@@ -83,7 +137,7 @@ def update_waiting_list_after_insert(signups):
     for signup in signups:
         accepted = update_waiting_list(signup['event'])
         if signup['_id'] in accepted:
-            signup['accepted'] = True
+            signup.update(accepted[signup['_id']])
 
 
 def update_waiting_list_after_delete(signup):
@@ -10,6 +10,8 @@ import json
 from flask import current_app, g, request
 from jsonschema import Draft4Validator, SchemaError
 
+from amivapi.cache import find_one_cached
+
 
 class EventValidator(object):
     """Custom Validator for event validation rules."""
@@ -50,15 +52,11 @@ class EventValidator(object):
             # will complain, but we can't continue here
             return
 
-        event = current_app.data.find_one('events', None, **lookup)
+        event = find_one_cached('events', lookup[id_field])
 
-        # Load schema, we can use this without caution because only valid
-        # json schemas can be written to the database
+        # Search for errors and move them into main validator
         if event is not None:
-            schema = json.loads(event['additional_fields'])
-            validator = Draft4Validator(schema)
-
-            # search for errors and move them into main validator
+            validator = _get_signup_validator(event)
             for error in validator.iter_errors(data):
                 self._error(field, error.message)
 
@@ -103,8 +101,7 @@ class EventValidator(object):
         if signup_possible:
             # We can assume event_id is valid, as the type validator will abort
             # otherwise and this validator is not executed
-            lookup = {current_app.config['ID_FIELD']: event_id}
-            event = current_app.data.find_one("events", None, **lookup)
+            event = find_one_cached('events', event_id)
 
             if event['spots'] is None:
                 self._error(field, "the event with id %s has no signup"
@@ -147,8 +144,7 @@ class EventValidator(object):
         if enabled:
             # Get event
             event_id = self.document.get('event', None)
-            lookup = {current_app.config['ID_FIELD']: event_id}
-            event = current_app.data.find_one("events", None, **lookup)
+            event = find_one_cached('events', event_id)
 
             # If the event doesnt exist we do not have to do anything,
             # The 'type' validator will generate an error anyway
@@ -176,39 +172,15 @@ class EventValidator(object):
         if not enabled:
             return
 
-        try:
-            json_data = json.loads(value)
-        except json.JSONDecodeError as error:
-            self._error(field,
-                        "Invalid json, parsing failed with exception: %s"
-                        % error)
-            return
-
-        # validate if these fields are included exactly as given
-        # (we, e.g., always require objects so UI can rely on this)
-        enforced_fields = {
-            '$schema': 'http://json-schema.org/draft-04/schema#',
-            'type': 'object',
-            'additionalProperties': False
-        }
-
-        for key, val in enforced_fields.items():
-            if key not in json_data or json_data[key] != val:
-                self._error(field,
-                            "'%s' is required to be set to '%s'"
-                            % (key, val))
-
-        # now check if it is entirely valid jsonschema
-        validator = Draft4Validator(json_data)
-        # by default, jsonschema specification allows unknown properties
-        # We do not allow these.
-        validator.META_SCHEMA['additionalProperties'] = False
+        cache = current_app.config['event_schema_cache']
+        key = ('schema', value)
+        errors = cache.get(key)
+        if errors is None:
+            errors = _check_json_schema(value)
+            cache.set(key, errors)
 
-        try:
-            validator.check_schema(json_data)
-        except SchemaError as error:
-            self._error(field, "does not contain a valid schema: %s"
-                        % error)
+        for error in errors:
+            self._error(field, error)
 
     # Eve doesn't handle time zones properly. It's always UTC but sometimes
     # the timezone is included, sometimes it isn't.
@@ -344,3 +316,62 @@ class EventValidator(object):
                     self._error(field,
                                 "'%s' is required if '%s' is not present."
                                 % (field, req_dep))
+
+
+def _get_signup_validator(event):
+    """Get the compiled validator for `additional_fields` of an event.
+
+    Validators are cached by event and `_etag`, i.e. until the event changes.
+    """
+    cache = current_app.config['event_schema_cache']
+    key = ('event', event['_id'], event.get('_etag'))
+    validator = cache.get(key)
+
+    if validator is None:
+        # Load schema, we can use this without caution because only valid
+        # json schemas can be written to the database
+        additional_fields = event.get('additional_fields')
+        schema = json.loads(additional_fields) if additional_fields else {}
+        validator = Draft4Validator(schema)
+        cache.set(key, validator)
+
+    return validator
+
+
+def _check_json_schema(value):
+    """Check a json schema string, see `_validate_json_schema`.
+
+    Returns:
+        list: Error messages, empty if the schema is valid.
+    """
+    try:
+        json_data = json.loads(value)
+    except json.JSONDecodeError as error:
+        return ["Invalid json, parsing failed with exception: %s" % error]
+
+    errors = []
+
+    # validate if these fields are included exactly as given
+    # (we, e.g., always require objects so UI can rely on this)
+    enforced_fields = {
+        '$schema': 'http://json-schema.org/draft-04/schema#',
+        'type': 'object',
+        'additionalProperties': False
+    }
+
+    for key, val in enforced_fields.items():
+        if key not in json_data or json_data[key] != val:
+            errors.append("'%s' is required to be set to '%s'" % (key, val))
+
+    # now check if it is entirely valid jsonschema
+    validator = Draft4Validator(json_data)
+    # by default, jsonschema specification allows unknown properties
+    # We do not allow these.
+    validator.META_SCHEMA['additionalProperties'] = False
+
+    try:
+        validator.check_schema(json_data)
+    except SchemaError as error:
+        errors.append("does not contain a valid schema: %s" % error)
+
+    return errors
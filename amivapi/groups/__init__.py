@@ -13,8 +13,11 @@ from datetime import datetime, timedelta
 
 from flask import current_app
 
+from amivapi.cache import TTLCache
 from amivapi.cron import periodic
+from amivapi.deferred import deferred
 from amivapi.groups.mailing_lists import (
+    RegenerationQueue,
     new_groups,
     new_members,
     removed_group,
@@ -22,7 +25,13 @@ from amivapi.groups.mailing_lists import (
     updated_group,
     updated_user)
 from amivapi.groups.model import groupdomain
-from amivapi.groups.permissions import check_group_permissions
+from amivapi.groups.permissions import (
+    check_group_permissions,
+    invalidate_new_members,
+    invalidate_removed_group,
+    invalidate_removed_member,
+    invalidate_updated_group,
+    invalidate_updated_member)
 from amivapi.groups.validation import GroupValidator
 from amivapi.utils import register_domain, register_validator
 
@@ -35,18 +44,33 @@ def init_app(app):
     # authentication
     app.after_auth += check_group_permissions
 
-    # email lists
-    app.on_inserted_groups += new_groups
-    app.on_updated_groups += updated_group
-    app.on_deleted_item_groups += removed_group
+    # Cached permissions, invalidated if memberships or groups change
+    app.config['group_permission_cache'] = TTLCache(
+        app.config['GROUP_PERMISSION_CACHE_SIZE'],
+        app.config['GROUP_PERMISSION_CACHE_TTL'])
+    app.on_inserted_groupmemberships += invalidate_new_members
+    app.on_updated_groupmemberships += invalidate_updated_member
+    app.on_deleted_item_groupmemberships += invalidate_removed_member
+    app.on_updated_groups += invalidate_updated_group
+    app.on_deleted_item_groups += invalidate_removed_group
 
-    app.on_inserted_groupmemberships += new_members
-    app.on_deleted_item_groupmemberships += removed_member
+    # email lists, regenerated with a debounce delay (not for tests)
+    delay = app.config['MAILING_LIST_DEBOUNCE'].total_seconds()
+    app.config['mailing_list_queue'] = RegenerationQueue(
+        app, 0 if app.config.get('TESTING') else delay)
+    app.on_inserted_groups += deferred(new_groups)
+    app.on_updated_groups += deferred(updated_group)
+    app.on_deleted_item_groups += deferred(removed_group)
 
-    app.on_updated_users += updated_user
+    app.on_inserted_groupmemberships += deferred(new_members)
+    app.on_deleted_item_groupmemberships += deferred(removed_member)
+
+    app.on_updated_users += deferred(updated_user)
 
 
 @periodic(timedelta(days=1))
 def remove_expired_group_members():
-    current_app.data.driver.db['groupmemberships'].delete_many(
+    result = current_app.data.driver.db['groupmemberships'].delete_many(
         {'expiry': {'$lte': datetime.utcnow()}})
+    if result.deleted_count:
+        current_app.config['group_permission_cache'].clear()
@@ -7,24 +7,36 @@
 A email list can be generated for any group.
 Everytime a group changes or a groupmember is added/removed, the group mail
 files will be regenerated.
-(Since we do not get thousands of requests like this per second we don't need
- anything fancy.)
+Changes are collected in a queue of dirty groups first, which is flushed after
+`MAILING_LIST_DEBOUNCE` by a worker thread. This way, many changes (e.g. a
+batch of new members or a user in many groups changing the email address)
+only regenerate the files of each group once.
 
  The files can be created locally or remotely via ssh, to support the current
- mailing list server solution in place.
+ mailing list server solution in place. Files are only written if their
+ content changed, and all remote changes are sent with a single ssh call.
 
  Ssh is probably not the best approach for this, but unfortunately the server
  does not support any other type of connection.
  If this changes, this implementation should be updated.
 """
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from itertools import chain
-from os import makedirs, path, remove
+from os import listdir, makedirs, path, remove, replace
+from shlex import quote, split
 from subprocess import Popen, PIPE
+from threading import Lock, Timer
 
 from bson import ObjectId
 
 from flask import current_app
+from pymongo import DeleteMany, UpdateOne
+
+# Number of threads writing local files in `recreate_files`
+MAX_WRITE_WORKERS = 8
 
 
 # Hooks
@@ -32,7 +44,7 @@ from flask import current_app
 def new_groups(groups):
     """Create mailing list files for all new groups."""
     for group in groups:
-        make_files(group['_id'])
+        regenerate(group['_id'])
 
 
 def updated_group(updates, original):
@@ -44,7 +56,7 @@ def updated_group(updates, original):
                      if address not in updates['receive_from'])
     # Update remaining forwards
     if ('receive_from' in updates) or ('forward_to' in updates):
-        make_files(original['_id'])
+        regenerate(original['_id'])
 
 
 def removed_group(group):
@@ -59,12 +71,12 @@ def new_members(new_memberships):
     group_ids = set(m['group'] for m in new_memberships)
 
     for group_id in group_ids:
-        make_files(group_id)
+        regenerate(group_id)
 
 
 def removed_member(member):
     """Update files for the group the user was in."""
-    make_files(member['group'])
+    regenerate(member['group'])
 
 
 def updated_user(updates, original):
@@ -74,7 +86,100 @@ def updated_user(updates, original):
             {'user': ObjectId(original['_id'])}, {'group': 1})
 
         for membership in memberships:
-            make_files(str(membership['group']))
+            regenerate(membership['group'])
+
+
+# Regeneration queue
+
+class RegenerationQueue(object):
+    """Dirty groups, waiting for their files to be regenerated.
+
+    The first change of a group starts a timer, all changes within the delay
+    are coalesced and the files of every dirty group are made once when the
+    timer fires. Without delay, files are made immediately.
+
+    The number of changes, regenerations, saved regenerations (changes
+    coalesced with an earlier change) and failed regenerations is counted in
+    `stats`.
+
+    Args:
+        app (Eve): The app
+        delay (float): Debounce delay in seconds
+    """
+
+    def __init__(self, app, delay):
+        self.app = app
+        self.delay = delay
+        self.stats = Counter()
+        self._dirty = {}
+        self._timer = None
+        self._lock = Lock()
+        # Only one flush may write files at a time
+        self._flush_lock = Lock()
+
+    def add(self, group_id):
+        """Mark a group as dirty."""
+        group_id = str(group_id)
+        if not self.delay:
+            self._count('changes')
+            self._make(group_id)
+            return
+
+        with self._lock:
+            self.stats['changes'] += 1
+            if group_id in self._dirty:
+                self.stats['saved'] += 1
+            self._dirty[group_id] = True
+
+            if self._timer is None:
+                self._timer = Timer(self.delay, self.flush)
+                self._timer.start()
+
+    def flush(self):
+        """Make the files of all dirty groups.
+
+        Returns:
+            int: Number of regenerated groups
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                dirty, self._dirty = list(self._dirty), {}
+
+            with self.app.app_context():
+                for group_id in dirty:
+                    self._make(group_id)
+
+        if dirty:
+            self.app.logger.debug(
+                "Regenerated mailing lists of %i groups, %i regenerations "
+                "saved so far." % (len(dirty), self.stats['saved']))
+        return len(dirty)
+
+    def _make(self, group_id):
+        try:
+            make_files(group_id)
+        except Exception:
+            self.app.logger.exception("Failed to regenerate mailing lists "
+                                      "of group '%s'." % group_id)
+            self._count('failed')
+        else:
+            self._count('regenerations')
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+def regenerate(group_id):
+    """Regenerate the files of a group, debounced if configured.
+
+    Args:
+        group_id (str or ObjectId): The id of the group
+    """
+    current_app.config['mailing_list_queue'].add(group_id)
 
 
 # File Handling
@@ -107,28 +212,11 @@ def make_files(group_id):
                 {'_id': {'$in': user_ids}}, {'email': 1})
             user_mails = (user['email'] for user in users)
 
-            # file content: user mails and 'forward_to' entries
-            # The empty string (last arg) ensures that the data ends with '\n'
-            content = '\n'.join(chain(group.get('forward_to') or [],
-                                      user_mails,
-                                      ''))
+            content = _file_content(group.get('forward_to') or [], user_mails)
 
             # A file is required for each 'receive_from' entry
-            for address in group.get('receive_from') or []:
-                # Local
-                local_dir = current_app.config['MAILING_LIST_DIR']
-                if local_dir:
-                    # Create directory if needed
-                    if not path.isdir(local_dir):
-                        makedirs(local_dir)
-
-                    with open(_get_local_path(address), 'w') as file:
-                        file.write(content)
-                        file.truncate()  # If old file was larger, cut of rest
-
-                # Remote
-                if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-                    ssh_create(address, content)
+            sync_files({address: content
+                        for address in group.get('receive_from') or []})
 
 
 def remove_files(addresses):
@@ -140,9 +228,28 @@ def remove_files(addresses):
     Args:
         addresses (list): email addresses with a forward file to delete
     """
-    for address in addresses:
-        # Local
-        if current_app.config['MAILING_LIST_DIR']:
+    sync_files({}, list(addresses))
+
+
+def sync_files(files, removed=(), force=False):
+    """Write and remove mailing list files locally and remotely.
+
+    Files are only written if their content changed. Locally, the existing
+    file is compared. For remote files, a hash of the uploaded content is
+    stored in the database, and all changes are sent with a single ssh
+    connection.
+
+    Args:
+        files (dict): File content (str) with the address as key
+        removed (list): Addresses with a file to remove
+        force (bool): Upload all remote files, even if unchanged
+    """
+    local_dir = current_app.config['MAILING_LIST_DIR']
+    if local_dir:
+        for address, content in files.items():
+            _write_local(address, content)
+
+        for address in removed:
             try:
                 remove(_get_local_path(address))
             except OSError as error:
@@ -151,9 +258,151 @@ def remove_files(addresses):
                     "mailing list database seems to be inconsistent!"
                     % address)
 
-        # Remote
-        if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-            ssh_remove(address)
+    if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
+        _sync_remote(files, removed, force)
+
+
+def recreate_files(force=False):
+    """Create the mailing list files of all groups at once.
+
+    The addresses of all groups are loaded with a single aggregation.
+    Local files are written concurrently, unchanged files are skipped.
+    Files of addresses which are not used by any group are removed.
+    Remote files are synchronized with a single ssh call.
+
+    Args:
+        force (bool): Upload all remote files, even if unchanged
+
+    Returns:
+        dict: Number of `written` local files, `uploaded` remote files and
+            `removed` files (local and remote).
+    """
+    db = current_app.data.driver.db
+    groups = db['groups'].aggregate([
+        {'$match': {'receive_from.0': {'$exists': True}}},
+        {'$lookup': {'from': 'groupmemberships',
+                     'localField': '_id',
+                     'foreignField': 'group',
+                     'as': 'memberships'}},
+        # Join the users one membership at a time, embedding all members in
+        # the group could exceed the maximum document size
+        {'$unwind': {'path': '$memberships',
+                     'preserveNullAndEmptyArrays': True}},
+        {'$lookup': {'from': 'users',
+                     'localField': 'memberships.user',
+                     'foreignField': '_id',
+                     'as': 'member'}},
+        {'$group': {'_id': '$_id',
+                    'receive_from': {'$first': '$receive_from'},
+                    'forward_to': {'$first': '$forward_to'},
+                    'emails': {'$push': {'$arrayElemAt': ['$member.email',
+                                                          0]}}}},
+    ])
+
+    files = {}
+    for group in groups:
+        # Groups without members have no email (or null)
+        emails = [email for email in group['emails'] if email]
+        content = _file_content(group.get('forward_to') or [], emails)
+        for address in group['receive_from']:
+            files[address] = content
+
+    stats = {'written': 0, 'uploaded': 0, 'removed': 0}
+
+    local_dir = current_app.config['MAILING_LIST_DIR']
+    if local_dir:
+        makedirs(local_dir, exist_ok=True)
+        paths = {_get_local_path(address): content
+                 for address, content in files.items()}
+
+        with ThreadPoolExecutor(max_workers=MAX_WRITE_WORKERS) as executor:
+            written = executor.map(_write_file, paths, paths.values())
+            stats['written'] = sum(written)
+
+        prefix = current_app.config['MAILING_LIST_FILE_PREFIX']
+        for filename in listdir(local_dir):
+            filename = path.join(local_dir, filename)
+            if (path.basename(filename).startswith(prefix) and
+                    filename not in paths):
+                remove(filename)
+                stats['removed'] += 1
+
+    if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
+        removed = [item['_id'] for item in
+                   db['mailing_list_files'].find({}, {'_id': 1})
+                   if item['_id'] not in files]
+        stats['uploaded'] = _sync_remote(files, removed, force)
+        stats['removed'] += len(removed)
+
+    return stats
+
+
+def _file_content(forward_to, user_mails):
+    """File content: user mails and 'forward_to' entries."""
+    # The empty string (last arg) ensures that the data ends with '\n'
+    return '\n'.join(chain(forward_to, user_mails, ''))
+
+
+def _write_local(address, content):
+    """Write a local file atomically, unless the content is unchanged.
+
+    Returns:
+        bool: True if the file was written.
+    """
+    return _write_file(_get_local_path(address), content)
+
+
+def _write_file(filename, content):
+    """Write a file atomically, unless the content is unchanged.
+
+    Does not need an app context, so it can be used in other threads.
+    """
+    try:
+        with open(filename, 'r') as file:
+            if file.read() == content:
+                return False
+    except OSError:
+        # Create directory if needed
+        makedirs(path.dirname(filename), exist_ok=True)
+
+    # Write a temporary file first and replace the old file afterwards, so
+    # the mail server never reads a partial file
+    tempfile = filename + '.tmp'
+    with open(tempfile, 'w') as file:
+        file.write(content)
+    replace(tempfile, filename)
+    return True
+
+
+def _sync_remote(files, removed, force):
+    """Upload changed files and remove files with a single ssh connection.
+
+    Returns:
+        int: Number of uploaded files.
+    """
+    hashes = current_app.data.driver.db['mailing_list_files']
+    new_hashes = {address: sha1(content.encode()).hexdigest()
+                  for address, content in files.items()}
+
+    if not force:
+        uploaded = {item['_id']: item['hash'] for item in hashes.find(
+            {'_id': {'$in': list(files)}})}
+        files = {address: content for address, content in files.items()
+                 if uploaded.get(address) != new_hashes[address]}
+
+    if not files and not removed:
+        return 0
+
+    ssh_sync(files, removed)
+
+    requests = [UpdateOne({'_id': address},
+                          {'$set': {'hash': new_hashes[address]}},
+                          upsert=True)
+                for address in files]
+    if removed:
+        requests.append(DeleteMany({'_id': {'$in': list(removed)}}))
+    hashes.bulk_write(requests, ordered=False)
+    return len(files)
 
 
 def _get_local_path(email):
@@ -170,33 +419,41 @@ def _get_remote_path(email):
 
 # SSH Helpers (in separate functions for easier testing)
 
+def ssh_sync(files, removed):
+    """Create and remove several files remotely with a single ssh call.
+
+    A shell script is sent to the remote shell via stdin. For every file,
+    a temporary file is created first, which replaces the file once the
+    upload is completed.
+
+    Args:
+        files (dict): File content (str) with the address as key
+        removed (list): Addresses with a file to remove
+    """
+    folder = current_app.config['REMOTE_MAILING_LIST_DIR']
+    script = ['mkdir -p %s' % quote(folder)]
+
+    for address, content in files.items():
+        file = quote(_get_remote_path(address))
+        tempfile = quote(_get_remote_path(address) + '.tmp')
+        # printf is a shell builtin, so the content length is not limited
+        script.append("printf '%%s' %s > %s" % (quote(content), tempfile))
+        script.append('mv %s %s' % (tempfile, file))
+
+    for address in removed:
+        script.append('rm -f %s' % quote(_get_remote_path(address)))
+
+    ssh_command('sh -s', input='\n'.join(script) + '\n')
+
+
 def ssh_create(address, content):
     """Create a file with content remotely over ssh."""
-    # Create dir, then use 'cat - ' to listen to stdin
-    # Create temporary file first, if upload is completed replace
-    folder = current_app.config['REMOTE_MAILING_LIST_DIR']
-    file = _get_remote_path(address)
-    tempfile = file + '.tmp'
-    ssh_command('mkdir -p %s; cat - > %s; mv %s %s;'
-                % (folder, tempfile, tempfile, file), input=content)
+    ssh_sync({address: content}, [])
 
 
 def ssh_remove(address):
     """Remove a file remotely over ssh."""
-    path = _get_remote_path(address)
-    try:
-        ssh_command('rm %s' % path)
-    except RuntimeError as e:
-        # File does not exist: log issue, but do not raise exception
-        no_file_error = ("rm: cannot remove '%s': No such file or directory" %
-                         path)
-        if no_file_error in str(e):
-            current_app.logger.error(
-                "Cannot remove remote mailing list '%s' because the file does "
-                "not exist. The mailing list database seems to be"
-                "inconsistent." % address)
-        else:
-            raise e
+    ssh_sync({}, [address])
 
 
 def ssh_command(remote_command, input=None):
@@ -204,6 +461,9 @@ def ssh_command(remote_command, input=None):
 
     Popen and communicate are used for compatibility with both python 2 and 3.
 
+    The ssh command can be configured with `REMOTE_MAILING_LIST_SSH_COMMAND`,
+    e.g. to reuse connections with the `ControlMaster` option.
+
     Args:
         remote_command(Str): Command to execute on remote server
         input(Str): Input, is sent to remote process via stdin
@@ -216,9 +476,10 @@ def ssh_command(remote_command, input=None):
     """
     keyfile = current_app.config.get('REMOTE_MAILING_LIST_KEYFILE')  # optional
     address = current_app.config['REMOTE_MAILING_LIST_ADDRESS']
+    ssh = split(current_app.config['REMOTE_MAILING_LIST_SSH_COMMAND'])
 
     # Construct local ssh command, use -i option if keyfile is specified
-    cmd = (["ssh"] + (['-i', keyfile] if keyfile else []) +
+    cmd = (ssh + (['-i', keyfile] if keyfile else []) +
            [address, remote_command])
 
     # Open subprocess, initialize pipes for input and errors
@@ -228,7 +489,7 @@ def ssh_command(remote_command, input=None):
     out, error = process.communicate(input=input.encode() if input else None)
 
     # Raise RuntimeError if anything went wrong
-    if error:
+    if error or process.returncode:
         raise RuntimeError("Executing command via ssh failed with error:\n%s"
                            % error.decode())
 
@@ -228,7 +228,9 @@ groupdomain = {
         },
 
         'mongo_indexes': {
-            'name': ([('name', 1)], {'background': True})
+            'name': ([('name', 1)], {'background': True}),
+            'moderator': ([('moderator', 1)], {'background': True}),
+            'receive_from': ([('receive_from', 1)], {'background': True}),
         },
 
         'schema': {
@@ -339,6 +341,12 @@ groupdomain = {
 
         'authentication': GroupMembershipAuth,
 
+        'mongo_indexes': {
+            # Memberships are looked up both by user and by group
+            'user_group': ([('user', 1), ('group', 1)], {'background': True}),
+            'group': ([('group', 1)], {'background': True}),
+        },
+
         'schema': {
             'group': {
                 'example': 'e0fb1d077ff6ca3c9dd731c4',
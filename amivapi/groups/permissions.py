@@ -3,12 +3,60 @@
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
 
-"""Permissions for group members."""
+"""Permissions for group members.
+
+The permissions of a user are combined from all their groups into a single
+map `{resource: permission}`, which is cached for every user. This way
+permissions can be checked for every resource (e.g. on the home endpoint)
+without any database query.
+
+The cache is invalidated by hooks whenever memberships or group permissions
+change. Changes by other processes are picked up after
+`GROUP_PERMISSION_CACHE_TTL`.
+"""
 
 from bson import ObjectId
 
 from flask import current_app, g
 
+from amivapi.utils import get_id
+
+
+def get_user_permissions(user_id):
+    """Get the permissions all groups of a user grant.
+
+    If several groups grant permissions for the same resource, `readwrite`
+    takes precedence over `read`.
+
+    Args:
+        user_id (str): The id of the user.
+
+    Returns:
+        dict: resources as keys and permissions as values.
+    """
+    cache = current_app.config['group_permission_cache']
+    entry = cache.get(user_id)
+
+    if entry is None:
+        memberships = current_app.data.driver.db['groupmemberships'].find(
+            {'user': ObjectId(user_id)}, {'group': 1})
+        group_ids = set(m['group'] for m in memberships)
+        groups = current_app.data.driver.db['groups'].find(
+            {'_id': {'$in': list(group_ids)}, 'permissions': {'$ne': None}},
+            {'permissions': 1})
+
+        permissions = {}
+        for group in groups:
+            for resource, permission in group['permissions'].items():
+                if permissions.get(resource) != 'readwrite':
+                    permissions[resource] = permission
+
+        # Keep the groups, so the entry can be invalidated if they change
+        entry = {'groups': group_ids, 'permissions': permissions}
+        cache.set(user_id, entry)
+
+    return entry['permissions']
+
 
 def check_group_permissions(resource):
     """Retrieve groups for current user and apply permissions for resource.
@@ -20,17 +68,48 @@ def check_group_permissions(resource):
     user = g.get('current_user')
 
     if user:
-        # Find the users groups giving permission for a resource
-        memberships = current_app.data.driver.db['groupmemberships'].find(
-            {'user': ObjectId(user)}, {'group': 1})
-        group_ids = [m['group'] for m in memberships]
-        permission_key = 'permissions.%s' % resource
-        groups = current_app.data.driver.db['groups'].find(
-            {'_id': {'$in': group_ids}, permission_key: {'$exists': True}},
-            {permission_key: 1})
-        permissions = [group['permissions'][resource] for group in groups]
+        permission = get_user_permissions(user).get(resource)
 
-        if 'read' in permissions:
+        if permission == 'read':
             g.resource_admin_readonly = True
-        if 'readwrite' in permissions:
+        elif permission == 'readwrite':
             g.resource_admin = True
+
+
+# Cache invalidation hooks
+
+def _invalidate_user(user_id):
+    current_app.config['group_permission_cache'].pop(str(get_id(user_id)))
+
+
+def _invalidate_group(group_id):
+    group_id = get_id(group_id)
+    current_app.config['group_permission_cache'].remove_if(
+        lambda _, entry: group_id in entry['groups'])
+
+
+def invalidate_new_members(items):
+    """Invalidate permissions of users who joined a group."""
+    for item in items:
+        _invalidate_user(item['user'])
+
+
+def invalidate_updated_member(updates, original):
+    """Invalidate permissions of users whose membership changed."""
+    _invalidate_user(original['user'])
+
+
+def invalidate_removed_member(item):
+    """Invalidate permissions of users who left a group."""
+    _invalidate_user(item['user'])
+
+
+def invalidate_updated_group(updates, original):
+    """Invalidate permissions of all members if group permissions change."""
+    if 'permissions' in updates:
+        _invalidate_group(original['_id'])
+
+
+def invalidate_removed_group(item):
+    """Invalidate permissions of all members of a deleted group."""
+    _invalidate_group(item['_id'])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Password hashing in worker processes.
+
+Hashing and verifying passwords with `PASSWORD_CONTEXT` is slow on purpose.
+With a threaded server, hashing in the request thread holds the GIL and slows
+down all other requests of the process. Therefore the work can be done by a
+pool of `PASSWORD_HASH_WORKERS` processes instead.
+
+This does not help with a server which handles one request at a time, such as
+bjoern (`amivapi run prod`): the request still waits for its hash, and no
+other request is served in the meantime. By default (and for tests),
+`PASSWORD_HASH_WORKERS = 0` and passwords are hashed in the request thread.
+
+At most `PASSWORD_HASH_QUEUE_SIZE` passwords wait for a worker. If the queue
+is full, requests wait up to `PASSWORD_HASH_TIMEOUT` for a free place and
+are rejected with `503 Service Unavailable` afterwards, so a burst of logins
+can not pile up indefinitely.
+
+The worker processes are started with `spawn` instead of `fork`, as the
+server process already runs other threads (e.g. deferred hooks or the ldap
+pool) when the first password is hashed.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+
+from flask import abort, current_app
+from passlib.context import CryptContext
+
+# Contexts of a worker process, by configuration string
+_contexts = {}
+
+
+def _run(config, method, *args):
+    """Call a method of the password context (in a worker process)."""
+    context = _contexts.get(config)
+    if context is None:
+        context = _contexts[config] = CryptContext.from_string(config)
+    return getattr(context, method)(*args)
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords with a pool of processes.
+
+    The processes are started (with `spawn`) on first use.
+
+    Args:
+        context (CryptContext): Password context
+        workers (int): Number of processes, 0 to hash in the calling thread
+        queue_size (int): Maximum number of passwords waiting for a process
+        timeout (float): Maximum time to wait for a place in the queue
+    """
+
+    def __init__(self, context, workers, queue_size, timeout):
+        self.context = context
+        self.workers = workers
+        self.timeout = timeout
+        self._config = context.to_string()
+        self._executor = None
+        self._slots = BoundedSemaphore(workers + queue_size)
+        self._lock = Lock()
+
+    def hash(self, plaintext):
+        """Return the hash of a password."""
+        return self._call('hash', plaintext)
+
+    def verify(self, plaintext, hashed):
+        """Check a password. Returns True if it matches the hash."""
+        return self._call('verify', plaintext, hashed)
+
+    def needs_update(self, hashed):
+        """Check if a hash should be replaced (this is fast)."""
+        return self.context.needs_update(hashed)
+
+    def _call(self, method, *args):
+        if not self.workers:
+            return getattr(self.context, method)(*args)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            current_app.logger.warning("Password hashing queue is full.")
+            abort(503, description="Too many requests, please try again.")
+        try:
+            return self._get_executor().submit(
+                _run, self._config, method, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=get_context('spawn'))
+            return self._executor
+
+
+def init_app(app):
+    """Create the password hasher."""
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if app.config.get('TESTING'):
+        workers = 0
+    app.config['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_CONTEXT'],
+        workers=workers,
+        queue_size=app.config['PASSWORD_HASH_QUEUE_SIZE'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'].total_seconds())
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Index management.
+
+Indexes of resources are declared in the resource domain with Eve's
+`mongo_indexes` setting, e.g.
+
+    'mongo_indexes': {
+        'token': ([('token', 1)], {'background': True, 'unique': True}),
+    }
+
+Eve creates them when the resource is registered. Collections which are not
+resources (e.g. `scheduled_tasks`) and indexes which depend on the app
+configuration can be declared in the same format with `register_indexes`,
+which creates them right away as well.
+
+Documents of ephemeral collections (e.g. sessions or sent mails) are removed
+by MongoDB with a TTL index, declared with `expiry_index`. If the timeout is
+changed in the configuration, the index is updated on startup.
+
+Indexes which have been declared once stay in the database, even if the
+declaration is removed. `check_indexes` compares the declared indexes with the
+database to find missing, changed and obsolete indexes, and `ensure_indexes`
+fixes them. Both are available with the `amivapi ensure_indexes` command.
+"""
+
+from pymongo.errors import OperationFailure
+
+# Options that change the behaviour of an index and are therefore compared
+COMPARED_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds',
+                    'partialFilterExpression')
+
+
+def register_indexes(app, collection, indexes):
+    """Declare and create indexes for a collection which is not a resource.
+
+    Args:
+        app (Eve): The app
+        collection (str): Name of the collection
+        indexes (dict): Indexes in the format of Eve's `mongo_indexes`
+    """
+    declared = app.config.setdefault('collection_indexes', {})
+    declared.setdefault(collection, {}).update(indexes)
+
+    with app.app_context():
+        db = app.data.driver.db
+        for name, index in indexes.items():
+            _create_index(db[collection], name, *_split(index))
+
+
+def expiry_index(field, timeout):
+    """Declare a TTL index, documents expire `timeout` after `field`.
+
+    Args:
+        field (str): A date field
+        timeout (timedelta): Time until documents expire
+
+    Returns:
+        tuple: Index declaration for `register_indexes`
+    """
+    return ([(field, 1)], {'background': True,
+                           'expireAfterSeconds': int(timeout.total_seconds())})
+
+
+def declared_indexes(app):
+    """Collect the indexes of all resources and other collections.
+
+    Returns:
+        dict: collection names as keys, dicts with index name as keys and
+            (keys, options) tuples as values.
+    """
+    declared = {}
+    for resource, settings in app.config['DOMAIN'].items():
+        collection = app.config['SOURCES'][resource]['source']
+        indexes = declared.setdefault(collection, {})
+        for name, index in (settings.get('mongo_indexes') or {}).items():
+            indexes[name] = _split(index)
+
+    for collection, indexes in app.config.get('collection_indexes',
+                                              {}).items():
+        declared.setdefault(collection, {}).update(
+            (name, _split(index)) for name, index in indexes.items())
+
+    return declared
+
+
+def check_indexes(app):
+    """Compare the declared indexes with the database.
+
+    Needs an app context.
+
+    Returns:
+        dict: With keys `missing`, `changed` and `obsolete`, each a list of
+            (collection, index name) tuples.
+    """
+    db = app.data.driver.db
+    report = {'missing': [], 'changed': [], 'obsolete': []}
+
+    for collection, indexes in sorted(declared_indexes(app).items()):
+        existing = db[collection].index_information()
+        existing.pop('_id_', None)
+
+        for name, (keys, options) in sorted(indexes.items()):
+            if name not in existing:
+                report['missing'].append((collection, name))
+            elif not _matches(existing[name], keys, options):
+                report['changed'].append((collection, name))
+
+        report['obsolete'].extend((collection, name)
+                                  for name in sorted(existing)
+                                  if name not in indexes)
+
+    return report
+
+
+def ensure_indexes(app, drop_obsolete=True):
+    """Create missing and changed indexes, drop obsolete ones (optional).
+
+    Needs an app context.
+
+    Returns:
+        dict: The report of `check_indexes` before any changes were made.
+    """
+    db = app.data.driver.db
+    report = check_indexes(app)
+    declared = declared_indexes(app)
+
+    for collection, name in report['changed']:
+        db[collection].drop_index(name)
+
+    for collection, name in report['missing'] + report['changed']:
+        _create_index(db[collection], name, *declared[collection][name])
+
+    if drop_obsolete:
+        for collection, name in report['obsolete']:
+            db[collection].drop_index(name)
+
+    return report
+
+
+def _split(index):
+    """Split an index declaration into keys and options."""
+    if isinstance(index, tuple):
+        return index
+    return index, {}
+
+
+def _create_index(collection, name, keys, options):
+    """Create an index, replace existing index with different options.
+
+    Same as Eve does for `mongo_indexes`.
+    """
+    try:
+        collection.create_index(keys, name=name, **options)
+    except OperationFailure as error:
+        if error.code not in (85, 86):  # Index options or keys conflict
+            raise
+        collection.drop_index(name)
+        collection.create_index(keys, name=name, **options)
+
+
+def _matches(info, keys, options):
+    """Check if the info of an existing index matches a declaration."""
+    def normalize(key):
+        # The database may return directions as float, e.g. 1.0
+        return [(field, int(direction) if isinstance(direction, float)
+                 else direction) for field, direction in key]
+
+    if normalize(info['key']) != normalize(keys):
+        return False
+
+    return all(info.get(option) == options.get(option)
+               for option in COMPARED_OPTIONS)
@@ -41,6 +41,10 @@ jobdomain = {
         'public_item_methods': ['GET', 'HEAD'],
         'public_methods': ['GET', 'HEAD'],
 
+        'mongo_indexes': {
+            'time_end': ([('time_end', 1)], {'background': True}),
+        },
+
         'schema': {
             'company': {
                 'description': 'The company offering the job.',
@@ -40,16 +40,27 @@ anymore. Unfortunately, the info for all previous students is still in the
 parsing.
 """
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from eve.methods.common import resolve_document_etag
 from eve.methods.patch import patch_internal
 from eve.methods.post import post_internal
 from flask import current_app
 from nethz.ldap import AuthenticatedLdap
+from pymongo import ReturnDocument, UpdateOne
 
+from amivapi.ldap_pool import LdapPool, LdapUnavailable
 from amivapi.utils import admin_permissions
 
+# `sync_all` searches the ldap in chunks, one for every first character
+SYNC_CHUNK_CHARACTERS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
 
 def init_app(app):
-    """Attach an ldap connection to the app."""
+    """Attach a pool of ldap connections to the app."""
     user = app.config['LDAP_USERNAME']
     password = app.config['LDAP_PASSWORD']
 
@@ -60,7 +71,12 @@ def init_app(app):
         raise ValueError("You cannot set only a username or only a password "
                          "for ldap.")
 
-    app.config['ldap_connector'] = AuthenticatedLdap(user, password)
+    app.config['ldap_connector'] = LdapPool(
+        lambda: AuthenticatedLdap(user, password),
+        size=app.config['LDAP_POOL_SIZE'],
+        timeout=app.config['LDAP_TIMEOUT'].total_seconds(),
+        failure_threshold=app.config['LDAP_FAILURE_THRESHOLD'],
+        reset_timeout=app.config['LDAP_RESET_TIMEOUT'].total_seconds())
 
 
 def authenticate_user(cn, password):
@@ -71,9 +87,15 @@ def authenticate_user(cn, password):
         password (string): the user password (plaintext)
 
     Returns:
-        bool: True if successful, False otherwise
+        bool: True if successful, False otherwise (also if the ldap is not
+            available)
     """
-    return current_app.config['ldap_connector'].authenticate(cn, password)
+    try:
+        return current_app.config['ldap_connector'].authenticate(cn,
+                                                                 password)
+    except LdapUnavailable as error:
+        current_app.logger.warning("Ldap authentication failed: %s" % error)
+        return False
 
 
 def sync_one(cn):
@@ -95,26 +117,131 @@ def sync_one(cn):
         return _create_or_update_user(ldap_data)
 
 
-def sync_all():
+def sync_all(restart=False):
     """Query the ETH LDAP for all our members. Adds non-existing ones to db.
 
     Updates existing ones if ldap data has changed.
-    Depending on the system, this can take 30 seconds or longer.
+
+    The ldap is searched in chunks by the first character of the nethz,
+    `LDAP_SYNC_WORKERS` chunks at a time. The results of a chunk are fetched
+    while they are processed, without the timeout for logins (see
+    `LdapPool.iter_search`), in pages of `LDAP_SYNC_PAGE_SIZE` users: the
+    existing users of a page are fetched with a single query and compared to
+    the ldap data, only new and changed users are written (in bulk). Thus
+    only a few pages are kept in memory.
+
+    Progress is stored in the database when a chunk is complete. If the sync
+    is interrupted, the next call continues with the missing chunks, unless
+    `restart` is set.
+
+    Args:
+        restart (bool): Ignore the progress of an interrupted sync.
 
     Returns:
-        list: Data of all updated users.
+        dict: Number of `created`, `updated` and `unchanged` users.
+    """
+    progress = current_app.data.driver.db['ldap_sync']
+    if restart:
+        progress.delete_one({'_id': 'sync_all'})
+    checkpoint = progress.find_one_and_update(
+        {'_id': 'sync_all'},
+        {'$setOnInsert': {'started': datetime.utcnow(), 'done': [],
+                          'created': 0, 'updated': 0, 'unchanged': 0}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+
+    app = current_app._get_current_object()
+    chunks = [(name, query) for name, query in _sync_chunks()
+              if name not in checkpoint['done']]
+    with ThreadPoolExecutor(app.config['LDAP_SYNC_WORKERS']) as executor:
+        futures = [executor.submit(_sync_chunk, app, name, query)
+                   for name, query in chunks]
+    for future in futures:
+        # Raise errors, completed chunks are not synced again
+        future.result()
+
+    result = progress.find_one_and_delete({'_id': 'sync_all'})
+    return {key: result[key] for key in ('created', 'updated', 'unchanged')}
+
+
+def _sync_chunks():
+    """Split the query for all members into chunks by the first character.
+
+    Returns:
+        list: (name, query) tuples
     """
     # See file docstring for explanation of `deparmentNumber` field
     keywords = ''.join(u"(departmentNumber=*%s*)" % _escape(item)
                        for item in current_app.config['LDAP_DEPARTMENT_MAP'])
-    query = u"(& (ou=VSETH Mitglied) (| %s) )" % keywords
-    ldap_data = _search(query)
+    query = u"(& (ou=VSETH Mitglied) (| %s) %%s)" % keywords
+
+    prefixes = [u"(cn=%s*)" % char for char in SYNC_CHUNK_CHARACTERS]
+    chunks = [(char, query % prefix)
+              for char, prefix in zip(SYNC_CHUNK_CHARACTERS, prefixes)]
+    # Everything else, in case a nethz starts with an unexpected character
+    chunks.append(('other', query % (u"(! (| %s))" % ''.join(prefixes))))
+    return chunks
+
+
+def _sync_chunk(app, name, query):
+    """Sync all users found by the query page by page (in a worker)."""
+    progress = app.data.driver.db['ldap_sync']
+    page_size = app.config['LDAP_SYNC_PAGE_SIZE']
+
+    # Counted only once the chunk is complete, an interrupted chunk is
+    # synced again from the start
+    counts = Counter(created=0, updated=0, unchanged=0)
+    with app.test_request_context():
+        results = _search(query, stream=True)
+        while True:
+            page = list(islice(results, page_size))
+            if not page:
+                break
+            counts.update(_sync_users(page))
+
+    progress.update_one({'_id': 'sync_all'},
+                        {'$inc': dict(counts), '$addToSet': {'done': name}})
+
+
+def _sync_users(ldap_users):
+    """Create new and update changed users.
+
+    Args:
+        ldap_users (list): Processed ldap data
+
+    Returns:
+        dict: Number of `created`, `updated` and `unchanged` users.
+    """
+    ldap_users = {user['nethz']: user for user in ldap_users}
+    existing = current_app.data.driver.db['users'].find(
+        {'nethz': {'$in': list(ldap_users)}})
+    existing = {user['nethz']: user for user in existing}
+
+    new_users = []
+    changed_users = []
+    for nethz, ldap_data in ldap_users.items():
+        db_data = existing.get(nethz)
+        if db_data is None:
+            new_users.append(ldap_data)
+        else:
+            updates = _user_updates(ldap_data, db_data)
+            if updates:
+                changed_users.append((updates, db_data))
+
+    with admin_permissions():
+        created = _insert_users(new_users)
+        updated = _update_users(changed_users)
 
-    return [_create_or_update_user(user) for user in ldap_data]
+    return {'created': created,
+            'updated': updated,
+            'unchanged': len(existing) - len(changed_users)}
 
 
-def _search(query):
-    """Search the LDAP. Returns filtered data (iterable) for string query."""
+def _search(query, stream=False):
+    """Search the LDAP. Returns filtered data (iterable) for string query.
+
+    With `stream`, results are fetched while they are processed, without
+    timeout (see `LdapPool.iter_search`).
+    """
     attr = [
         'cn',
         'swissEduPersonMatriculationNumber',
@@ -126,8 +253,9 @@ def _search(query):
         'departmentNumber',
         'description',
     ]
-    results = current_app.config['ldap_connector'].search(query,
-                                                          attributes=attr)
+    connector = current_app.config['ldap_connector']
+    search = connector.iter_search if stream else connector.search
+    results = search(query, attributes=attr)
     return (_process_data(res) for res in results)
 
 
@@ -185,26 +313,125 @@ def _process_data(data):
     return res
 
 
+def _filter_ldap_data(ldap_data, db_data):
+    """Remove all fields from ldap data which must not overwrite the db."""
+    # Membership will not be downgraded and email not be overwritten
+    # Newletter settings will also not be adjusted
+    data = dict(ldap_data)
+    data.pop('email', None)
+    if db_data.get('membership') != u"none":
+        data.pop('membership', None)
+        data.pop('send_newsletter', None)
+    return data
+
+
+def _user_updates(ldap_data, db_data):
+    """Return all fields of the ldap data which differ from the db."""
+    return {key: value
+            for key, value in _filter_ldap_data(ldap_data, db_data).items()
+            if db_data.get(key) != value}
+
+
 def _create_or_update_user(ldap_data):
-    """Try to find user in database. Update if it exists, create otherwise."""
+    """Try to find user in database. Update if it exists, create otherwise.
+
+    Only changed fields are updated, and nothing is written if the user is
+    up to date.
+    """
     query = {'nethz': ldap_data['nethz']}
     db_data = current_app.data.driver.db['users'].find_one(query)
 
     with admin_permissions():
         if db_data:
-            # Membership will not be downgraded and email not be overwritten
-            # Newletter settings will also not be adjusted
-            ldap_data.pop('email', None)
-            if db_data.get('membership') != u"none":
-                ldap_data.pop('membership', None)
-                ldap_data.pop('send_newsletter', None)
-
-            user = patch_internal('users',
-                                  ldap_data,
-                                  _id=db_data['_id'])[0]
+            updates = _user_updates(ldap_data, db_data)
+            if not updates:
+                # Nothing changed, e.g. for most logins
+                return db_data
+            user = patch_internal('users', updates, _id=db_data['_id'])[0]
         else:
             # For new members,
 
             user = post_internal('users', ldap_data)[0]
 
     return user
+
+
+def _insert_users(users):
+    """Create several users at once.
+
+    If any user is invalid, Eve rejects the whole batch. In this case, all
+    users are created separately to create at least all valid users.
+
+    Returns:
+        int: Number of created users.
+    """
+    if not users:
+        return 0
+
+    status = post_internal('users', users)[3]
+    if status == 201:
+        return len(users)
+
+    created = 0
+    for user in users:
+        response, _, _, status, _ = post_internal('users', user)
+        if status == 201:
+            created += 1
+        else:
+            current_app.logger.error("Could not create user '%s' from "
+                                     "ldap: %s" % (user['nethz'], response))
+    return created
+
+
+def _update_users(changed_users):
+    """Write the updates of several users with a single bulk write.
+
+    The ldap data is not validated again (it has been processed by
+    `_process_data`), except for changed legi numbers, which need to be
+    checked for uniqueness with `patch_internal`. The `on_update` and
+    `on_updated` hooks are called for every user, like for `patch_internal`.
+
+    Args:
+        changed_users (list): `(updates, original)` tuples
+
+    Returns:
+        int: Number of updated users.
+    """
+    app = current_app
+    now = datetime.utcnow().replace(microsecond=0)
+
+    requests = []
+    updated = []
+    patched = 0
+    for updates, original in changed_users:
+        if 'legi' in updates:
+            response, _, _, status, _ = patch_internal(
+                'users', updates, _id=original['_id'])
+            if status == 200:
+                patched += 1
+            else:
+                current_app.logger.error("Could not update user '%s' from "
+                                         "ldap: %s" % (original['nethz'],
+                                                       response))
+            continue
+
+        updates['_updated'] = now
+        app.on_update('users', updates, original)
+        app.on_update_users(updates, original)
+
+        document = dict(original, **updates)
+        resolve_document_etag(document, 'users')
+        updates['_etag'] = document['_etag']
+
+        requests.append(UpdateOne({'_id': original['_id']},
+                                  {'$set': updates}))
+        updated.append((updates, original))
+
+    if requests:
+        app.data.driver.db['users'].bulk_write(requests, ordered=False)
+
+    for updates, original in updated:
+        app.on_updated('users', updates, original)
+        app.on_updated_users(updates, original)
+
+    return patched + len(updated)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Pool of ldap connectors with timeouts and a circuit breaker.
+
+A slow or unreachable ldap server must not block all workers, e.g. during
+peak login times. Therefore every call to the ldap is executed in a separate
+thread and given up after `LDAP_TIMEOUT`. At most `LDAP_POOL_SIZE` calls run
+at the same time, further calls wait for a free connector (again at most
+`LDAP_TIMEOUT`).
+
+Connectors are created on demand. A connector which raised an error or did
+not answer in time is considered broken and replaced by a new one.
+
+After `LDAP_FAILURE_THRESHOLD` failed calls in a row, the circuit opens: all
+calls fail immediately for `LDAP_RESET_TIMEOUT`. Afterwards, calls are tried
+again and the first successful call closes the circuit, while the first
+failed call opens it again.
+
+All failures raise `LdapUnavailable`.
+
+Large searches (`iter_search`) are not limited by `LDAP_TIMEOUT`: the results
+are fetched by the calling thread while they are processed.
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from queue import Empty, LifoQueue
+from threading import Lock
+from time import monotonic
+
+
+class LdapUnavailable(Exception):
+    """The ldap did not answer (in time) or the circuit is open."""
+
+
+class LdapPool(object):
+    """Pool of ldap connectors, can be used like a single connector.
+
+    Args:
+        factory (callable): Creates a new connector, e.g. `AuthenticatedLdap`
+        size (int): Maximum number of connectors and concurrent calls
+        timeout (float): Maximum time for a call, in seconds
+        failure_threshold (int): Failed calls in a row to open the circuit
+        reset_timeout (float): Time until calls are allowed again, in seconds
+    """
+
+    def __init__(self, factory, size, timeout, failure_threshold,
+                 reset_timeout):
+        self.factory = factory
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.stats = Counter()
+
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        # Free connectors, `None` is a slot for a new connector. The last
+        # used connector is reused first, unused slots stay at the bottom
+        self._connectors = LifoQueue()
+        for _ in range(size):
+            self._connectors.put(None)
+
+        self._lock = Lock()
+        self._failures = 0
+        self._open_until = None
+
+    def authenticate(self, cn, password):
+        """Authenticate a user, see `AuthenticatedLdap.authenticate`."""
+        return self.call('authenticate', cn, password)
+
+    def search(self, query, attributes=None):
+        """Search the ldap, see `AuthenticatedLdap.search`.
+
+        All results are fetched within the timeout and returned as list.
+        """
+        return self.call('search', query, attributes=attributes)
+
+    def iter_search(self, query, attributes=None):
+        """Search the ldap and yield the results while they are fetched.
+
+        This is meant for large searches, e.g. to sync all users. Only
+        getting a connector is limited by the timeout, the search is not.
+        The calling thread uses the connector until all results are fetched
+        or the generator is closed. Errors are counted, but do not open the
+        circuit.
+        """
+        connector = self._get_connector()
+        try:
+            if connector is None:
+                connector = self.factory()
+            for result in connector.search(query, attributes=attributes):
+                yield result
+        except GeneratorExit:
+            # Not all results have been fetched, don't reuse the connector
+            self._connectors.put(None)
+            raise
+        except Exception as error:
+            self._connectors.put(None)
+            self._count('errors')
+            raise LdapUnavailable("Ldap error: %s" % error) from error
+
+        self._connectors.put(connector)
+        self._count('searches')
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of a connector from the pool.
+
+        Raises:
+            LdapUnavailable: The circuit is open, no connector is available
+                in time, or the call failed or did not finish in time.
+        """
+        deadline = monotonic() + self.timeout
+        connector = self._get_connector()
+
+        try:
+            if connector is None:
+                connector = self.factory()
+            future = self._executor.submit(self._run, connector, method,
+                                           args, kwargs)
+            result = future.result(timeout=max(deadline - monotonic(), 0))
+        except TimeoutError:
+            # The call may still be running, the connector can't be reused
+            self._connectors.put(None)
+            self._failed('timeouts')
+            raise LdapUnavailable("Ldap did not answer in time.")
+        except Exception as error:
+            self._connectors.put(None)
+            self._failed('errors')
+            raise LdapUnavailable("Ldap error: %s" % error) from error
+
+        self._connectors.put(connector)
+        self._succeeded()
+        return result
+
+    def _get_connector(self):
+        """Take a connector (or an empty slot) from the pool."""
+        self._check_circuit()
+        try:
+            return self._connectors.get(timeout=self.timeout)
+        except Empty:
+            self._count('exhausted')
+            raise LdapUnavailable("No ldap connector available.")
+
+    @staticmethod
+    def _run(connector, method, args, kwargs):
+        result = getattr(connector, method)(*args, **kwargs)
+        if method == 'search':
+            # Results may be fetched lazily, fetch them within the timeout
+            result = list(result)
+        return result
+
+    def _check_circuit(self):
+        with self._lock:
+            if self._open_until is not None:
+                if monotonic() < self._open_until:
+                    self.stats['rejected'] += 1
+                    raise LdapUnavailable("Ldap circuit is open.")
+                # Try again, the next failure opens the circuit again
+                self._open_until = None
+
+    def _failed(self, key):
+        with self._lock:
+            self.stats[key] += 1
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = monotonic() + self.reset_timeout
+                self.stats['opened'] += 1
+
+    def _succeeded(self):
+        with self._lock:
+            self.stats['calls'] += 1
+            self._failures = 0
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Outbox for mails sent by the API.
+
+`amivapi.utils.mail` does not talk to the SMTP server, it only stores the mail
+in the `outbox` collection. This keeps requests fast, as they do not need to
+wait for the SMTP server.
+
+Queued mails are sent by `send_queued_mails`, which runs periodically with the
+scheduled tasks (`amivapi cron`). To send mails without delay, a dedicated
+worker can be started with `amivapi send_mails --continuous`. Both can run at
+the same time, mails are claimed before they are sent.
+
+Mails are sent in batches with a single SMTP connection. If sending fails,
+the mail is retried later, with the delay doubling for every attempt
+(`MAIL_RETRY_DELAY`), until `MAIL_MAX_ATTEMPTS` is reached. The status of
+every mail is kept in the outbox:
+
+- `pending`: Waiting to be sent (again) at `next_attempt`
+- `sending`: Claimed by a sender. If the sender crashes, the mail becomes
+  pending again after `MAIL_SEND_TIMEOUT`
+- `sent`: Sent successfully at `sent_time`, removed after
+  `MAIL_OUTBOX_RETENTION`
+- `failed`: Could not be sent, see `error`
+"""
+
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+import smtplib
+
+from flask import current_app
+from pymongo import ReturnDocument
+
+from amivapi.cron import periodic
+from amivapi.indexes import expiry_index, register_indexes
+
+
+def queue_mail(sender, to, subject, text):
+    """Add a mail to the outbox.
+
+    Args:
+        sender (str): Sender address
+        to (list of str): Recipient addresses
+        subject (str): Subject, already formatted
+        text (str): Mail content
+    """
+    now = datetime.utcnow()
+    current_app.data.driver.db['outbox'].insert_one({
+        'sender': sender,
+        'receivers': [to] if isinstance(to, str) else list(to),
+        'subject': subject,
+        'text': text,
+        'status': 'pending',
+        'attempts': 0,
+        'created': now,
+        'next_attempt': now,
+    })
+
+
+def send_queued_mails():
+    """Send all mails which are due in batches.
+
+    Needs an app context.
+
+    Returns:
+        int: Number of successfully sent mails.
+    """
+    total = 0
+    while True:
+        batch = _claim_batch(current_app.config['MAIL_BATCH_SIZE'])
+        if not batch:
+            return total
+        total += _send_batch(batch)
+
+
+@periodic(timedelta(minutes=1))
+def send_mails_periodically():
+    """Send queued mails with the scheduled tasks."""
+    send_queued_mails()
+
+
+def _claim_batch(size):
+    """Mark up to `size` mails which are due as `sending` and return them."""
+    outbox = current_app.data.driver.db['outbox']
+    now = datetime.utcnow()
+    lease = now + current_app.config['MAIL_SEND_TIMEOUT']
+
+    batch = []
+    while len(batch) < size:
+        # Mails stuck in `sending` have been claimed by a crashed sender
+        mail = outbox.find_one_and_update(
+            {'status': {'$in': ['pending', 'sending']},
+             'next_attempt': {'$lte': now}},
+            {'$set': {'status': 'sending', 'next_attempt': lease}},
+            sort=[('next_attempt', 1)],
+            return_document=ReturnDocument.AFTER)
+        if mail is None:
+            break
+        batch.append(mail)
+
+    return batch
+
+
+def _connect():
+    """Open an authenticated connection to the SMTP server."""
+    config = current_app.config
+    smtp = smtplib.SMTP(config['SMTP_SERVER'],
+                        port=config['SMTP_PORT'],
+                        timeout=config['SMTP_TIMEOUT'])
+    try:
+        if config.get('SMTP_STARTTLS', True):
+            status_code, _ = smtp.starttls()
+            if status_code != 220:
+                raise smtplib.SMTPException("Failed to create secure SMTP "
+                                            "connection!")
+
+        if config.get('SMTP_USERNAME') and config.get('SMTP_PASSWORD'):
+            smtp.login(config['SMTP_USERNAME'], config['SMTP_PASSWORD'])
+        else:
+            smtp.ehlo()
+    except Exception:
+        smtp.close()
+        raise
+
+    return smtp
+
+
+def _send_batch(batch):
+    """Send claimed mails using a single connection.
+
+    Returns:
+        int: Number of successfully sent mails.
+    """
+    try:
+        smtp = _connect()
+    except (smtplib.SMTPException, OSError) as error:
+        current_app.logger.error("SMTP error trying to send mails: %s"
+                                 % error)
+        for mail in batch:
+            _failed(mail, error)
+        return 0
+
+    sent = 0
+    try:
+        for mail in batch:
+            msg = MIMEText(mail['text'])
+            msg['Subject'] = mail['subject']
+            msg['From'] = mail['sender']
+            msg['To'] = ';'.join(mail['receivers'])
+
+            try:
+                smtp.sendmail(mail['sender'], mail['receivers'],
+                              msg.as_string())
+            except smtplib.SMTPRecipientsRefused as error:
+                # Retrying will not help
+                current_app.logger.error(
+                    "Failed to send mail:\nFrom: %s\nTo: %s\nSubject: %s"
+                    % (mail['sender'], mail['receivers'], mail['subject']))
+                _failed(mail, error, permanent=True)
+            except smtplib.SMTPServerDisconnected as error:
+                _failed(mail, error)
+                smtp = _connect()
+            except (smtplib.SMTPException, OSError) as error:
+                current_app.logger.error("SMTP error trying to send mail: %s"
+                                         % error)
+                _failed(mail, error)
+            else:
+                _sent(mail)
+                sent += 1
+    except (smtplib.SMTPException, OSError) as error:
+        # Reconnecting failed, try again with the next batch
+        current_app.logger.error("SMTP error trying to send mails: %s"
+                                 % error)
+        for mail in batch:
+            if mail['status'] == 'sending':
+                _failed(mail, error)
+    finally:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    return sent
+
+
+def _sent(mail):
+    mail['status'] = 'sent'
+    current_app.data.driver.db['outbox'].update_one(
+        {'_id': mail['_id']},
+        {'$set': {'status': 'sent', 'sent_time': datetime.utcnow()},
+         '$inc': {'attempts': 1}})
+
+
+def _failed(mail, error, permanent=False):
+    """Schedule the next attempt or give up."""
+    attempts = mail['attempts'] + 1
+    if permanent or attempts >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        mail['status'] = 'failed'
+        next_attempt = None
+    else:
+        mail['status'] = 'pending'
+        delay = current_app.config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+        next_attempt = datetime.utcnow() + delay
+
+    current_app.data.driver.db['outbox'].update_one(
+        {'_id': mail['_id']},
+        {'$set': {'status': mail['status'],
+                  'attempts': attempts,
+                  'next_attempt': next_attempt,
+                  'error': str(error)}})
+
+
+def init_app(app):
+    """Create indexes for the outbox."""
+    register_indexes(app, 'outbox', {
+        'status_next_attempt': ([('status', 1), ('next_attempt', 1)],
+                                {'background': True}),
+        'sent_time': expiry_index('sent_time',
+                                  app.config['MAIL_OUTBOX_RETENTION']),
+    })
@@ -62,9 +62,16 @@ MAILING_LIST_DIR = None
 REMOTE_MAILING_LIST_ADDRESS = None
 REMOTE_MAILING_LIST_KEYFILE = None
 REMOTE_MAILING_LIST_DIR = './'  # Use home directory on remote by default
+# Command used to connect, e.g. to add options for persistent connections
+REMOTE_MAILING_LIST_SSH_COMMAND = 'ssh'
+# Changes are coalesced and files regenerated once per group after this delay
+MAILING_LIST_DEBOUNCE = timedelta(seconds=5)
 # Signups via email (@email_blueprint.route('/delete_signup/<token>')
 # in email_links.py)
 # DEFINITIVE_DELETE = ''
+# Compiled JSON schemas of events (`additional_fields`) are kept in memory
+EVENT_SCHEMA_CACHE_SIZE = 1000
+EVENT_SCHEMA_CACHE_TTL = timedelta(hours=1)
 
 # SMTP server defaults
 API_MAIL = 'api@amiv.ethz.ch'
@@ -72,23 +79,68 @@ API_MAIL_SUBJECT = "[AMIV] {subject}"
 SMTP_HOST = 'localhost'
 SMTP_PORT = 587
 SMTP_TIMEOUT = 10
+SMTP_STARTTLS = True
+# Mails are queued in an outbox and sent in batches (see outbox.py)
+MAIL_BATCH_SIZE = 100
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_DELAY = timedelta(minutes=1)  # doubled after every attempt
+MAIL_SEND_TIMEOUT = timedelta(minutes=10)  # mails are claimed for this time
+MAIL_OUTBOX_RETENTION = timedelta(days=30)  # keep sent mails for this time
+MAIL_WORKER_INTERVAL = timedelta(seconds=10)  # `amivapi send_mails`
 
 # LDAP
 LDAP_USERNAME = None
 LDAP_PASSWORD = None
+# Connections are pooled, calls are given up after a timeout and all calls
+# fail immediately for some time after several failures in a row
+LDAP_POOL_SIZE = 4
+LDAP_TIMEOUT = timedelta(seconds=5)
+LDAP_FAILURE_THRESHOLD = 3
+LDAP_RESET_TIMEOUT = timedelta(seconds=30)
+# `amivapi ldap_sync --all` processes users in pages, several chunks at a time
+LDAP_SYNC_PAGE_SIZE = 500
+LDAP_SYNC_WORKERS = 4
 
 # Execution of periodic tasks with `amivapi run cron`
-CRON_INTERVAL = timedelta(minutes=5)  # per default, check tasks every 5 min
+# `amivapi cron --continuous` waits for the next task, but at most 5 min
+CRON_INTERVAL = timedelta(minutes=5)
+# Due tasks are run in parallel and leased while running (see cron.py)
+CRON_WORKERS = 4
+CRON_LEASE = timedelta(minutes=10)  # tasks running longer are run again
+CRON_MAX_ATTEMPTS = 3
+CRON_RETRY_DELAY = timedelta(minutes=1)  # doubled after every attempt
+
+# Deferred hooks are executed after the request (see deferred.py).
+# With more than one worker, hooks may run in a different order.
+DEFERRED_HOOK_WORKERS = 1  # 0 disables deferred execution
+DEFERRED_HOOK_QUEUE_SIZE = 1000
 
 # Security
 ROOT_PASSWORD = u"root"  # Will be overwridden by config.py
 SESSION_TIMEOUT = timedelta(days=365)
+# Sessions are cached in memory to avoid a database lookup for every request.
+# Timestamp updates of cached sessions are collected and written in batches.
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = timedelta(minutes=1)
+# Tokens without session (e.g. API keys) are cached separately
+UNKNOWN_TOKEN_CACHE_SIZE = 1000
+TIMESTAMP_FLUSH_INTERVAL = timedelta(seconds=30)
+# API keys are kept in memory as well, reload them after this time
+APIKEY_CACHE_TTL = timedelta(minutes=1)
+# Permissions granted by groups are cached per user
+GROUP_PERMISSION_CACHE_SIZE = 10000
+GROUP_PERMISSION_CACHE_TTL = timedelta(minutes=1)
 PASSWORD_CONTEXT = CryptContext(
     schemes=["pbkdf2_sha256"],
     pbkdf2_sha256__default_rounds=10 ** 3,
     # min_rounds is used to determine if a hash needs to be upgraded
     pbkdf2_sha256__min_rounds=8 * 10 ** 2,
 )
+# Passwords can be hashed and verified in worker processes (see hashing.py).
+# This only helps threaded servers, bjoern serves one request at a time.
+PASSWORD_HASH_WORKERS = 0  # 0 hashes passwords in the request thread
+PASSWORD_HASH_QUEUE_SIZE = 100
+PASSWORD_HASH_TIMEOUT = timedelta(seconds=5)  # wait for a place in the queue
 
 # Newsletter subscriber list view authorization
 SUBSCRIBER_LIST_USERNAME = None
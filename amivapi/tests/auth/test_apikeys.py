@@ -105,6 +105,30 @@ class ApiKeyPermissionsTest(WebTest):
 
         self.api.get('/apikeys', token=token, status_code=403)
 
+    def test_modified_keys_take_effect_immediately(self):
+        """Test that the cached keys are reloaded if keys are modified."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        token = key['token']
+        item_url = '/apikeys/%s' % key['_id']
+        root = self.get_root_token()
+
+        self.api.post('/apikeys', data={}, token=token, status_code=403)
+
+        key = self.api.patch(item_url,
+                             data={'permissions': {'apikeys': 'readwrite'}},
+                             headers={'If-Match': key['_etag']},
+                             token=root, status_code=200).json
+        self.api.get(item_url, token=token, status_code=200)
+        self.api.patch(item_url, data={'name': 'renamed'},
+                       headers={'If-Match': key['_etag']},
+                       token=token, status_code=200)
+
+        self.api.delete(item_url,
+                        headers={'If-Match': self.api.get(
+                            item_url, token=root).json['_etag']},
+                        token=root, status_code=204)
+        self.api.get('/apikeys', token=token, status_code=401)
+
 
 class ApiKeyModelTests(WebTestNoAuth):
     """Test that tokens are correctly generated and permissions validation."""
@@ -7,29 +7,23 @@
 """ Test that sessions get cleaned up after enough time passed. """
 
 from datetime import timedelta
-from freezegun import freeze_time
 
-from amivapi.cron import run_scheduled_tasks
+from amivapi.bootstrap import create_app
 from amivapi.tests.utils import WebTest
 
 
 class TestSessionExpiry(WebTest):
-    def test_session_expiry(self):
-        with self.app.app_context(), freeze_time() as frozen_time:
-            self.new_object("users", nethz="pablo", password="password")
-            self.api.post('/sessions',
-                          data={"username": "pablo", "password": "password"},
-                          status_code=201)
-
-            frozen_time.tick(delta=self.app.config['SESSION_TIMEOUT'] -
-                             timedelta(days=1))
-            run_scheduled_tasks()
+    def assertExpiry(self, timeout):
+        info = self.db['sessions'].index_information()['_updated']
+        self.assertEqual(info['key'], [('_updated', 1)])
+        self.assertEqual(info['expireAfterSeconds'], timeout.total_seconds())
 
-            self.assertEqual(
-                self.app.data.driver.db['sessions'].count_documents({}), 1)
+    def test_session_expiry(self):
+        """Test that sessions expire with a TTL index on `_updated`."""
+        self.assertExpiry(self.app.config['SESSION_TIMEOUT'])
 
-            frozen_time.tick(delta=timedelta(days=2))
-            run_scheduled_tasks()
+    def test_changed_timeout(self):
+        """Test that the index is updated if the timeout changes."""
+        create_app(**dict(self.test_config, SESSION_TIMEOUT=timedelta(days=1)))
 
-            self.assertEqual(
-                self.app.data.driver.db['sessions'].count_documents({}), 0)
+        self.assertExpiry(timedelta(days=1))
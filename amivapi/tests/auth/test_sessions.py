@@ -4,7 +4,10 @@
 #          you to buy us beer if we meet and you like the software.
 """Tests for session."""
 
+from datetime import datetime, timedelta
+
 from bson import ObjectId
+from freezegun import freeze_time
 from passlib.context import CryptContext
 from passlib.hash import pbkdf2_sha256
 
@@ -268,3 +271,60 @@ class PasswordVerificationTest(WebTest):
 
         # Check database
         self.assertRehashed(user_id, password, weak_hash)
+
+
+class SessionCacheTest(WebTest):
+    """Test that sessions are cached and timestamps are written in batches."""
+
+    def _updated_in_db(self, token):
+        return self.db['sessions'].find_one({'token': token})['_updated']
+
+    def test_timestamp_updates_are_buffered(self):
+        """Only the first request writes the timestamp immediately."""
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+
+        with freeze_time("2017-01-01 00:00:00") as frozen_time:
+            self.api.get('/sessions', token=token, status_code=200)
+            first_update = self._updated_in_db(token)
+
+            frozen_time.tick(delta=timedelta(seconds=10))
+            self.api.get('/sessions', token=token, status_code=200)
+            # Cached, update is not written yet
+            self.assertEqual(self._updated_in_db(token), first_update)
+
+            frozen_time.tick(delta=self.app.config['TIMESTAMP_FLUSH_INTERVAL'])
+            self.api.get('/sessions', token=token, status_code=200)
+            self.assertEqual(self._updated_in_db(token),
+                             datetime(2017, 1, 1, 0, 0, 40))
+
+    def test_unknown_tokens_do_not_evict_sessions(self):
+        """Invalid tokens are cached separately from sessions."""
+        self.app.config['session_cache'].maxsize = 2
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+        self.api.get('/sessions', token=token, status_code=200)
+
+        for index in range(5):
+            self.api.get('/sessions', token='invalid%i' % index,
+                         status_code=401)
+
+        self.assertIsNotNone(self.app.config['session_cache'].get(token))
+        self.assertIsNotNone(
+            self.app.config['unknown_token_cache'].get('invalid4'))
+
+    def test_deleted_user_sessions_are_invalidated(self):
+        """Sessions of a deleted user cannot be used anymore."""
+        user = self.new_object('users')
+        tokens = [self.get_user_token(user['_id']) for _ in range(2)]
+        for token in tokens:
+            self.api.get('/users/%s' % user['_id'], token=token,
+                         status_code=200)
+
+        self.api.delete('/users/%s' % user['_id'],
+                        token=self.get_root_token(),
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        for token in tokens:
+            self.api.get('/sessions', token=token, status_code=401)
@@ -4,13 +4,18 @@
 #          you to buy us beer if we meet and you like the software.
 """Tests for blacklist resource."""
 
+from bson import ObjectId
+
 from amivapi.tests.utils import WebTest
+from amivapi.blacklist.emails import send_removed_mail
 from amivapi.cron import (
+    func_str,
     run_scheduled_tasks
 )
 from datetime import datetime
 from datetime import timedelta
 from freezegun import freeze_time
+import pickle
 
 
 class BlacklistEmailTest(WebTest):
@@ -268,3 +273,85 @@ class BlacklistEmailTest(WebTest):
 
             # Since the entry was deleted no mail should be sent
             self.assertEqual(len(self.app.test_mails), 2)
+
+    def test_rescheduled_email_replaces_task(self):
+        """Test that changing the end_time replaces the scheduled mail and
+        that only the id of the entry is stored with the task."""
+        with self.app.app_context(), freeze_time("2017-01-01 00:00:00"):
+            user_id = 24 * '0'
+            blacklist_id = 24 * '1'
+            self.load_fixture({
+                'users': [{'_id': user_id, 'email': "bla@bla.bl"}]
+            })
+            etag = self.load_fixture({
+                'blacklist': [{
+                    '_id': blacklist_id,
+                    'user': user_id,
+                    'reason': "Test1",
+                    'end_time': "2017-01-02T00:00:00Z", }]
+            })[0]['_etag']
+
+            for end_time in ('2017-01-03T00:00:00Z', '2017-01-04T00:00:00Z'):
+                etag = self.api.patch(
+                    "/blacklist/%s" % blacklist_id,
+                    data={'end_time': end_time},
+                    headers={'If-Match': etag}, token=self.get_root_token(),
+                    status_code=200).json['_etag']
+
+            tasks = list(self.db['scheduled_tasks'].find(
+                {'function': func_str(send_removed_mail)}))
+            self.assertEqual(len(tasks), 1)
+            self.assertEqual(tasks[0]['time'], datetime(2017, 1, 4))
+            self.assertEqual(pickle.loads(tasks[0]['args']), (blacklist_id,))
+
+            # Removing the end time cancels the mail
+            self.api.patch("/blacklist/%s" % blacklist_id,
+                           data={'end_time': None},
+                           headers={'If-Match': etag},
+                           token=self.get_root_token(), status_code=200)
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': func_str(send_removed_mail)}), 0)
+
+    def test_removed_email_for_correct_entry(self):
+        """Test that scheduled and immediate removal mails are sent for the
+        right entry, if there are entries of other users."""
+        with self.app.app_context(), freeze_time(
+                "2017-01-01 00:00:00") as frozen_time:
+            self.load_fixture({
+                'users': [{'_id': 24 * '0', 'email': "other@bla.bl"},
+                          {'_id': 24 * '2', 'email': "bla@bla.bl"}]
+            })
+            self.load_fixture({
+                'blacklist': [{
+                    '_id': 24 * '1',
+                    'user': 24 * '0',
+                    'reason': "Other",
+                    'end_time': datetime(2018, 1, 1)
+                }, {
+                    '_id': 24 * '3',
+                    'user': 24 * '2',
+                    'reason': "Test1",
+                    'end_time': datetime(2017, 1, 2)
+                }]
+            })
+            del self.app.test_mails[:]
+
+            frozen_time.tick(delta=timedelta(days=1))
+            run_scheduled_tasks()
+
+            self.assertEqual(len(self.app.test_mails), 1)
+            self.assertEqual(self.app.test_mails[0]['receivers'],
+                             'bla@bla.bl')
+            self.assertIn('Test1', self.app.test_mails[0]['text'])
+
+            # Resolve the entry immediately
+            entry = self.db['blacklist'].find_one({'_id': ObjectId(24 * '3')})
+            self.api.patch("/blacklist/%s" % (24 * '3'),
+                           data={'end_time': '2017-01-01T00:00:00Z'},
+                           headers={'If-Match': entry['_etag']},
+                           token=self.get_root_token(), status_code=200)
+
+            self.assertEqual(len(self.app.test_mails), 2)
+            self.assertEqual(self.app.test_mails[1]['receivers'],
+                             'bla@bla.bl')
+            self.assertIn('Test1', self.app.test_mails[1]['text'])
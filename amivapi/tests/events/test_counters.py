@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Test that signup counters are stored in events and kept up to date."""
+
+import json
+from unittest.mock import patch
+
+from amivapi.events.counters import recount_signups, reserve_seats
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class SignupCounterTest(WebTestNoAuth):
+    def assertCounters(self, event_id, accepted, unaccepted):
+        event = self.db['events'].find_one({'_id': event_id})
+        self.assertEqual(event['signup_count'], accepted)
+        self.assertEqual(event['unaccepted_count'], unaccepted)
+
+    def test_counters_updated(self):
+        """Test that creating, accepting and deleting signups updates the
+        counters stored in the event."""
+        event = self.new_object('events', spots=1,
+                                selection_strategy='fcfs')
+        self.assertCounters(event['_id'], 0, 0)
+
+        first, second = [
+            self.new_object('eventsignups', event=event['_id'],
+                            user=self.new_object('users')['_id'])
+            for _ in range(2)]
+        self.assertCounters(event['_id'], 1, 1)
+
+        # The second signup moves up from the waiting list
+        self.api.delete('/eventsignups/%s' % first['_id'],
+                        headers={'If-Match': first['_etag']},
+                        status_code=204)
+        self.assertCounters(event['_id'], 1, 0)
+
+        second = self.api.get('/eventsignups/%s' % second['_id'],
+                              status_code=200).json
+        self.api.patch('/eventsignups/%s' % second['_id'],
+                       data={'accepted': False},
+                       headers={'If-Match': second['_etag']},
+                       status_code=200)
+        self.assertCounters(event['_id'], 0, 1)
+
+    def test_counters_updated_on_cascade(self):
+        """Test that all signups of a deleted user are removed from the
+        counters."""
+        user = self.new_object('users')
+        events = [self.new_object('events', spots=0,
+                                  selection_strategy='fcfs')
+                  for _ in range(2)]
+        for event in events:
+            self.new_object('eventsignups', user=user['_id'],
+                            event=event['_id'])
+            self.assertCounters(event['_id'], 1, 0)
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        for event in events:
+            self.assertCounters(event['_id'], 0, 0)
+
+    def test_reserve_seats(self):
+        """Test that no more seats are reserved than spots are left, even if
+        the event changed in the meantime."""
+        event = self.new_object('events', spots=3,
+                                selection_strategy='fcfs')
+        event = self.db['events'].find_one({'_id': event['_id']})
+
+        # Another request reserves a seat, `event` is outdated now
+        with self.app.app_context():
+            self.assertEqual(reserve_seats(event, 1), 1)
+            self.assertEqual(reserve_seats(event, 3), 2)
+            self.assertEqual(reserve_seats(event, 1), 0)
+
+        self.assertCounters(event['_id'], 3, -3)
+
+    def test_recount(self):
+        """Test that the counters can be recomputed."""
+        event = self.new_object('events', spots=1,
+                                selection_strategy='fcfs')
+        empty_event = self.new_object('events')
+        for _ in range(3):
+            self.new_object('eventsignups', event=event['_id'],
+                            user=self.new_object('users')['_id'])
+
+        self.db['events'].update_many({}, {'$set': {'signup_count': 42,
+                                                    'unaccepted_count': 42}})
+
+        with self.app.app_context():
+            self.assertEqual(recount_signups(), 1)
+
+        self.assertCounters(event['_id'], 1, 2)
+        self.assertCounters(empty_event['_id'], 0, 0)
+
+    def test_missing_counters(self):
+        """Test that counters are added to events which have none."""
+        event = self.new_object('events', spots=0,
+                                selection_strategy='fcfs')
+        self.new_object('eventsignups', event=event['_id'],
+                        user=self.new_object('users')['_id'])
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+
+        response = self.api.get('/events/%s' % event['_id'],
+                                status_code=200).json
+        self.assertEqual(response['signup_count'], 1)
+        self.assertEqual(response['unaccepted_count'], 0)
+        self.assertCounters(event['_id'], 1, 0)
+
+    def test_missing_counters_on_signup(self):
+        """Test that signups of events without counters do not start
+        counting from zero, which would overbook the event."""
+        event = self.new_object('events', spots=1,
+                                selection_strategy='fcfs')
+        accepted, waiting = [
+            self.new_object('eventsignups', event=event['_id'],
+                            user=self.new_object('users')['_id'])
+            for _ in range(2)]
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+
+        signup = self.new_object('eventsignups', event=event['_id'],
+                                 user=self.new_object('users')['_id'])
+        self.assertFalse(signup['accepted'])
+        self.assertCounters(event['_id'], 1, 2)
+
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+        self.api.delete('/eventsignups/%s' % signup['_id'],
+                        headers={'If-Match': signup['_etag']},
+                        status_code=204)
+        self.assertCounters(event['_id'], 1, 1)
+
+        # The waiting signup moves up, but no one else
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+        self.api.delete('/eventsignups/%s' % accepted['_id'],
+                        headers={'If-Match': accepted['_etag']},
+                        status_code=204)
+        self.assertCounters(event['_id'], 1, 0)
+        waiting = self.db['eventsignups'].find_one({'_id': waiting['_id']})
+        self.assertTrue(waiting['accepted'])
+
+    def test_projected_counters(self):
+        """Test that counters excluded by the projection are neither counted
+        nor added."""
+        event = self.new_object('events', spots=0,
+                                selection_strategy='fcfs')
+        self.new_object('eventsignups', event=event['_id'],
+                        user=self.new_object('users')['_id'])
+        excluded = json.dumps({'signup_count': 0, 'unaccepted_count': 0})
+
+        with patch('amivapi.events.projections.ensure_signup_counters') \
+                as ensure:
+            response = self.api.get('/events?projection=%s' % excluded,
+                                    status_code=200).json
+            ensure.assert_not_called()
+        self.assertNotIn('signup_count', response['_items'][0])
+        self.assertNotIn('unaccepted_count', response['_items'][0])
+
+        # Old events are counted, but only requested counters are added
+        self.db['events'].update_one(
+            {'_id': event['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+        included = json.dumps({'title_en': 1, 'signup_count': 1})
+        response = self.api.get('/events/%s?projection=%s'
+                                % (event['_id'], included),
+                                status_code=200).json
+        self.assertEqual(response['signup_count'], 1)
+        self.assertNotIn('unaccepted_count', response)
+        self.assertCounters(event['_id'], 1, 0)
@@ -150,6 +150,35 @@ class EventModelTest(WebTestNoAuth):
             })
         }, status_code=201)
 
+    def test_modified_additional_fields_take_effect(self):
+        """Test that signups are validated with the current schema, even if
+        the previous one was cached."""
+        schema = {
+            "$schema": "http://json-schema.org/draft-04/schema#",
+            "type": "object",
+            "additionalProperties": False,
+            'properties': {'field1': {'type': 'string'}},
+            'required': ['field1']
+        }
+        ev = self.new_object("events", spots=100,
+                             additional_fields=json.dumps(schema))
+        user = self.new_object("users")
+        data = {
+            'user': str(user['_id']),
+            'event': str(ev['_id']),
+            'additional_fields': json.dumps({})
+        }
+
+        self.api.post("/eventsignups", data=data, status_code=422)
+
+        del schema['required']
+        self.api.patch('/events/%s' % ev['_id'],
+                       headers={'If-Match': ev['_etag']},
+                       data={'additional_fields': json.dumps(schema)},
+                       status_code=200)
+
+        self.api.post("/eventsignups", data=data, status_code=201)
+
     def test_email_signup_only_when_allowed(self):
         """Test that email signup is only possible if enabled."""
         ev = self.new_object("events", spots=100, allow_email_signup=False)
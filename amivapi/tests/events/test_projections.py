@@ -107,6 +107,32 @@ class EventProjectionTest(WebTestNoAuth):
             self.assertEqual(event['signup_count'], 3)
             self.assertEqual(event['unaccepted_count'], 1)
 
+    def test_signuplist_position_collection(self):
+        """Test that positions are correct for a list of signups of several
+        events, including signups created at the same time"""
+        with freeze_time("2016-01-01 00:00:00") as frozen_time:
+            events = [self.new_object('events', spots=1,
+                                      selection_strategy='fcfs')
+                      for _ in range(2)]
+            users = self.load_fixture({'users': [{} for _ in range(3)]})
+
+            expected = {}
+            for event in events:
+                for index, user in enumerate(users):
+                    signup = self.new_object('eventsignups',
+                                             event=event['_id'],
+                                             user=user['_id'])
+                    # The first two signups are created at the same time
+                    expected[str(signup['_id'])] = max(index + 1, 2)
+                    if index > 0:
+                        frozen_time.tick(delta=timedelta(seconds=1))
+
+            signups = self.api.get('/eventsignups',
+                                   status_code=200).json['_items']
+            self.assertEqual(len(signups), 6)
+            for signup in signups:
+                self.assertEqual(signup['position'], expected[signup['_id']])
+
     def test_signup_email_correct(self):
         """Test that signups display the correct email address"""
         event = self.new_object('events', spots=100)
@@ -126,6 +152,20 @@ class EventProjectionTest(WebTestNoAuth):
                               status_code=200).json
         self.assertEqual(signup['email'], 'testemail@amiv.com')
 
+    def test_signup_email_collection(self):
+        """Test that emails are correct for lists of signups"""
+        event = self.new_object('events', spots=100)
+        users = self.load_fixture({'users': [{} for _ in range(3)]})
+        for user in users:
+            self.new_object('eventsignups', event=event['_id'],
+                            user=user['_id'])
+
+        expected = {str(user['_id']): user['email'] for user in users}
+        signups = self.api.get('/eventsignups', status_code=200).json
+        self.assertEqual(len(signups['_items']), 3)
+        for signup in signups['_items']:
+            self.assertEqual(signup['email'], expected[signup['user']])
+
     def test_confirmed_projected(self):
         """Test that an external signups gets the confirmed field"""
         event = self.new_object('events', spots=100, additional_fields=None,
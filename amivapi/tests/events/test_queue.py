@@ -4,6 +4,13 @@
 #          you to buy us beer if we meet and you like the software.
 """Test that people are correctly added and removed from the waiting list"""
 
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from bson import ObjectId
+
+from amivapi.events import counters
+from amivapi.events.queue import update_waiting_list
 from amivapi.tests.utils import WebTestNoAuth, WebTest
 
 
@@ -138,3 +145,48 @@ class EventsignupQueueTest(WebTestNoAuth):
         self.api.delete('/eventsignups/%s' % signup2['_id'],
                         headers={'If-Match': signup2['_etag']},
                         status_code=204)
+
+    def test_concurrent_accept(self):
+        """Test that seats released because a concurrent request accepted
+        a signup first are given to the next signups on the waiting list."""
+        event_id = ObjectId(self.new_object('events', spots=3,
+                                            selection_strategy='fcfs')['_id'])
+        now = datetime.utcnow()
+        signups = [{
+            'event': event_id,
+            'user': ObjectId(self.new_object('users')['_id']),
+            'accepted': False,
+            'confirmed': True,
+            '_created': now + timedelta(seconds=index),
+        } for index in range(4)]
+        self.db['eventsignups'].insert_many(signups)
+        self.db['events'].update_one({'_id': event_id},
+                                     {'$set': {'unaccepted_count': 4}})
+
+        reserve_seats = counters.reserve_seats
+
+        def interleaved(event, count):
+            if not interleaved.done:
+                # Another request reserves a seat and accepts the first
+                # signup, after this request has read the waiting list
+                interleaved.done = True
+                self.db['eventsignups'].update_one(
+                    {'_id': signups[0]['_id']}, {'$set': {'accepted': True}})
+                self.db['events'].update_one(
+                    {'_id': event_id},
+                    {'$inc': {'signup_count': 1, 'unaccepted_count': -1}})
+            return reserve_seats(event, count)
+        interleaved.done = False
+
+        with self.app.test_request_context(), \
+                patch('amivapi.events.queue.reserve_seats', interleaved):
+            accepted = update_waiting_list(event_id)
+
+        self.assertEqual(set(accepted),
+                         {signups[1]['_id'], signups[2]['_id']})
+        waiting = self.db['eventsignups'].find({'accepted': False})
+        self.assertEqual([signup['_id'] for signup in waiting],
+                         [signups[3]['_id']])
+        event = self.db['events'].find_one({'_id': event_id})
+        self.assertEqual(event['signup_count'], 3)
+        self.assertEqual(event['unaccepted_count'], 1)
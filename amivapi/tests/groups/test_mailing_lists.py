@@ -14,12 +14,13 @@ from os.path import isfile, join
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from unittest.mock import patch, call
+from unittest.mock import patch
 
 from amivapi.tests.utils import WebTestNoAuth, skip_if_false
 
 from amivapi.groups.mailing_lists import (
-    make_files, remove_files, ssh_command, ssh_create, ssh_remove)
+    RegenerationQueue, make_files, recreate_files, remove_files, ssh_command,
+    ssh_create, ssh_remove, sync_files)
 
 
 class MailingListTest(WebTestNoAuth):
@@ -163,6 +164,57 @@ class MailingListTest(WebTestNoAuth):
 
         self.assertFileContent('a', ['new@amiv.ch'])
 
+    def test_recreate_files(self):
+        """Test that all files are recreated, obsolete files removed and
+        unchanged files not written again."""
+        self.load_fixture({
+            'users': [{'_id': 24 * '0', 'email': 'user@amiv.ch'},
+                      {'_id': 24 * '1', 'email': 'other@amiv.ch'}],
+            'groups': [{'_id': 24 * '2', 'receive_from': ['a', 'b'],
+                        'forward_to': ['f@amiv.ch']},
+                       {'_id': 24 * '3', 'receive_from': ['c']},
+                       {'_id': 24 * '4'},
+                       {'_id': 24 * '5', 'receive_from': ['d']}],
+            'groupmemberships': [{'user': 24 * '0', 'group': 24 * '2'},
+                                 {'user': 24 * '1', 'group': 24 * '2'},
+                                 {'user': 24 * '1', 'group': 24 * '3'}]
+        })
+        with open(self._full_name('a'), 'w') as file:
+            file.write('outdated')
+        with open(self._full_name('obsolete'), 'w') as file:
+            file.write('outdated')
+
+        with self.app.app_context():
+            stats = recreate_files()
+
+        self.assertEqual(stats, {'written': 1, 'uploaded': 0, 'removed': 1})
+        for name in 'a', 'b':
+            self.assertFileContent(
+                name, ['f@amiv.ch', 'user@amiv.ch', 'other@amiv.ch'])
+        self.assertFileContent('c', ['other@amiv.ch'])
+        self.assertFileContent('d', [''])
+        self.assertNoFile('obsolete')
+
+    def test_regeneration_queue(self):
+        """Test that changes are coalesced and files are made once per group
+        when the queue is flushed."""
+        queue = RegenerationQueue(self.app, delay=60)
+        with patch('amivapi.groups.mailing_lists.make_files') as make:
+            for _ in range(3):
+                queue.add(24 * '1')
+            queue.add(24 * '2')
+            # Nothing is made before the queue is flushed
+            make.assert_not_called()
+
+            self.assertEqual(queue.flush(), 2)
+            self.assertEqual(queue.flush(), 0)
+
+        self.assertItemsEqual([call[0][0] for call in make.call_args_list],
+                              [24 * '1', 24 * '2'])
+        self.assertEqual(queue.stats['changes'], 4)
+        self.assertEqual(queue.stats['saved'], 2)
+        self.assertEqual(queue.stats['regenerations'], 2)
+
 
 class RemoteMailingListTest(WebTestNoAuth):
     """Test creation and removal of remote mailing list files via ssh.
@@ -182,30 +234,80 @@ class RemoteMailingListTest(WebTestNoAuth):
 
     def test_remote_create_called(self):
         """Test that creating the file over ssh is attempted."""
-        with patch('amivapi.groups.mailing_lists.ssh_create') as create:
+        with patch('amivapi.groups.mailing_lists.ssh_sync') as sync:
             group_id = 24 * '0'
             receive_from = ['a', 'b']
             self.load_fixture({
                 'groups': [{'_id': group_id, 'receive_from': receive_from}]
             })
+            # Forget that the files were uploaded with the new group
+            self.db['mailing_list_files'].delete_many({})
+            sync.reset_mock()
             with self.app.app_context():
                 make_files(group_id)
-                # Both times there will be no content
-                create.assert_has_calls(
-                    [call(address, '') for address in receive_from],
-                    any_order=True
-                )
+                # Both files are uploaded at once, there will be no content
+                sync.assert_called_once_with(
+                    {address: '' for address in receive_from}, [])
 
     def test_remote_remove_called(self):
         """Test that removing the file over ssh is attempted."""
         addresses = ['a', 'b']
-        with patch('amivapi.groups.mailing_lists.ssh_remove') as remove:
+        with patch('amivapi.groups.mailing_lists.ssh_sync') as sync:
             with self.app.app_context():
                 remove_files(addresses)
-                remove.assert_has_calls(
-                    [call(address) for address in addresses],
-                    any_order=True
-                )
+                sync.assert_called_once_with({}, addresses)
+
+
+class FakeSSHMailingListTest(WebTestNoAuth):
+    """Test remote files with an ssh command that runs locally."""
+
+    def setUp(self):
+        """Use a temporary directory as remote directory."""
+        super().setUp()
+        self.directory = mkdtemp(prefix='amivapi_test')
+        self.app.config.update({
+            'REMOTE_MAILING_LIST_ADDRESS': 'remote',
+            'REMOTE_MAILING_LIST_DIR': join(self.directory, 'lists'),
+            # Ignore the address and execute the command locally
+            'REMOTE_MAILING_LIST_SSH_COMMAND':
+                "sh -c 'exec sh -c \"$2\"' fake-ssh",
+        })
+
+    def tearDown(self):
+        rmtree(self.directory, ignore_errors=True)
+        super().tearDown()
+
+    def _remote_file(self, address):
+        return join(self.app.config['REMOTE_MAILING_LIST_DIR'],
+                    self.app.config['MAILING_LIST_FILE_PREFIX'] + address)
+
+    def test_only_changed_files_uploaded(self):
+        """Test that files are uploaded only if the content changed."""
+        files = {'a@amiv.ch': 'x@amiv.ch\n', 'b@amiv.ch': ''}
+
+        with self.app.app_context(), \
+                patch('amivapi.groups.mailing_lists.ssh_command',
+                      wraps=ssh_command) as command:
+            sync_files(files)
+            self.assertEqual(command.call_count, 1)
+            for address, content in files.items():
+                with open(self._remote_file(address)) as file:
+                    self.assertEqual(file.read(), content)
+
+            # Nothing changed, no connection needed
+            sync_files(files)
+            self.assertEqual(command.call_count, 1)
+
+            # Change one file and remove the other in one connection
+            sync_files({'a@amiv.ch': 'y@amiv.ch\n'}, ['b@amiv.ch'])
+            self.assertEqual(command.call_count, 2)
+            with open(self._remote_file('a@amiv.ch')) as file:
+                self.assertEqual(file.read(), 'y@amiv.ch\n')
+            self.assertFalse(isfile(self._remote_file('b@amiv.ch')))
+
+            # Forced upload
+            sync_files({'a@amiv.ch': 'y@amiv.ch\n'}, force=True)
+            self.assertEqual(command.call_count, 3)
 
 
 # Decorator to mark tests to be skipped if ssh envvars are missing.
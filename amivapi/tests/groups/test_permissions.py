@@ -60,3 +60,22 @@ class PermissionsTest(WebTest):
         """Test that 'readwrite' gives admin permissions."""
         self.permission_fixture({'groups': 'read'})
         self.assertAdminReadonly()
+
+    def test_cached_permissions_are_invalidated(self):
+        """Test that changes of groups and memberships apply immediately."""
+        self.permission_fixture({'groups': 'read'})
+        self.assertAdminReadonly()
+
+        group = self.db['groups'].find_one({})
+        root = self.get_root_token()
+        self.api.patch('/groups/%s' % group['_id'],
+                       data={'permissions': {'groups': 'readwrite'}},
+                       headers={'If-Match': group['_etag']},
+                       token=root, status_code=200)
+        self.assertAdmin()
+
+        membership = self.db['groupmemberships'].find_one({})
+        self.api.delete('/groupmemberships/%s' % membership['_id'],
+                        headers={'If-Match': membership['_etag']},
+                        token=root, status_code=204)
+        self.assertNothing()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for in-process caches."""
+
+from datetime import datetime, timedelta
+from time import sleep, time
+
+from amivapi.cache import (
+    TimestampBuffer,
+    _flush_timestamp_buffers,
+    find_one_cached,
+    forget_cached_document
+)
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class RequestCacheTest(WebTestNoAuth):
+    def test_document_loaded_once_per_request(self):
+        """Test that documents are cached within a request only."""
+        event = self.new_object('events')
+
+        with self.app.app_context():
+            with self.app.test_request_context():
+                first = find_one_cached('events', event['_id'])
+                self.assertIs(find_one_cached('events', str(event['_id'])),
+                              first)
+
+                forget_cached_document('events', event['_id'])
+                second = find_one_cached('events', event['_id'])
+                self.assertIsNot(second, first)
+                self.assertEqual(second, first)
+
+            # A new request in the same app context starts with empty cache
+            with self.app.test_request_context():
+                self.assertIsNot(find_one_cached('events', event['_id']),
+                                 second)
+
+    def test_updates_invalidate_cache(self):
+        """Test that modifying a document through eve removes it from the
+        cache."""
+        event = self.new_object('events', title_en='old')
+
+        with self.app.test_request_context():
+            self.assertEqual(
+                find_one_cached('events', event['_id'])['title_en'], 'old')
+
+            self.db['events'].update_one({'_id': event['_id']},
+                                         {'$set': {'title_en': 'new'}})
+            self.app.on_updated('events', {'title_en': 'new'}, event)
+
+            self.assertEqual(
+                find_one_cached('events', event['_id'])['title_en'], 'new')
+
+
+class TimestampBufferTest(WebTestNoAuth):
+    def _updated(self, _id):
+        return self.db['sessions'].find_one({'_id': _id})['_updated']
+
+    def test_flushed_without_requests(self):
+        """Test that pending timestamps are written after the interval, even
+        if no further updates arrive, and when the process exits."""
+        ids = self.db['sessions'].insert_many([
+            {'_updated': datetime(2017, 1, 1)} for _ in range(2)
+        ]).inserted_ids
+        later = datetime(2017, 1, 2)
+
+        buffer = TimestampBuffer(self.app, 'sessions',
+                                 timedelta(milliseconds=100))
+        buffer.touch(ids[0], later)
+        self.assertEqual(self._updated(ids[0]), datetime(2017, 1, 1))
+
+        deadline = time() + 5
+        while self._updated(ids[0]) != later and time() < deadline:
+            sleep(0.05)
+        self.assertEqual(self._updated(ids[0]), later)
+
+        buffer = TimestampBuffer(self.app, 'sessions', timedelta(hours=1))
+        buffer.touch(ids[1], later)
+        _flush_timestamp_buffers()
+        self.assertEqual(self._updated(ids[1]), later)
@@ -4,8 +4,11 @@
 #          you to buy us beer if we meet and you like the software.
 """Test for cascading deletes"""
 
+from unittest.mock import MagicMock
+
 from bson import ObjectId
 
+from amivapi.cascade import Reference
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -51,3 +54,51 @@ class CascadingDeleteTest(WebTestNoAuth):
         session_count = self.db['sessions'].count_documents({
             'user': ObjectId('deadbeefdeadbeefdeadbeef')})
         self.assertEqual(session_count, 0)
+
+    def test_reference_graph(self):
+        """Test that references are collected once per resource."""
+        graph = self.app.config['cascade_graph']
+
+        self.assertIn(Reference('sessions', 'user', True, True),
+                      graph['users'])
+        self.assertIn(Reference('groups', 'moderator', False, True),
+                      graph['users'])
+        # Studydocs have media files, which need Eve to be deleted
+        self.assertIn(Reference('studydocs', 'uploader', False, False),
+                      graph['users'])
+
+    def test_bulk_cascade(self):
+        """Test that all referencing objects are deleted or updated and
+        hooks run for every object."""
+        user, other = self.load_fixture({'users': [{}, {}]})
+        group = self.new_object('groups', moderator=user['_id'])
+        self.load_fixture({
+            'groupmemberships': [{'user': user['_id'], 'group': group['_id']},
+                                 {'user': other['_id'],
+                                  'group': group['_id']}],
+            'sessions': [{'username': user['nethz']} for _ in range(3)],
+        })
+
+        deleted_sessions = MagicMock()
+        updated_groups = MagicMock()
+        self.app.on_deleted_item_sessions += deleted_sessions
+        self.app.on_updated_groups += updated_groups
+
+        self.api.delete("/users/%s" % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.assertEqual(deleted_sessions.call_count, 3)
+        self.assertEqual(updated_groups.call_count, 1)
+        self.assertEqual(self.db['sessions'].count_documents({}), 0)
+        self.assertEqual(self.db['groupmemberships'].count_documents(
+            {'user': ObjectId(other['_id'])}), 1)
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 1)
+
+        # The group is updated with a new etag
+        updated = self.db['groups'].find_one({'_id': ObjectId(group['_id'])})
+        self.assertIsNone(updated['moderator'])
+        self.assertNotEqual(updated['_etag'], group['_etag'])
+        self.api.patch("/groups/%s" % group['_id'], data={'name': 'new'},
+                       headers={'If-Match': updated['_etag']},
+                       status_code=200)
@@ -7,17 +7,24 @@
 """ Test scheduler """
 
 from datetime import datetime, timedelta
+import pickle
+from threading import Thread
+from time import sleep, time
+
+from bson import ObjectId
 from freezegun import freeze_time
 
 from amivapi import cron
 from amivapi.cron import (
     NotSchedulable,
+    cancel_task,
     periodic,
     run_scheduled_tasks,
     schedulable,
     schedule_once_soon,
     schedule_task,
-    update_scheduled_task
+    update_scheduled_task,
+    wait_for_tasks
 )
 from amivapi.tests.utils import WebTestNoAuth
 
@@ -139,3 +146,185 @@ class CronTest(WebTestNoAuth):
 
             self.assertTrue(CronTest.has_run)
             self.assertEqual(CronTest.received_arg, "new-arg")
+
+    def test_failed_task_is_retried(self):
+        """Test that a failed task is retried later until the maximum number
+        of attempts is reached."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def failing():
+                CronTest.run_count += 1
+                raise ValueError()
+
+            schedule_task(datetime.utcnow(), failing)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            task = self.db['scheduled_tasks'].find_one(
+                {'function': cron.func_str(failing)})
+            self.assertEqual(task['attempts'], 1)
+            self.assertIsNone(task['locked_until'])
+
+            # Not retried before the delay has passed
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            for _ in range(self.app.config['CRON_MAX_ATTEMPTS']):
+                frozen_time.tick(delta=timedelta(hours=1))
+                run_scheduled_tasks()
+
+            self.assertEqual(CronTest.run_count,
+                             self.app.config['CRON_MAX_ATTEMPTS'])
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': task['function']}), 0)
+
+    def test_unknown_function_removed(self):
+        """Test that a task whose function does not exist anymore is removed
+        without crashing the scheduler."""
+        self.db['scheduled_tasks'].insert_one({
+            'time': datetime.utcnow(),
+            'function': 'amivapi.removed.function',
+            'args': pickle.dumps(()),
+        })
+
+        with self.app.app_context():
+            run_scheduled_tasks()
+
+        self.assertEqual(self.db['scheduled_tasks'].count_documents(
+            {'function': 'amivapi.removed.function'}), 0)
+
+    def test_removed_function_tasks_deleted(self):
+        """Test that tasks of functions removed from the code are deleted
+        when the app starts."""
+        self.db['scheduled_tasks'].insert_one({
+            'time': datetime.utcnow(),
+            'function': cron.removed_functions[0],
+            'args': pickle.dumps(()),
+        })
+
+        cron.init_app(self.app)
+
+        self.assertEqual(self.db['scheduled_tasks'].count_documents(
+            {'function': cron.removed_functions[0]}), 0)
+
+    def test_leased_task(self):
+        """Test that a task leased by another worker is only executed once
+        the lease has expired, e.g. because the other worker crashed."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def leased():
+                CronTest.run_count += 1
+
+            schedule_task(datetime.utcnow(), leased)
+            self.db['scheduled_tasks'].update_one(
+                {'function': cron.func_str(leased)},
+                {'$set': {'worker_id': 'crashed',
+                          'locked_until': datetime.utcnow() +
+                          self.app.config['CRON_LEASE'],
+                          'attempts': 1}})
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 0)
+
+            frozen_time.tick(delta=self.app.config['CRON_LEASE'])
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': cron.func_str(leased)}), 0)
+
+    def test_wait_for_next_task(self):
+        """Test that workers wait until the next task is due."""
+        # Remove periodic tasks, which are due immediately
+        self.db['scheduled_tasks'].delete_many({})
+
+        with self.app.app_context():
+            @schedulable
+            def soon():
+                pass
+
+            start = time()
+            wait_for_tasks(timedelta(milliseconds=500))
+            self.assertGreaterEqual(time() - start, 0.5)
+
+            schedule_task(datetime.utcnow() + timedelta(seconds=1), soon)
+            start = time()
+            wait_for_tasks(timedelta(minutes=1))
+            self.assertLess(time() - start, 10)
+
+    def test_wait_for_new_task(self):
+        """Test that waiting workers wake up if a task is scheduled."""
+        self.db['scheduled_tasks'].delete_many({})
+
+        @schedulable
+        def new():
+            pass
+
+        def wait():
+            with self.app.app_context():
+                wait_for_tasks(timedelta(minutes=1))
+
+        start = time()
+        waiting = Thread(target=wait)
+        waiting.start()
+        sleep(0.5)
+
+        with self.app.app_context():
+            schedule_task(datetime.utcnow(), new)
+        waiting.join(timeout=10)
+
+        self.assertFalse(waiting.is_alive())
+        self.assertLess(time() - start, 10)
+
+    def test_wait_for_signal_with_lower_id(self):
+        """Test that signals are read in insertion order, even if the id
+        (generated by another process) is lower than the id of the last
+        signal."""
+        self.db['scheduled_tasks'].delete_many({})
+
+        def wait():
+            with self.app.app_context():
+                wait_for_tasks(timedelta(minutes=1))
+
+        waiting = Thread(target=wait)
+        waiting.start()
+        sleep(1)
+
+        self.db['scheduled_task_signals'].insert_one({
+            '_id': ObjectId.from_datetime(datetime(2000, 1, 1)),
+            'time': datetime.utcnow(),
+        })
+        waiting.join(timeout=10)
+
+        self.assertFalse(waiting.is_alive())
+
+    def test_keyed_task_replaced(self):
+        """Test that a task with the same key replaces the earlier task and
+        can be cancelled."""
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def keyed(arg):
+                CronTest.run_count += 1
+                CronTest.received_arg = arg
+
+            schedule_task(datetime(2016, 1, 1, 1), keyed, 'first', key='k')
+            schedule_task(datetime(2016, 1, 1, 2), keyed, 'second', key='k')
+            self.assertEqual(
+                self.db['scheduled_tasks'].count_documents({'key': 'k'}), 1)
+
+            frozen_time.tick(delta=timedelta(hours=1))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 0)
+
+            frozen_time.tick(delta=timedelta(hours=1))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+            self.assertEqual(CronTest.received_arg, 'second')
+
+            schedule_task(datetime(2016, 1, 1, 3), keyed, 'third', key='k')
+            cancel_task('k')
+            frozen_time.tick(delta=timedelta(hours=2))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for deferred hooks."""
+
+from threading import Event
+
+from flask import g, request
+
+from amivapi.deferred import DeferredHooks, deferred
+from amivapi.tests.utils import WebTest
+
+
+class DeferredHookTest(WebTest):
+    def test_hooks_collected_during_request(self):
+        """Test that deferred hooks are collected with a copy of their
+        arguments, and run immediately outside of requests."""
+        calls = []
+
+        @deferred
+        def hook(items):
+            calls.append(items)
+
+        with self.app.test_request_context():
+            hook([1])
+            self.assertEqual(calls, [[1]])
+
+            g.deferred_hooks = []
+            items = [2]
+            hook(items)
+            items.append(3)
+            self.assertEqual(calls, [[1]])
+            self.assertEqual(len(g.deferred_hooks), 1)
+            self.assertEqual(g.deferred_hooks[0][1], ([2],))
+
+    def test_worker_pool(self):
+        """Test that hooks run with a request context, failures are counted
+        and a full queue leads to immediate execution."""
+        hooks = DeferredHooks(self.app, workers=1, queue_size=0)
+        blocked = Event()
+        done = Event()
+        urls = []
+
+        def blocking():
+            blocked.wait(timeout=5)
+
+        def record():
+            urls.append(request.url_root)
+            done.set()
+
+        def failing():
+            raise ValueError()
+
+        hooks.submit(blocking, (), 'http://api.example.com/')
+        # The single worker is busy, so this is executed immediately
+        hooks.submit(failing, (), 'http://api.example.com/')
+        self.assertEqual(hooks.stats['inline'], 1)
+        self.assertEqual(hooks.stats['failed'], 1)
+
+        blocked.set()
+        hooks._executor.shutdown(wait=True)
+        self.assertEqual(hooks.stats['completed'], 1)
+
+        hooks = DeferredHooks(self.app, workers=1, queue_size=0)
+        hooks.submit(record, (), 'http://api.example.com/')
+        self.assertTrue(done.wait(timeout=5))
+        self.assertEqual(urls, ['http://api.example.com/'])
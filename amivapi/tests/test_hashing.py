@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for password hashing in worker processes."""
+
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable
+
+from amivapi.hashing import PasswordHasher
+from amivapi.tests.utils import WebTest
+
+
+class PasswordHasherTest(WebTest):
+    def setUp(self):
+        super().setUp()
+        self.context = CryptContext(schemes=["pbkdf2_sha256"],
+                                    pbkdf2_sha256__default_rounds=10,
+                                    pbkdf2_sha256__min_rounds=5)
+
+    def test_worker_processes(self):
+        """Test hashing and verifying in a worker process."""
+        hasher = PasswordHasher(self.context, workers=1, queue_size=1,
+                                timeout=1)
+        hashed = hasher.hash('secret')
+
+        self.assertTrue(self.context.verify('secret', hashed))
+        self.assertTrue(hasher.verify('secret', hashed))
+        self.assertFalse(hasher.verify('wrong', hashed))
+        self.assertFalse(hasher.needs_update(hashed))
+        self.assertTrue(hasher.needs_update(
+            self.context.hash('secret', rounds=1)))
+
+    def test_full_queue(self):
+        """Test that requests are rejected if the queue is full."""
+        hasher = PasswordHasher(self.context, workers=1, queue_size=0,
+                                timeout=0.01)
+        # Occupy the only worker
+        hasher._slots.acquire()
+
+        with self.app.test_request_context():
+            with self.assertRaises(ServiceUnavailable):
+                hasher.hash('secret')
+
+        hasher._slots.release()
+        self.assertTrue(hasher.verify('secret', hasher.hash('secret')))
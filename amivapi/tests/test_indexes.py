@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Test index management."""
+
+from amivapi.indexes import check_indexes, declared_indexes, ensure_indexes
+from amivapi.tests.utils import WebTest
+
+
+class IndexTest(WebTest):
+    """Test that declared indexes are created and drift is detected."""
+
+    def test_hot_lookups_are_indexed(self):
+        declared = declared_indexes(self.app)
+
+        self.assertIn('token', declared['sessions'])
+        self.assertIn('token', declared['apikeys'])
+        self.assertIn('client_id', declared['oauthclients'])
+        self.assertIn('time', declared['scheduled_tasks'])
+
+        with self.app.app_context():
+            report = check_indexes(self.app)
+        self.assertEqual(report, {'missing': [], 'changed': [],
+                                  'obsolete': []})
+
+    def test_unique_tokens(self):
+        info = self.db['sessions'].index_information()
+        self.assertTrue(info['token'].get('unique'))
+
+    def test_ensure_indexes(self):
+        """Missing, changed and obsolete indexes are fixed."""
+        self.db['sessions'].drop_index('token')
+        self.db['sessions'].create_index('token', name='token')
+        self.db['apikeys'].drop_index('token')
+        self.db['apikeys'].create_index('name', name='obsolete')
+
+        with self.app.app_context():
+            report = check_indexes(self.app)
+            self.assertEqual(report['missing'], [('apikeys', 'token')])
+            self.assertEqual(report['changed'], [('sessions', 'token')])
+            self.assertEqual(report['obsolete'], [('apikeys', 'obsolete')])
+
+            ensure_indexes(self.app)
+            self.assertEqual(check_indexes(self.app),
+                             {'missing': [], 'changed': [], 'obsolete': []})
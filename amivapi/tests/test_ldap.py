@@ -11,13 +11,15 @@ There is another file, "ldap_integration.py", which can be used to test
 integration with the real ldap. More info there.
 """
 
-from unittest.mock import MagicMock, patch, call
+from unittest.mock import MagicMock, patch
+import re
 import warnings
 
 from os import getenv
 from pprint import pformat
 
 from amivapi import ldap
+from amivapi.ldap_pool import LdapPool, LdapUnavailable
 from amivapi.tests.utils import WebTest, WebTestNoAuth, skip_if_false
 
 
@@ -32,10 +34,12 @@ class LdapTest(WebTestNoAuth):
         self.mock_ldap = self.app.config['ldap_connector'] = MagicMock()
 
     def test_init_app(self):
-        """Test that init app uses correct credentials stored connector."""
+        """Test that init app stores a pool creating connectors with the
+        correct credentials."""
         ldap_user = 'test'
         ldap_pass = 'T3ST'
-        initialized_ldap = 'I totally am an ldap instance.'
+        initialized_ldap = MagicMock()
+        initialized_ldap.authenticate.return_value = True
 
         self.app.config['LDAP_USERNAME'] = ldap_user
         self.app.config['LDAP_PASSWORD'] = ldap_pass
@@ -43,10 +47,31 @@ class LdapTest(WebTestNoAuth):
 
         with patch(to_patch, return_value=initialized_ldap) as init:
             ldap.init_app(self.app)
+            pool = self.app.config['ldap_connector']
+            self.assertIsInstance(pool, LdapPool)
 
+            # Connectors are created on demand
+            init.assert_not_called()
+            self.assertTrue(pool.authenticate('user', 'pass'))
             init.assert_called_with(ldap_user, ldap_pass)
-            self.assertEqual(self.app.config['ldap_connector'],
-                             initialized_ldap)
+            initialized_ldap.authenticate.assert_called_with('user', 'pass')
+
+    def test_ldap_unavailable(self):
+        """Test that users can log in with their password if the ldap is
+        not available, and that ldap users without stored password can
+        still log in if only the sync fails."""
+        self.new_object('users', nethz='pablo', password='p4bl0')
+        login_data = {'username': 'pablo', 'password': 'p4bl0'}
+        unavailable = LdapUnavailable("Ldap did not answer in time.")
+
+        self.mock_ldap.authenticate = MagicMock(side_effect=unavailable)
+        self.api.post("/sessions", data=login_data, status_code=201)
+
+        self.mock_ldap.authenticate = MagicMock(return_value=True)
+        with patch('amivapi.ldap.sync_one', side_effect=unavailable):
+            self.api.post("/sessions", data=login_data, status_code=201)
+            login_data['username'] = 'unknown'
+            self.api.post("/sessions", data=login_data, status_code=503)
 
     def test_ldap_auth(self):
         """Test that ldap can authenticate a user."""
@@ -214,6 +239,26 @@ class LdapTest(WebTestNoAuth):
             else:
                 self.assertEqual(result[field], db_value)
 
+    def test_update_unchanged_user(self):
+        """Test that nothing is written if the ldap data did not change."""
+        user = self.new_object('users', **self.fake_filtered_data())
+
+        with patch('amivapi.ldap.patch_internal') as patch_user:
+            with self.app.test_request_context():
+                result = ldap._create_or_update_user(
+                    self.fake_filtered_data())
+
+        patch_user.assert_not_called()
+        self.assertEqual(result['_id'], user['_id'])
+
+        # Only changed fields are patched
+        with patch('amivapi.ldap.patch_internal') as patch_user:
+            with self.app.test_request_context():
+                ldap._create_or_update_user(
+                    dict(self.fake_filtered_data(), firstname='Q'))
+
+        self.assertEqual(patch_user.call_args[0][1], {'firstname': 'Q'})
+
     def test_upgrade_membership(self):
         # Insert non-member and upgrade by ldap later
         user = self.api.post('/users', data={
@@ -292,22 +337,162 @@ class LdapTest(WebTestNoAuth):
                 mock_create.assert_not_called()
 
     def test_sync_all(self):
-        """Test if sync_all builds the query correctly and creates users."""
+        """Test if sync_all builds the chunk queries correctly."""
         # Shorten ou list
         self.app.config['LDAP_DEPARTMENT_MAP'] = {'a': 'itet'}
-        expected_query = '(& (ou=VSETH Mitglied) (| (departmentNumber=*a*)) )'
-        search_results = (i for i in [1, 2])
-        search = 'amivapi.ldap._search'
-        create = 'amivapi.ldap._create_or_update_user'
+        fake = self.app.config['ldap_connector'] = FakeLdap([])
 
-        with patch(search, return_value=search_results) as mock_search:
-            with patch(create, return_value=3) as mock_create:
-                with self.app.app_context():
-                    result = ldap.sync_all()
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result, {'created': 0, 'updated': 0, 'unchanged': 0})
+        self.assertIn(
+            '(& (ou=VSETH Mitglied) (| (departmentNumber=*a*)) (cn=p*))',
+            fake.queries)
+        # One query for every character and one for all other names
+        self.assertEqual(len(fake.queries),
+                         len(ldap.SYNC_CHUNK_CHARACTERS) + 1)
+
+    def fake_ldap_users(self):
+        """Ldap data for an unchanged, a changed and a new user."""
+        return [
+            self.fake_ldap_data(),
+            self.fake_ldap_data(cn=['changed'],
+                                swissEduPersonMatriculationNumber='11111111'),
+            self.fake_ldap_data(cn=['new'],
+                                swissEduPersonMatriculationNumber='22222222'),
+        ]
 
-                mock_search.assert_called_with(expected_query)
-                mock_create.assert_has_calls([call(1), call(2)])
-                self.assertEqual(result, [3, 3])
+    def test_sync_all_diff(self):
+        """Test that sync_all only writes new and changed users and calls
+        the update hooks only for changed users."""
+        self.app.config['ldap_connector'] = FakeLdap(self.fake_ldap_users())
+        self.new_object('users', **self.fake_filtered_data())
+        self.new_object('users', **dict(self.fake_filtered_data(),
+                                        nethz='changed', legi='11111111',
+                                        email='changed@ethz.ch',
+                                        lastname='Old'))
+
+        changed_etag = self.db['users'].find_one({'nethz': 'changed'})['_etag']
+        hook = MagicMock()
+        self.app.on_updated_users += hook
+
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result, {'created': 1, 'updated': 1, 'unchanged': 1})
+        hook.assert_called_once()
+        self.assertEqual(hook.call_args[0][0]['lastname'], 'Ablo')
+
+        user = self.db['users'].find_one({'nethz': 'changed'})
+        self.assertEqual(user['lastname'], 'Ablo')
+        self.assertNotEqual(user['_etag'], changed_etag)
+        # The new etag is valid for further changes
+        self.api.patch('/users/changed', data={'lastname': 'Newer'},
+                       headers={'If-Match': user['_etag']}, status_code=200)
+
+        self.assertEqual(self.db['users'].count_documents({'nethz': 'new'}), 1)
+
+    def test_sync_all_invalid_user(self):
+        """Test that all valid users are created if the batch is rejected
+        because of a single invalid user."""
+        self.app.config['ldap_connector'] = FakeLdap([
+            self.fake_ldap_data(),
+            self.fake_ldap_data(cn=['new'],
+                                swissEduPersonMatriculationNumber='22222222'),
+            # The legi is used by pablo already
+            self.fake_ldap_data(cn=['nova']),
+        ])
+        self.new_object('users', **self.fake_filtered_data())
+
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result, {'created': 1, 'updated': 0, 'unchanged': 1})
+        self.assertEqual(self.db['users'].count_documents({'nethz': 'new'}), 1)
+        self.assertEqual(self.db['users'].count_documents({'nethz': 'nova'}),
+                         0)
+
+    def test_sync_all_invalid_legi(self):
+        """Test that users whose new legi can not be stored are not counted
+        as updated."""
+        self.app.config['ldap_connector'] = FakeLdap([
+            self.fake_ldap_data(),
+            # The legi is used by pablo already
+            self.fake_ldap_data(cn=['other']),
+        ])
+        self.new_object('users', **self.fake_filtered_data())
+        self.new_object('users', **dict(self.fake_filtered_data(),
+                                        nethz='other', legi='33333333',
+                                        email='other@ethz.ch'))
+
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result, {'created': 0, 'updated': 0, 'unchanged': 1})
+        user = self.db['users'].find_one({'nethz': 'other'})
+        self.assertEqual(user['legi'], '33333333')
+
+    def test_sync_all_resume(self):
+        """Test that an interrupted sync continues with the missing chunks."""
+        self.app.config['LDAP_SYNC_PAGE_SIZE'] = 1
+        fake = FakeLdap(self.fake_ldap_users(), fail=['n'])
+        self.app.config['ldap_connector'] = fake
+
+        with self.app.test_request_context():
+            with self.assertRaises(RuntimeError):
+                ldap.sync_all()
+
+        # All other chunks are done
+        progress = self.db['ldap_sync'].find_one({'_id': 'sync_all'})
+        self.assertEqual(progress['created'], 2)
+        self.assertNotIn('n', progress['done'])
+        self.assertEqual(self.db['users'].count_documents({}), 2)
+
+        fake.queries = []
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result, {'created': 3, 'updated': 0, 'unchanged': 0})
+        self.assertEqual(len(fake.queries), 1)
+        self.assertEqual(self.db['users'].count_documents({}), 3)
+        self.assertIsNone(self.db['ldap_sync'].find_one())
+
+        # Restart ignores the progress
+        fake.queries = []
+        with self.app.test_request_context():
+            result = ldap.sync_all(restart=True)
+        self.assertEqual(result, {'created': 0, 'updated': 0, 'unchanged': 3})
+
+
+class FakeLdap(object):
+    """Ldap connector searching a list of ldap entries.
+
+    Only understands the chunks of `sync_all`, i.e. filters entries by the
+    first character of the cn. Searching a chunk in `fail` raises an error
+    (once).
+    """
+
+    def __init__(self, entries, fail=()):
+        self.entries = entries
+        self.fail = set(fail)
+        self.queries = []
+
+    def search(self, query, attributes=None):
+        self.queries.append(query)
+        match = re.search(r'\(cn=(\w)\*\)\)$', query)
+        if match is None:
+            return (entry for entry in self.entries
+                    if entry['cn'][0][0] not in ldap.SYNC_CHUNK_CHARACTERS)
+
+        char = match.group(1)
+        if char in self.fail:
+            self.fail.remove(char)
+            raise RuntimeError("Ldap not available.")
+        return (entry for entry in self.entries
+                if entry['cn'][0].startswith(char))
+
+    iter_search = search
 
 
 # Integration Tests
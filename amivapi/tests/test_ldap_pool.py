@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the ldap connector pool, using stubbed connectors."""
+
+from threading import Event
+from time import sleep
+import unittest
+
+from amivapi.ldap_pool import LdapPool, LdapUnavailable
+
+
+class StubLdap(object):
+    """Connector which answers, fails or blocks on request."""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+
+    def authenticate(self, cn, password):
+        action = self.behaviour.pop(0) if self.behaviour else 'ok'
+        if action == 'fail':
+            raise ValueError("Connection lost.")
+        if isinstance(action, Event):
+            action.wait(timeout=5)
+        return password == 'correct'
+
+    def search(self, query, attributes=None):
+        yield query
+        if self.behaviour and self.behaviour[0] == 'fail':
+            self.behaviour.pop(0)
+            raise ValueError("Connection lost.")
+        yield attributes
+
+
+class LdapPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.behaviour = []
+        self.connectors = []
+        self.pool = LdapPool(self._create, size=2, timeout=0.2,
+                             failure_threshold=2, reset_timeout=0.3)
+
+    def _create(self):
+        connector = StubLdap(self.behaviour)
+        self.connectors.append(connector)
+        return connector
+
+    def test_connectors_reused(self):
+        """Test that connectors are created on demand and reused."""
+        self.assertTrue(self.pool.authenticate('pablo', 'correct'))
+        self.assertFalse(self.pool.authenticate('pablo', 'wrong'))
+        self.assertEqual(self.pool.search('(cn=pablo)', ['cn']),
+                         ['(cn=pablo)', ['cn']])
+        self.assertEqual(len(self.connectors), 1)
+        self.assertEqual(self.pool.stats['calls'], 3)
+
+    def test_broken_connectors_replaced(self):
+        """Test that failed and timed out connectors are replaced."""
+        blocked = Event()
+        self.behaviour.extend(['fail', blocked])
+
+        with self.assertRaises(LdapUnavailable):
+            self.pool.authenticate('pablo', 'correct')
+        with self.assertRaises(LdapUnavailable):
+            self.pool.authenticate('pablo', 'correct')
+        blocked.set()
+
+        self.assertEqual(self.pool.stats['errors'], 1)
+        self.assertEqual(self.pool.stats['timeouts'], 1)
+        self.assertEqual(len(self.connectors), 2)
+
+    def test_circuit_breaker(self):
+        """Test that the circuit opens after several failures and closes
+        after a successful call."""
+        self.behaviour.extend(['fail', 'fail'])
+        for _ in range(2):
+            with self.assertRaises(LdapUnavailable):
+                self.pool.authenticate('pablo', 'correct')
+
+        # Open, the connectors are not called anymore
+        with self.assertRaises(LdapUnavailable):
+            self.pool.authenticate('pablo', 'correct')
+        self.assertEqual(self.pool.stats['rejected'], 1)
+        self.assertEqual(len(self.connectors), 2)
+
+        sleep(0.3)
+        # A failed trial opens the circuit again
+        self.behaviour.append('fail')
+        with self.assertRaises(LdapUnavailable):
+            self.pool.authenticate('pablo', 'correct')
+        with self.assertRaises(LdapUnavailable):
+            self.pool.authenticate('pablo', 'correct')
+        self.assertEqual(self.pool.stats['rejected'], 2)
+
+        sleep(0.3)
+        self.assertTrue(self.pool.authenticate('pablo', 'correct'))
+        self.assertTrue(self.pool.authenticate('pablo', 'correct'))
+        self.assertEqual(self.pool.stats['opened'], 2)
+
+    def test_iter_search(self):
+        """Test that large searches are not limited by the timeout and
+        failures do not open the circuit."""
+        results = self.pool.iter_search('(cn=pablo)', ['cn'])
+        self.assertEqual(next(results), '(cn=pablo)')
+        sleep(0.3)
+        self.assertEqual(list(results), [['cn']])
+        self.assertEqual(self.pool.stats['searches'], 1)
+
+        # A search which is not completed does not return the connector
+        results = self.pool.iter_search('(cn=pablo)', ['cn'])
+        next(results)
+        results.close()
+        self.assertTrue(self.pool.authenticate('pablo', 'correct'))
+        self.assertEqual(len(self.connectors), 2)
+
+        self.behaviour.extend(['fail', 'fail'])
+        for _ in range(2):
+            with self.assertRaises(LdapUnavailable):
+                list(self.pool.iter_search('(cn=pablo)', ['cn']))
+        self.assertEqual(self.pool.stats['errors'], 2)
+        self.assertEqual(self.pool.stats['opened'], 0)
+        self.assertTrue(self.pool.authenticate('pablo', 'correct'))
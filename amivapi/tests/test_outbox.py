@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the mail outbox, using a local SMTP server."""
+
+import asyncore
+from datetime import datetime
+import smtpd
+from threading import Thread
+
+from amivapi.outbox import queue_mail, send_queued_mails
+from amivapi.tests.utils import WebTest
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """SMTP server collecting all mails, refuses mails with 'fail' as
+    subject."""
+
+    def __init__(self):
+        self.socket_map = {}
+        self.messages = []
+        super().__init__(('localhost', 0), None, map=self.socket_map,
+                         decode_data=True)
+        self.port = self.socket.getsockname()[1]
+        self.thread = Thread(target=asyncore.loop,
+                             kwargs={'timeout': 0.01, 'map': self.socket_map})
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if 'Subject: fail' in data:
+            return '451 Try again later'
+        self.messages.append({'from': mailfrom, 'to': rcpttos, 'data': data})
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        for channel in list(self.socket_map.values()):
+            channel.close()
+        self.thread.join()
+
+
+class OutboxTest(WebTest):
+    def setUp(self):
+        self.smtp_server = LocalSMTPServer()
+        self.smtp_server.start()
+        super().setUp(SMTP_SERVER='localhost',
+                      SMTP_PORT=self.smtp_server.port,
+                      SMTP_STARTTLS=False)
+
+    def tearDown(self):
+        self.smtp_server.stop()
+        super().tearDown()
+
+    def test_mails_sent_in_batch(self):
+        """Test that all queued mails are sent and marked as sent."""
+        with self.app.app_context():
+            for index in range(3):
+                queue_mail('api@example.com', ['user%i@example.com' % index],
+                           'subject %i' % index, 'text')
+
+            self.assertEqual(send_queued_mails(), 3)
+            # Nothing is sent twice
+            self.assertEqual(send_queued_mails(), 0)
+
+        self.assertEqual(len(self.smtp_server.messages), 3)
+        self.assertEqual(self.db['outbox'].count_documents(
+            {'status': 'sent', 'sent_time': {'$ne': None}}), 3)
+
+    def test_failed_mails_are_retried(self):
+        """Test that a failed mail is retried later and does not block
+        other mails."""
+        with self.app.app_context():
+            queue_mail('api@example.com', ['a@example.com'], 'fail', 'text')
+            queue_mail('api@example.com', ['b@example.com'], 'ok', 'text')
+
+            self.assertEqual(send_queued_mails(), 1)
+
+        failed = self.db['outbox'].find_one({'subject': 'fail'})
+        self.assertEqual(failed['status'], 'pending')
+        self.assertEqual(failed['attempts'], 1)
+        self.assertGreater(failed['next_attempt'], datetime.utcnow())
+        self.assertIn('451', failed['error'])
+
+        # Give up after the maximum number of attempts
+        self.db['outbox'].update_one(
+            {'_id': failed['_id']},
+            {'$set': {'next_attempt': datetime.utcnow(),
+                      'attempts': self.app.config['MAIL_MAX_ATTEMPTS'] - 1}})
+        with self.app.app_context():
+            self.assertEqual(send_queued_mails(), 0)
+
+        failed = self.db['outbox'].find_one({'subject': 'fail'})
+        self.assertEqual(failed['status'], 'failed')
+        self.assertEqual(len(self.smtp_server.messages), 1)
@@ -191,10 +191,10 @@ def _hash_password(user):
     Args:
         user (dict): dict of user data.
     """
-    password_context = current_app.config['PASSWORD_CONTEXT']
+    hasher = current_app.config['password_hasher']
 
     if user.get('password', None) is not None:
-        user['password'] = password_context.hash(user['password'])
+        user['password'] = hasher.hash(user['password'])
 
 
 def hash_on_insert(items):
@@ -8,10 +8,8 @@
 from base64 import b64encode
 from contextlib import contextmanager
 from copy import deepcopy
-from email.mime.text import MIMEText
 from os import urandom
 from binascii import hexlify
-import smtplib
 from functools import wraps
 import json
 
@@ -20,6 +18,8 @@ from eve.utils import config
 from flask import current_app as app
 from flask import g
 
+from amivapi.outbox import queue_mail
+
 
 def token_urlsafe(nbytes=32):
     """Cryptographically random generate a token that can be passed in a URL.
@@ -80,6 +80,8 @@ def mail(to, subject, text):
     The mail is sent from the address specified by `API_MAIL` in the config,
     and the subject formatted according to `API_MAIL_SUBJECT`.
 
+    The mail is only added to the outbox and sent later (see `outbox.py`).
+
 
     Args:
         to(list of strings): List of recipient addresses
@@ -97,35 +99,8 @@ def mail(to, subject, text):
             'text': text
         })
     elif config.SMTP_SERVER and config.SMTP_PORT:
-        msg = MIMEText(text)
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ';'.join([to] if isinstance(to, str) else to)
-
-        try:
-            with smtplib.SMTP(config.SMTP_SERVER,
-                              port=config.SMTP_PORT,
-                              timeout=config.SMTP_TIMEOUT) as smtp:
-                status_code, _ = smtp.starttls()
-                if status_code != 220:
-                    app.logger.error("Failed to create secure "
-                                     "SMTP connection!")
-                    return
-
-                if config.SMTP_USERNAME and config.SMTP_PASSWORD:
-                    smtp.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-                else:
-                    smtp.ehlo()
-
-                try:
-                    smtp.sendmail(msg['From'], to, msg.as_string())
-                except smtplib.SMTPRecipientsRefused:
-                    error = ("Failed to send mail:\n"
-                             "From: %s\nTo: %s\n"
-                             "Subject: %s\n\n%s")
-                    app.logger.error(error % (sender, str(to), subject, text))
-        except smtplib.SMTPException as e:
-            app.logger.error("SMTP error trying to send mails: %s" % e)
+        # Mails are sent in the background, see `amivapi.outbox`
+        queue_mail(sender, to, subject, text)
 
 
 def run_embedded_hooks_fetched_item(resource, item):
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Measure password verification throughput (i.e. logins per second).
+
+Compares verifying in request threads with verifying in a pool of worker
+processes (see amivapi/hashing.py), for 1 up to the number of cores.
+Passwords are verified with the `PASSWORD_CONTEXT` from the settings.
+
+Usage: benchmark_password_hashing.py [logins per measurement]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+from sys import argv
+from time import time
+
+from flask import Flask
+
+from amivapi.hashing import PasswordHasher
+from amivapi.settings import PASSWORD_CONTEXT
+
+LOGINS = int(argv[1]) if len(argv) > 1 else 200
+# Concurrent requests, e.g. threads of the server
+REQUEST_THREADS = 16
+
+
+def measure(hasher, hashed):
+    """Verify LOGINS passwords concurrently, return logins per second."""
+    app = Flask(__name__)
+
+    def login(_):
+        with app.app_context():
+            assert hasher.verify('password', hashed)
+
+    start = time()
+    with ThreadPoolExecutor(REQUEST_THREADS) as executor:
+        list(executor.map(login, range(LOGINS)))
+    return LOGINS / (time() - start)
+
+
+def main():
+    hashed = PASSWORD_CONTEXT.hash('password')
+
+    inline = PasswordHasher(PASSWORD_CONTEXT, workers=0, queue_size=0,
+                            timeout=60)
+    print("Request threads:  %7.1f logins/s" % measure(inline, hashed))
+
+    for workers in range(1, (cpu_count() or 1) + 1):
+        hasher = PasswordHasher(PASSWORD_CONTEXT, workers=workers,
+                                queue_size=LOGINS, timeout=60)
+        hasher.verify('password', hashed)  # Start processes
+        print("%2i process(es):   %7.1f logins/s"
+              % (workers, measure(hasher, hashed)))
+
+
+if __name__ == '__main__':
+    main()